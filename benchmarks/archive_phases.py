@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+
+# This file is part of pdar.
+#
+# Copyright 2011 Jason Penney
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Time creating, saving, loading and applying an archive of a synthetic
+tree.
+
+Each phase runs in a fresh interpreter, so peak RSS and I/O counters only
+reflect the work done up to the end of that phase.  Creating and saving
+share a process, since saving needs the created archive; the peak RSS of
+`save` therefore includes `create`.  Results are written as JSON so runs
+of different commits can be compared with `--compare`.'''
+
+from tempfile import mkdtemp
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import time
+
+from synthetic_tree import TreeGenerator, DEFAULTS, add_arguments
+
+PHASES = ['create', 'save', 'load', 'apply']
+
+
+def _io_counters():
+    # bytes passed to read and write calls, whether or not they reached
+    # the disk
+    counters = {}
+    try:
+        with open('/proc/self/io') as reader:
+            for line in reader:
+                key, value = line.split(':')
+                counters[key] = int(value)
+    except IOError:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        return {'bytes_read': usage.ru_inblock * 512,
+                'bytes_written': usage.ru_oublock * 512}
+    return {'bytes_read': counters['rchar'],
+            'bytes_written': counters['wchar']}
+
+
+class _Phase(object):
+
+    def __init__(self, name, results):
+        self._name = name
+        self._results = results
+
+    def __enter__(self):
+        self._io = _io_counters()
+        self._start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        elapsed = time.time() - self._start
+        io = _io_counters()
+        result = {
+            'seconds': elapsed,
+            'peak_rss_kib': resource.getrusage(
+                resource.RUSAGE_SELF).ru_maxrss}
+        for key, value in io.iteritems():
+            result[key] = value - self._io[key]
+        self._results[self._name] = result
+
+
+def run_phase(args):
+    import pdar
+
+    results = {}
+    if args.phase == 'create':
+        stats = pdar.StatsCollector()
+        with _Phase('create', results):
+            archive = pdar.PDArchive(args.orig_path, args.dest_path,
+                                     workers=args.jobs, observer=stats,
+                                     screen=not args.no_screen)
+        # how many changed files were stored whole without diffing them
+        results['create']['screen'] = dict(
+            (name[len('screen_'):], value)
+            for name, value in stats.counters.iteritems()
+            if name.startswith('screen_'))
+        with _Phase('save', results):
+            with open(args.archive_path, 'wb') as patchfile:
+                archive.save_archive(patchfile, args.codec, None,
+                                     args.layout)
+    elif args.phase == 'load':
+        with _Phase('load', results):
+            with open(args.archive_path, 'rb') as patchfile:
+                archive = pdar.PDArchive.load_archive(patchfile)
+        archive.close()
+    elif args.phase == 'apply':
+        with pdar.PDArchive.load(args.archive_path) as archive:
+            patcher = pdar.PDArchivePatcher(archive, args.patch_path,
+                                            workers=args.jobs)
+            with _Phase('apply', results):
+                patcher.apply_archive()
+    print json.dumps(results)
+
+
+def _run_subprocess(args, phase, **paths):
+    command = [sys.executable, os.path.abspath(__file__), '--phase', phase,
+               '--jobs', str(args.jobs)]
+    if args.codec:
+        command += ['--codec', args.codec]
+    if args.layout:
+        command += ['--layout', args.layout]
+    if args.no_screen:
+        command += ['--no-screen']
+    for key, value in paths.iteritems():
+        command += ['--%s' % key.replace('_', '-'), value]
+    return json.loads(subprocess.check_output(command).splitlines()[-1])
+
+
+def _commit():
+    try:
+        with open(os.devnull, 'wb') as devnull:
+            return subprocess.check_output(
+                ['git', 'rev-parse', 'HEAD'], stderr=devnull,
+                cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(args):
+    workdir = mkdtemp(prefix='pdar-bench.', dir=args.workdir)
+    try:
+        orig_path = os.path.join(workdir, 'orig')
+        dest_path = os.path.join(workdir, 'dest')
+        patch_path = os.path.join(workdir, 'patch')
+        archive_path = os.path.join(workdir, 'bench.pdar')
+
+        generator = TreeGenerator(**dict(
+                (key, getattr(args, key)) for key in DEFAULTS))
+        tree = generator.generate(orig_path, dest_path)
+
+        phases = _run_subprocess(args, 'create', orig_path=orig_path,
+                                 dest_path=dest_path,
+                                 archive_path=archive_path)
+        phases.update(_run_subprocess(args, 'load',
+                                      archive_path=archive_path))
+        shutil.copytree(orig_path, patch_path)
+        phases.update(_run_subprocess(args, 'apply',
+                                      archive_path=archive_path,
+                                      patch_path=patch_path))
+
+        return {
+            'commit': _commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'options': {'jobs': args.jobs, 'codec': args.codec,
+                        'layout': args.layout,
+                        'screen': not args.no_screen},
+            'tree': tree,
+            'archive_size': os.path.getsize(archive_path),
+            'phases': phases}
+    finally:
+        shutil.rmtree(workdir, True)
+
+
+def print_results(results, baseline=None):
+    print 'archive size: %d bytes' % results['archive_size']
+    columns = ('seconds', 'peak_rss_kib', 'bytes_read', 'bytes_written')
+    print '%-8s' % 'phase' + ''.join('  %14s' % col for col in columns)
+    for phase in PHASES:
+        values = results['phases'][phase]
+        line = '%-8s' % phase
+        for col in columns:
+            value = values[col]
+            if baseline is not None:
+                base = baseline['phases'].get(phase, {}).get(col)
+                if base:
+                    line += '  %13.2fx' % (float(value) / base)
+                    continue
+            if isinstance(value, float):
+                line += '  %14.3f' % value
+            else:
+                line += '  %14d' % value
+        print line
+    screen = results['phases']['create'].get('screen')
+    if screen:
+        print 'screened: ' + ', '.join(
+            '%s %d' % item for item in sorted(screen.iteritems()))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_arguments(parser)
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='workers used to create and apply (default: 1)')
+    parser.add_argument('--codec', default=None)
+    parser.add_argument('--layout', default=None)
+    parser.add_argument('--no-screen', action='store_true', default=False,
+                        help='diff every changed file, instead of storing '
+                        'incompressible files whole')
+    parser.add_argument('--workdir', default=None,
+                        help='directory the trees are generated in')
+    parser.add_argument('-o', '--output', default=None,
+                        help='file the JSON results are written to')
+    parser.add_argument('--compare', default=None,
+                        help='JSON results of an earlier run, printed as '
+                        'ratios of this run to that one')
+    # used internally to run a single phase
+    parser.add_argument('--phase', choices=['create', 'load', 'apply'],
+                        default=None, help=argparse.SUPPRESS)
+    for name in ('orig_path', 'dest_path', 'archive_path', 'patch_path'):
+        parser.add_argument('--%s' % name.replace('_', '-'), dest=name,
+                            default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.phase:
+        run_phase(args)
+        return 0
+
+    results = run_benchmark(args)
+    if args.output:
+        with open(args.output, 'wb') as writer:
+            json.dump(results, writer, indent=2, sort_keys=True)
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'rb') as reader:
+            baseline = json.load(reader)
+    print_results(results, baseline)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.dirname(os.path.dirname(
+                os.path.abspath(__file__))))
+    sys.exit(main())
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+
+# This file is part of pdar.
+#
+# Copyright 2011 Jason Penney
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Compare peak RSS of whole-file and chunked digest verification.
+
+Each method runs in a fresh interpreter so `ru_maxrss` only reflects the
+method being measured.  The test file is sparse, so no disk space is
+needed for large sizes.'''
+
+from tempfile import mkstemp
+import argparse
+import hashlib
+import os
+import resource
+import subprocess
+import sys
+import time
+
+METHODS = ['read', 'chunked', 'mmap']
+
+
+def run_method(method, path, hash_type):
+    import pdar
+
+    start = time.time()
+    if method == 'read':
+        # behaviour before chunked hashing
+        with open(path, 'rb') as reader:
+            digest = hashlib.new(hash_type, reader.read()).hexdigest()
+    else:
+        digest = pdar.PDAREntry._generate_file_digest(
+            path, hash_type, use_mmap=(method == 'mmap'))
+    elapsed = time.time() - start
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print '%s %d %f' % (digest, maxrss, elapsed)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-s', '--size', type=int, default=4096,
+                        help='size of test file in MiB (default: 4096)')
+    parser.add_argument('--hash-type', default='sha1')
+    parser.add_argument('--method', choices=METHODS, default=None,
+                        help='run a single method (used internally)')
+    parser.add_argument('--path', default=None,
+                        help='file to hash (used internally)')
+    args = parser.parse_args()
+
+    if args.method:
+        run_method(args.method, args.path, args.hash_type)
+        return 0
+
+    handle, path = mkstemp(prefix='pdar-bench.')
+    try:
+        with os.fdopen(handle, 'wb') as writer:
+            writer.truncate(args.size * 1024 * 1024)
+
+        print '%-8s  %12s  %8s' % ('method', 'peak RSS KiB', 'seconds')
+        digests = set()
+        for method in METHODS:
+            output = subprocess.check_output([
+                    sys.executable, __file__, '--method', method,
+                    '--path', path, '--hash-type', args.hash_type])
+            digest, maxrss, elapsed = output.split()
+            digests.add(digest)
+            print '%-8s  %12s  %8.2f' % (method, maxrss, float(elapsed))
+        if len(digests) != 1:
+            print 'ERROR: digests do not match'
+            return 1
+    finally:
+        os.unlink(path)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.dirname(os.path.dirname(
+                os.path.abspath(__file__))))
+    sys.exit(main())
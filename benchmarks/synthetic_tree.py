@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+
+# This file is part of pdar.
+#
+# Copyright 2011 Jason Penney
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Generate a pair of original and modified trees for benchmarks.
+
+File sizes follow a log-uniform distribution between `min_size` and
+`max_size`.  Contents are built from a seeded pool of random blocks, so
+trees are reproducible and compress about as well as typical binaries.
+Each original file is kept, edited, moved, copied or deleted according
+to the given ratios, and new files are added to the modified tree.'''
+
+import argparse
+import json
+import math
+import os
+import random
+import sys
+
+BLOCK_SIZE = 4096
+BLOCK_POOL_SIZE = 256
+FILES_PER_DIR = 100
+
+DEFAULTS = {
+    'files': 1000,
+    'min_size': 1024,
+    'max_size': 4 * 1024 * 1024,
+    'edit_ratio': 0.2,
+    'move_ratio': 0.05,
+    'copy_ratio': 0.05,
+    'delete_ratio': 0.05,
+    'new_ratio': 0.05,
+    'seed': 0}
+
+
+class TreeGenerator(object):
+
+    def __init__(self, files=DEFAULTS['files'],
+                 min_size=DEFAULTS['min_size'],
+                 max_size=DEFAULTS['max_size'],
+                 edit_ratio=DEFAULTS['edit_ratio'],
+                 move_ratio=DEFAULTS['move_ratio'],
+                 copy_ratio=DEFAULTS['copy_ratio'],
+                 delete_ratio=DEFAULTS['delete_ratio'],
+                 new_ratio=DEFAULTS['new_ratio'],
+                 seed=DEFAULTS['seed']):
+        if edit_ratio + move_ratio + delete_ratio > 1:
+            raise ValueError('edit, move and delete ratios exceed 1')
+        self.files = files
+        self.min_size = min_size
+        self.max_size = max_size
+        self.edit_ratio = edit_ratio
+        self.move_ratio = move_ratio
+        self.copy_ratio = copy_ratio
+        self.delete_ratio = delete_ratio
+        self.new_ratio = new_ratio
+        self.seed = seed
+        self._random = random.Random(seed)
+        self._blocks = [self._random_bytes(BLOCK_SIZE)
+                        for dummy in xrange(BLOCK_POOL_SIZE)]
+
+    @property
+    def params(self):
+        return dict((key, getattr(self, key)) for key in DEFAULTS)
+
+    def _random_bytes(self, size):
+        return ('%0*x' % (size * 2, self._random.getrandbits(size * 8))
+                ).decode('hex')
+
+    def _size(self):
+        return int(math.exp(self._random.uniform(
+                    math.log(self.min_size), math.log(self.max_size))))
+
+    def _data(self, size):
+        blocks = [self._random.choice(self._blocks)
+                  for dummy in xrange(size / BLOCK_SIZE + 1)]
+        return ''.join(blocks)[:size]
+
+    def _edit(self, data):
+        # overwrite, insert and remove a few runs of bytes
+        data = bytearray(data)
+        for dummy in xrange(self._random.randint(1, 8)):
+            offset = self._random.randint(0, len(data))
+            length = self._random.randint(1, max(1, len(data) / 50))
+            change = self._random_bytes(length)
+            action = self._random.choice(('overwrite', 'insert', 'remove'))
+            if action == 'overwrite':
+                data[offset:offset + length] = change
+            elif action == 'insert':
+                data[offset:offset] = change
+            else:
+                del data[offset:offset + length]
+        return str(data)
+
+    @classmethod
+    def _name(cls, num, suffix=''):
+        return os.path.join('d%04d' % (num / FILES_PER_DIR),
+                            'f%06d%s.bin' % (num, suffix))
+
+    @classmethod
+    def _write(cls, root, name, data):
+        path = os.path.join(root, name)
+        parent = os.path.dirname(path)
+        if not os.path.exists(parent):
+            os.makedirs(parent)
+        with open(path, 'wb') as writer:
+            writer.write(data)
+        return len(data)
+
+    def generate(self, orig_path, dest_path):
+        '''Write both trees, returning a summary of what was generated.'''
+        counts = dict.fromkeys(
+            ('same', 'edit', 'move', 'copy', 'delete', 'new'), 0)
+        orig_bytes = dest_bytes = 0
+        for num in xrange(self.files):
+            name = self._name(num)
+            data = self._data(self._size())
+            orig_bytes += self._write(orig_path, name, data)
+
+            choice = self._random.random()
+            if choice < self.edit_ratio:
+                counts['edit'] += 1
+                dest_bytes += self._write(dest_path, name, self._edit(data))
+            elif choice < self.edit_ratio + self.move_ratio:
+                counts['move'] += 1
+                dest_bytes += self._write(
+                    dest_path, self._name(num, '.moved'), data)
+            elif choice < self.edit_ratio + self.move_ratio + \
+                    self.delete_ratio:
+                counts['delete'] += 1
+            else:
+                counts['same'] += 1
+                dest_bytes += self._write(dest_path, name, data)
+
+            if self._random.random() < self.copy_ratio:
+                counts['copy'] += 1
+                dest_bytes += self._write(
+                    dest_path, self._name(num, '.copy'), data)
+
+        for num in xrange(int(self.files * self.new_ratio)):
+            counts['new'] += 1
+            dest_bytes += self._write(
+                dest_path, self._name(self.files + num),
+                self._data(self._size()))
+
+        return {'params': self.params, 'counts': counts,
+                'orig_bytes': orig_bytes, 'dest_bytes': dest_bytes}
+
+
+def add_arguments(parser):
+    for key, value in sorted(DEFAULTS.iteritems()):
+        parser.add_argument(
+            '--%s' % key.replace('_', '-'), dest=key, default=value,
+            type=type(value), help='(default: %s)' % value)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_arguments(parser)
+    parser.add_argument('orig_path')
+    parser.add_argument('dest_path')
+    args = parser.parse_args()
+    generator = TreeGenerator(**dict(
+            (key, getattr(args, key)) for key in DEFAULTS))
+    print json.dumps(generator.generate(args.orig_path, args.dest_path),
+                     indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -21,9 +21,17 @@ DEFAULT_HASH_TYPE = 'sha1'  # backwards compat
 
 # pylint: disable=W0401
 from pdar.archive import *
+from pdar.bspatch import *
+from pdar.cache import *
+from pdar.compression import *
 from pdar.entry import *
 from pdar.errors import *
+from pdar.journal import *
+from pdar.layout import *
 from pdar.patcher import *
+from pdar.payload import *
+from pdar.screen import *
+from pdar.stats import *
 # pylint: enable=W0401
 import os
 import sys
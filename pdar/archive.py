@@ -14,89 +14,286 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from bz2 import BZ2File
+from collections import OrderedDict, deque
 from datetime import datetime
-from gzip import GzipFile
+from itertools import islice, izip
 from pdar import PDAR_VERSION, DEFAULT_HASH_TYPE
+from pdar.cache import FileCache, DigestCache, DeltaCache
+from pdar.compression import *
 from pdar.entry import *
+from pdar.entry import ENTRY_HEADER_TARGET
+from pdar.entry import DEFAULT_BLOCK_THRESHOLD, DEFAULT_BLOCK_SIZE
+from pdar.entry import DEFAULT_REPLACE_RATIO
 from pdar.errors import *
+from pdar.layout import *
 from pdar.patcher import DEFAULT_PATCHER_TYPE
-from pkg_resources import parse_version
-from shutil import rmtree
-from tempfile import SpooledTemporaryFile, mkstemp
-import filecmp
+from pdar.payload import FilePayload, UnloadedPayload
+from pdar.screen import DiffScreen
+from pdar.stats import timed_phase
+from tempfile import mkstemp
 import fnmatch
 import logging
+import multiprocessing
 import os
 import re
+import shutil
 import tarfile
+import time
 
-__all__ = ['PDArchive', 'PDAR_MAGIC', 'PDAR_ID']
+__all__ = ['PDArchive', 'PDAR_MAGIC', 'PDAR_ID', 'PDAR_INDEXED_ID',
+           'PDAR_EXTENDED_ID', 'PDAR_EXTENDED_INDEXED_ID']
 
-PDAR_MAGIC = 'PDAR'
-PDAR_ID = '%s%03d%c' % (
-    PDAR_MAGIC, int(parse_version(PDAR_VERSION)[0]), 0)
+INDEXED_IDS = (PDAR_INDEXED_ID, PDAR_EXTENDED_INDEXED_ID)
 
 ARCHIVE_HEADER_VERSION = 'pdar_version'
 ARCHIVE_HEADER_CREATED = 'pdar_created_datetime'
 ARCHIVE_HEADER_HASH_TYPE = 'pdar_hash_type'
 
+DEFAULT_CODEC = 'gz'
+DEFAULT_LAYOUT = 'tar'
+
+COMPRESSION_SAMPLE_COUNT = 16
+COMPRESSION_SAMPLE_SIZE = 64 * 1024
+# compressed samples must be smaller than this ratio of their original
+# size, otherwise the archive is stored uncompressed
+COMPRESSION_MIN_RATIO = 0.95
+CODEC_HEADER_SIZE = tarfile.BLOCKSIZE
+COPY_CHUNK_SIZE = 1024 * 1024
+# entries being created, or waiting to be written, per worker process
+CREATE_WINDOW = 2
+
+
+class _PrefixedReader(object):
+    # replays bytes already read from `fileobj` when detecting the codec
+
+    def __init__(self, prefix, fileobj):
+        self._prefix = prefix
+        self._fileobj = fileobj
+
+    def read(self, size=-1):
+        if not self._prefix:
+            return self._fileobj.read(size)
+        if size < 0:
+            data, self._prefix = self._prefix + self._fileobj.read(), ''
+        else:
+            data = self._prefix[:size]
+            self._prefix = self._prefix[size:]
+            if len(data) < size:
+                data += self._fileobj.read(size - len(data))
+        return data
+
+
+_worker_create_args = None
+
+
+def _init_worker(create_args):
+    global _worker_create_args  # pylint: disable=W0603
+    _worker_create_args = create_args
+
+
+def _create_counters(create_args):
+    file_cache = create_args['file_cache']
+    counters = {'bytes_read': file_cache.bytes_read}
+    for name, cache in (('digest_cache', file_cache.digest_cache),
+                        ('delta_cache', create_args.get('delta_cache'))):
+        if cache is not None:
+            counters[name + '_hits'] = cache.hits
+            counters[name + '_misses'] = cache.misses
+    screen = create_args.get('screen')
+    if screen is not None:
+        for name, value in screen.counts.iteritems():
+            counters['screen_' + name] = value
+    return counters
+
+
+def _create_entry(job, create_args=None):
+    # module level so it can be pickled for use with multiprocessing
+    if create_args is None:
+        create_args = _worker_create_args
+    cls, target, orig_path, dest_path, hash_type = job
+    args = list(target)
+    args += [orig_path, dest_path, hash_type]
+    before = _create_counters(create_args)
+    start = time.time()
+    entry = cls.create(*args, **create_args)  # pylint: disable=W0142
+    seconds = time.time() - start
+    # counters are returned as differences, since a worker's caches are
+    # copies of those in the parent process
+    counters = dict((key, value - before[key]) for key, value
+                    in _create_counters(create_args).iteritems())
+    updates = []
+    digest_cache = create_args['file_cache'].digest_cache
+    if digest_cache is not None:
+        updates = digest_cache.pop_updates()
+    return entry, updates, (seconds, counters)
+
 
 class PDArchive(object):
 
+    _codecs = OrderedDict()
+    _layouts = OrderedDict([
+            ('tar', TarArchiveWriter),
+            ('indexed', IndexedArchiveWriter)])
+
     def __init__(self, orig_path, dest_path, patterns=['*'], payload=None,
-                 hash_type=DEFAULT_HASH_TYPE):
+                 hash_type=DEFAULT_HASH_TYPE, workers=None, digest_cache=None,
+                 delta_cache=None, observer=None,
+                 block_threshold=DEFAULT_BLOCK_THRESHOLD,
+                 block_size=DEFAULT_BLOCK_SIZE,
+                 replace_ratio=DEFAULT_REPLACE_RATIO, screen=True):
         self._hash_type = hash_type
+        self._observer = observer
+        self._payload_file = None
         if orig_path and dest_path and patterns and not payload:
-            logging.debug("""\
+            self._pdar_version = PDAR_VERSION
+            self._created_datetime = datetime.utcnow()
+            self._patches = list(self._iter_create(
+                    orig_path, dest_path, patterns, workers, digest_cache,
+                    delta_cache, block_threshold=block_threshold,
+                    block_size=block_size, replace_ratio=replace_ratio,
+                    screen=screen))
+        elif payload and not orig_path and not dest_path:
+            self._patches = payload['patches']
+            self._pdar_version = payload[ARCHIVE_HEADER_VERSION]
+            self._created_datetime = payload[ARCHIVE_HEADER_CREATED]
+            self._hash_type = payload[ARCHIVE_HEADER_HASH_TYPE]
+            self._payload_file = payload.get('payload_file')
+
+        else:
+            raise InvalidParameterError(
+                "You must pass either 'orig_path', 'dest_path', and "
+                "'patterns' OR 'payload'")
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:  # pylint: disable=W0703
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *dummy):
+        self.close()
+
+    def close(self):
+        # payloads of entries loaded from tar archives, and of block diffs
+        # created here, are kept in temporary files until the archive is
+        # closed
+        for patch in self._patches:
+            patch.discard_payload()
+        if self._payload_file is not None:
+            if os.path.exists(self._payload_file):
+                os.unlink(self._payload_file)
+            self._payload_file = None
+
+    def _iter_create(self, orig_path, dest_path, patterns, workers=None,
+                     digest_cache=None, delta_cache=None, stream=False,
+                     block_threshold=DEFAULT_BLOCK_THRESHOLD,
+                     block_size=DEFAULT_BLOCK_SIZE,
+                     replace_ratio=DEFAULT_REPLACE_RATIO, screen=True):
+        # entries are yielded in archive order as they are created, with
+        # `stream` the payloads of new files are left on disk.  Changed
+        # files larger than `block_threshold` are diffed in blocks, and
+        # stored whole when the delta is `replace_ratio` of their size or
+        # when `screen` (a DiffScreen, or True for the default) expects
+        # the delta to be useless.
+        observer = self.observer
+        logging.debug("""\
 creating new pdar:
   orig_path: %s
   dest_path: %s
   patterns: %s""" % (orig_path, dest_path, str(patterns)))
-            self._patches = []
-            pattern_re = r'|'.join([
-                    fnmatch.translate(pat) for pat in patterns])
-            pattern_re = re.compile(pattern_re)
-
-            def target_gen(path):
-                for root, dummy, files in os.walk(path):
-                    for dest in (
-                        os.path.normcase(
-                            os.path.join(root, f)) for f in files \
-                            if pattern_re.match(f)):
-                        yield os.path.relpath(dest, path)
-
+        pattern_re = r'|'.join([
+                fnmatch.translate(pat) for pat in patterns])
+        pattern_re = re.compile(pattern_re)
+
+        def target_gen(path):
+            for root, dummy, files in os.walk(path):
+                for dest in (
+                    os.path.normcase(
+                        os.path.join(root, f)) for f in files \
+                        if pattern_re.match(f)):
+                    yield os.path.relpath(dest, path)
+
+        with timed_phase(observer, 'scan'):
             orig_targets = set(target_gen(orig_path))
             dest_targets = set(target_gen(dest_path))
 
-            common_targets = [
-                (target, target, target) for target in (
-                    orig_targets & dest_targets)]
-            moved_targets = []
-            deleted_targets = []
-            new_targets = []
-            copied_targets = []
-
-            orig_only = orig_targets - dest_targets
-            dest_only = dest_targets - orig_targets
+        common_targets = [
+            (target, target, target) for target in (
+                orig_targets & dest_targets)]
+        moved_targets = []
+        deleted_targets = []
+        new_targets = []
+        copied_targets = []
+
+        orig_only = orig_targets - dest_targets
+        dest_only = dest_targets - orig_targets
+
+        # contents read while detecting moves are only worth retaining
+        # when the entries are created in this process
+        if workers == 0:
+            workers = multiprocessing.cpu_count()
+        if isinstance(digest_cache, basestring):
+            digest_cache = DigestCache(digest_cache)
+        if isinstance(delta_cache, basestring):
+            delta_cache = DeltaCache(delta_cache)
+        if workers and workers > 1:
+            file_cache = FileCache(retain_limit=0,
+                                   digest_cache=digest_cache)
+        else:
+            file_cache = FileCache(digest_cache=digest_cache)
+
+        def diffed_whole(orig_target, dest_target):
+            # larger files are diffed in blocks, without reading them
+            return not block_threshold or max(
+                os.path.getsize(os.path.join(orig_path, orig_target)),
+                os.path.getsize(os.path.join(dest_path, dest_target))
+                ) <= block_threshold
+
+        # index original files by size, digests are only generated
+        # for sizes shared with at least one new file, so each new file
+        # needs a single lookup to find a matching source
+        with timed_phase(observer, 'match'):
+            orig_sizes = {}
+            for target in orig_targets:
+                orig_sizes.setdefault(
+                    os.path.getsize(os.path.join(orig_path, target)),
+                    []).append(target)
+            orig_digests = {}
 
             source_match = {}
-            for target in dest_only:
-                matched = False
+            for target in sorted(dest_only):
                 dest_target_path = os.path.join(dest_path, target)
-                for potential_match in orig_targets:
-                    if filecmp.cmp(dest_target_path,
-                                   os.path.join(orig_path, potential_match)):
-                        source_match.setdefault(potential_match, [])
-                        source_match[potential_match].append(target)
-                        matched = True
-                        break
-                if not matched:
+                size = os.path.getsize(dest_target_path)
+                potential_match = None
+                if size in orig_sizes:
+                    if size not in orig_digests:
+                        digests = {}
+                        for source in sorted(orig_sizes[size]):
+                            # retained for the 'diff' entry of a source
+                            # that is still in dest
+                            digests.setdefault(file_cache.digest(
+                                    os.path.join(orig_path, source),
+                                    self.hash_type,
+                                    retain=source in dest_targets and
+                                    diffed_whole(source, source)), source)
+                        orig_digests[size] = digests
+                    # retained so the 'new' entry does not read it again,
+                    # unless its payload is left on disk
+                    potential_match = orig_digests[size].get(
+                        file_cache.digest(dest_target_path, self.hash_type,
+                                          retain=not stream))
+                if potential_match is None:
                     new_targets.append((target, None, target))
+                else:
+                    file_cache.release(dest_target_path)
+                    source_match.setdefault(potential_match, [])
+                    source_match[potential_match].append(target)
 
-            matched = source_match.keys()
             for target in orig_only:
-                if target not in matched:
+                if target not in source_match:
                     deleted_targets.append((target, target, None))
 
             for source, matches in source_match.iteritems():
@@ -114,44 +311,204 @@ creating new pdar:
                     target = move_match
                     moved_targets.append((target, source, target))
 
-            def add_entry(targets, cls):
-                args = list(targets)
-                args += [orig_path, dest_path, self.hash_type]
-                entry = cls.create(*args)  # pylint: disable=W0142
+        if observer is not None:
+            observer.count('bytes_read', file_cache.bytes_read)
+
+        jobs = []
+        for cls, targets in ((PDARCopyEntry, copied_targets),
+                             (PDARMoveEntry, moved_targets),
+                             (PDARDiffEntry, common_targets),
+                             (PDARDeleteEntry, deleted_targets),
+                             (PDARNewEntry, new_targets)):
+            # sorted so archive contents do not depend on set ordering
+            for target in sorted(targets):
+                job_cls = cls
+                if cls is PDARDiffEntry and \
+                        not diffed_whole(target[1], target[2]):
+                    job_cls = PDARBlockDiffEntry
+                jobs.append(
+                    (job_cls, target, orig_path, dest_path, self.hash_type))
+
+        if screen is True:
+            screen = DiffScreen()
+        elif not screen:
+            screen = None
+        create_args = {'file_cache': file_cache,
+                       'delta_cache': delta_cache,
+                       'stream_payloads': stream,
+                       'block_size': block_size,
+                       'replace_ratio': replace_ratio,
+                       'screen': screen}
+        with timed_phase(observer, 'create'):
+            for job, (entry, updates, stats) in izip(
+                jobs, self._create_entries(jobs, create_args, workers)):
+                if digest_cache is not None:
+                    digest_cache.update(updates)
+                if observer is not None:
+                    seconds, counters = stats
+                    for key, value in sorted(counters.iteritems()):
+                        observer.count(key, value)
+                    if entry:
+                        observer.entry_end('create', entry, seconds)
                 if entry:
                     logging.info("adding '%s' entry for: %s"
                                  % (entry.type_code, entry.target))
-                    self._patches.append(entry)
+                    yield entry
                 else:
-                    logging.debug("unchanged file: %s" % target[0])
+                    logging.debug("unchanged file: %s" % job[1][0])
 
-            for target in copied_targets:
-                add_entry(target, PDARCopyEntry)
+        if digest_cache is not None:
+            logging.debug("digest cache: %d hits, %d misses"
+                          % (digest_cache.hits, digest_cache.misses))
+            digest_cache.save()
+        if delta_cache is not None:
+            delta_cache.prune()
 
-            for target in moved_targets:
-                add_entry(target, PDARMoveEntry)
+    @classmethod
+    def _create_entries(cls, jobs, create_args, workers=None):
+        if not workers or workers < 2 or len(jobs) < 2:
+            for job in jobs:
+                yield _create_entry(job, create_args)
+            return
+
+        workers = min(workers, len(jobs))
+        logging.debug("creating entries using %d worker processes" % workers)
+        pool = multiprocessing.Pool(workers, _init_worker, (create_args,))
+        try:
+            # entries are handed over in the order of `jobs`, as soon as
+            # they and those before them are done.  Only a window of jobs
+            # is queued at a time, so entries finished behind a slow one
+            # do not pile up in memory
+            jobs = iter(jobs)
+            pending = deque(
+                pool.apply_async(_create_entry, (job,))
+                for job in islice(jobs, CREATE_WINDOW * workers))
+            while pending:
+                result = pending.popleft().get()
+                for job in islice(jobs, 1):
+                    pending.append(pool.apply_async(_create_entry, (job,)))
+                yield result
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
 
-            for target in common_targets:
-                add_entry(target, PDARDiffEntry)
+    @classmethod
+    def _writer_args(cls, codec, level, layout):
+        # checked before the archive file is opened
+        codec = cls.get_codec(codec)
+        codec.check_level(level)
+        if layout is None:
+            layout = DEFAULT_LAYOUT
+        if layout not in cls._layouts:
+            raise InvalidParameterError("unsupported layout: %s" % layout)
+        return codec, layout
 
-            for target in deleted_targets:
-                add_entry(target, PDARDeleteEntry)
+    @classmethod
+    def create(cls, path, orig_path, dest_path, force=False, **kwargs):
+        '''Create an archive at `path`, see `create_archive`.'''
+        if os.path.exists(path) and not force:
+            raise RuntimeError('File already exists: %s' % path)
+        cls._writer_args(kwargs.get('codec') or DEFAULT_CODEC,
+                         kwargs.get('level'), kwargs.get('layout'))
+        with open(path, 'wb') as patchfile:
+            return cls.create_archive(patchfile, orig_path, dest_path,
+                                      **kwargs)
 
-            for target in new_targets:
-                add_entry(target, PDARNewEntry)
+    @classmethod
+    def create_archive(cls, patchfile, orig_path, dest_path, patterns=['*'],
+                       hash_type=DEFAULT_HASH_TYPE, workers=None,
+                       digest_cache=None, delta_cache=None, codec=None,
+                       level=None, layout=None, observer=None,
+                       block_threshold=DEFAULT_BLOCK_THRESHOLD,
+                       block_size=DEFAULT_BLOCK_SIZE,
+                       replace_ratio=DEFAULT_REPLACE_RATIO, screen=True):
+        '''Create an archive of the changes from `orig_path` to
+        `dest_path`, writing each entry to `patchfile` as soon as it is
+        created.  Only the payload of the entry being written is held in
+        memory, and new files are copied straight from `dest_path`.
+
+        The codec is not estimated from the payloads, which have not been
+        created yet, so `DEFAULT_CODEC` is used unless `codec` is given.
+        The archive returned holds the entries without their payloads.'''
+        if codec is None:
+            codec = DEFAULT_CODEC
+        codec, layout = cls._writer_args(codec, level, layout)
+
+        archive = cls(orig_path=None, dest_path=None, patterns=None,
+                      observer=observer, payload={
+                ARCHIVE_HEADER_VERSION: PDAR_VERSION,
+                ARCHIVE_HEADER_CREATED: datetime.utcnow(),
+                ARCHIVE_HEADER_HASH_TYPE: hash_type,
+                'patches': []})
+        if observer is not None:
+            start = patchfile.tell()
+        # written as extended unless no extended entries can be created,
+        # the writer falls back when it can rewrite the file ID
+        extended = bool(block_threshold or replace_ratio or screen)
+        writer = cls._layouts[layout](patchfile, archive.headers, codec, level,
+                                      extended)
+        try:
+            for entry in archive._iter_create(
+                orig_path, dest_path, patterns, workers, digest_cache,
+                delta_cache, stream=True, block_threshold=block_threshold,
+                block_size=block_size, replace_ratio=replace_ratio,
+                screen=screen):
+                entry_start = time.time()
+                writer.add_entry(entry)
+                if observer is not None:
+                    observer.entry_end('save', entry,
+                                       time.time() - entry_start)
+                entry.unload_payload()
+                archive.patches.append(entry)
+        finally:
+            writer.close()
+        if observer is not None:
+            observer.count('bytes_written', patchfile.tell() - start)
+        return archive
 
-            self._pdar_version = PDAR_VERSION
-            self._created_datetime = datetime.utcnow()
-        elif payload and not orig_path and not dest_path:
-            self._patches = payload['patches']
-            self._pdar_version = payload[ARCHIVE_HEADER_VERSION]
-            self._created_datetime = payload[ARCHIVE_HEADER_CREATED]
-            self._hash_type = payload[ARCHIVE_HEADER_HASH_TYPE]
+    @classmethod
+    def register_codec(cls, codec):
+        cls._codecs[codec.name] = codec
 
-        else:
-            raise InvalidParameterError(
-                "You must pass either 'orig_path', 'dest_path', and "
-                "'patterns' OR 'payload'")
+    @classmethod
+    def codec_names(cls):
+        return [name for name, codec in cls._codecs.iteritems()
+                if codec.available]
+
+    @classmethod
+    def get_codec(cls, name):
+        codec = cls._codecs.get(name)
+        if codec is None or not codec.available:
+            raise InvalidParameterError("unsupported codec: %s" % name)
+        return codec
+
+    @classmethod
+    def layout_names(cls):
+        return cls._layouts.keys()
+
+    @classmethod
+    def detect_codec(cls, header):
+        for codec in cls._codecs.itervalues():
+            if codec.matches(header):
+                if not codec.available:
+                    raise UnsupportedArchiveError(
+                        "archive compressed with unsupported codec: %s"
+                        % codec.name)
+                return codec
+        raise PDArchiveFormatError("Unknown archive compression")
+
+    @property
+    def observer(self):
+        '''Receives events of saving and applying this archive, see
+        :mod:`pdar.stats`.'''
+        return self._observer
+
+    @observer.setter
+    def observer(self, value):
+        self._observer = value
 
     @property
     def hash_type(self):
@@ -169,107 +526,228 @@ creating new pdar:
     def patches(self):
         return self._patches
 
-    def save(self, path, force=False):
+    def save(self, path, force=False, codec=None, level=None, layout=None):
         if os.path.exists(path) and not force:
             raise RuntimeError('File already exists: %s' % path)
+        if codec is None:
+            codec = self.estimate_codec(level)
+        self._writer_args(codec, level, layout)
         with open(path, 'wb') as patchfile:
-            self.save_archive(patchfile)
-
-    def save_archive(self, patchfile):
-        with SpooledTemporaryFile() as tmpfile:
-            tfile = tarfile.open(
-                mode='w', fileobj=tmpfile,
-                format=tarfile.PAX_FORMAT,
-                pax_headers={
-                    ARCHIVE_HEADER_VERSION: unicode(self.pdar_version),
-                    ARCHIVE_HEADER_CREATED: unicode(
-                        self.created_datetime.isoformat()),
-                    ARCHIVE_HEADER_HASH_TYPE: unicode(self.hash_type)})
+            self.save_archive(patchfile, codec, level, layout)
+
+    def estimate_codec(self, level=None):
+        # compress evenly spaced samples of the payloads with each codec,
+        # rather than compressing the whole archive with each of them.
+        # Only the middle of each sampled payload is read
+        codecs = [self.get_codec(name) for name in self.codec_names()
+                  if name != StoreCodec.name]
+        if level is not None:
+            codecs = [codec for codec in codecs if level in codec.levels]
+            if not codecs:
+                raise InvalidParameterError(
+                    "unsupported compression level: %s" % level)
+        patches = [patch for patch in self.patches if patch.payload_size]
+        if not patches:
+            return DEFAULT_CODEC
+        step = max(1, len(patches) / COMPRESSION_SAMPLE_COUNT)
+        samples = []
+        for patch in patches[::step]:
+            reader = patch.open_payload(max(
+                    0, (patch.payload_size - COMPRESSION_SAMPLE_SIZE) / 2))
+            try:
+                samples.append(reader.read(COMPRESSION_SAMPLE_SIZE))
+            finally:
+                reader.close()
+        sample = ''.join(samples)
+
+        best_codec = StoreCodec.name
+        best_size = len(sample) * COMPRESSION_MIN_RATIO
+        for codec in codecs:
+            size = len(codec.compress(sample, level))
+            if size < best_size:
+                best_codec, best_size = codec.name, size
+        logging.debug("estimated best compression: %s" % best_codec)
+        return best_codec
 
+    @property
+    def headers(self):
+        return {
+            ARCHIVE_HEADER_VERSION: unicode(self.pdar_version),
+            ARCHIVE_HEADER_CREATED: unicode(
+                self.created_datetime.isoformat()),
+            ARCHIVE_HEADER_HASH_TYPE: unicode(self.hash_type)}
+
+    def save_archive(self, patchfile, codec=None, level=None, layout=None):
+        if codec is None:
+            codec = self.estimate_codec(level)
+        codec, layout = self._writer_args(codec, level, layout)
+
+        observer = self.observer
+        with timed_phase(observer, 'save'):
+            if observer is not None:
+                start = patchfile.tell()
+            writer = self._layouts[layout](
+                patchfile, self.headers, codec, level,
+                any(patch.extended for patch in self.patches))
             try:
                 for patch in self.patches:
-                    patch.pax_dump(tfile)
+                    if observer is None:
+                        writer.add_entry(patch)
+                        continue
+                    entry_start = time.time()
+                    writer.add_entry(patch)
+                    observer.entry_end('save', patch,
+                                       time.time() - entry_start)
             finally:
-                tfile.close()
-            tmpfile.flush()
-
-            # find best compression
-            archive_path = None
-            for comp in [GzipFile, BZ2File]:
-                dummy, test_path = mkstemp(prefix=__name__)
-                os.close(dummy)
-                compfile = comp(test_path, mode='wb',
-                                compresslevel=9)
-                tmpfile.seek(0)
-                compfile.writelines(tmpfile)
-                compfile.close()
-                if not archive_path or os.path.getsize(
-                    archive_path) > os.path.getsize(test_path):
-                    if archive_path and os.path.exists(archive_path):
-                        os.unlink(archive_path)
-                    archive_path = test_path
-
-            patchfile.write(PDAR_ID)
-            with open(archive_path, 'rb') as archive:
-                patchfile.writelines(archive)
-            patchfile.flush()
-
-    def patch(self, path=None, patcher=None):
+                writer.close()
+            if observer is not None:
+                observer.count('bytes_written', patchfile.tell() - start)
+
+    def patch(self, path=None, patcher=None, **kwargs):
         if patcher is None:
-            patcher = DEFAULT_PATCHER_TYPE(self, path)
+            patcher = DEFAULT_PATCHER_TYPE(self, path, **kwargs)
 
         patcher.apply_archive()
 
     @classmethod
-    def load(cls, path):
+    def load(cls, path, payloads=True, observer=None):
         with open(path, 'rb') as patchfile:
             try:
-                return cls.load_archive(patchfile)
+                return cls.load_archive(patchfile, payloads, observer)
             except PDArchiveFormatError, err:
                 raise PDArchiveFormatError("%s: %s" % (str(err), path))
 
     @classmethod
-    def load_archive(cls, patchfile):
-        with SpooledTemporaryFile(prefix=__name__) as archive:
-            file_id = patchfile.read(len(PDAR_ID))
-            if not file_id.startswith(PDAR_MAGIC):
-                raise PDArchiveFormatError("Not a pdar file")
-            if file_id != PDAR_ID:
-                raise PDArchiveFormatError(
-                    "Unsupported pdar version ID '%s'"
-                    % (file_id[len(PDAR_MAGIC):-1]))
-            archive.writelines(patchfile)
-            archive.seek(0)
-            patches = []
-            payload = {}
-            tfile = tarfile.open(mode='r:*', fileobj=archive)
+    def _read_file_id(cls, patchfile):
+        file_id = patchfile.read(len(PDAR_ID))
+        if not file_id.startswith(PDAR_MAGIC):
+            raise PDArchiveFormatError("Not a pdar file")
+        if file_id not in (PDAR_ID, PDAR_EXTENDED_ID) + INDEXED_IDS:
+            raise PDArchiveFormatError(
+                "Unsupported pdar version ID '%s'"
+                % (file_id[len(PDAR_MAGIC):-1]))
+        return file_id
+
+    @classmethod
+    def _parse_headers(cls, headers):
+        payload = dict(headers)
+        if ARCHIVE_HEADER_CREATED in payload:
+            cdt = payload[ARCHIVE_HEADER_CREATED]
+            if isinstance(cdt, basestring):
+                iso, dummy, iso_ms = cdt.partition('.')
+                cdt = datetime.strptime(
+                    iso.replace("-", ""), "%Y%m%dT%H:%M:%S")
+                if iso_ms:
+                    cdt = cdt.replace(microsecond=int(iso_ms))
+            payload[ARCHIVE_HEADER_CREATED] = cdt
+        return payload
+
+    @classmethod
+    def _iter_tar_members(cls, patchfile, headers):
+        header = patchfile.read(CODEC_HEADER_SIZE)
+        codec = cls.detect_codec(header)
+        archive = codec.open_reader(_PrefixedReader(header, patchfile))
+        tfile = tarfile.open(mode='r|', fileobj=archive)
+        try:
+            headers.update(tfile.pax_headers)
+            tinfo = tfile.next()
+            while tinfo:
+                yield tfile, tinfo
+                tinfo = tfile.next()
+        finally:
+            tfile.close()
+
+    @classmethod
+    def _load_tar_headers(cls, patchfile, headers):
+        # member data is skipped over in the decompressed stream, rather
+        # than written out
+        patches = []
+        for dummy, tinfo in cls._iter_tar_members(patchfile, headers):
+            payload = ''
+            if tinfo.size:
+                payload = UnloadedPayload(tinfo.size)
+            patches.append(PDAREntry.from_headers(
+                    tinfo.pax_headers, payload=payload))
+        return patches
+
+    @classmethod
+    def _load_tar_entries(cls, patchfile, headers, payload_file):
+        # decompressed payloads are written to `payload_file` so only the
+        # payloads being applied need to be held in memory
+        patches = []
+        with open(payload_file, 'wb') as writer:
+            for tfile, tinfo in cls._iter_tar_members(patchfile, headers):
+                payload = ''
+                if tinfo.size:
+                    payload = FilePayload(payload_file, writer.tell(),
+                                          tinfo.size)
+                    shutil.copyfileobj(tfile.extractfile(tinfo), writer,
+                                       COPY_CHUNK_SIZE)
+                patches.append(PDAREntry.from_headers(
+                        tinfo.pax_headers, payload=payload))
+        return patches
+
+    @classmethod
+    def load_archive(cls, patchfile, payloads=True, observer=None):
+        '''Load an archive from `patchfile`.  Without `payloads`, only the
+        entry headers and payload sizes are read.'''
+        with timed_phase(observer, 'load'):
+            archive = cls._load_archive(patchfile, payloads)
+        archive.observer = observer
+        return archive
+
+    @classmethod
+    def _load_archive(cls, patchfile, payloads):
+        payload = {}
+        if cls._read_file_id(patchfile) in INDEXED_IDS:
+            path = getattr(patchfile, 'name', None)
+            if not isinstance(path, basestring) or not os.path.isfile(path):
+                path = None
+            reader = IndexedArchiveReader(patchfile, cls.get_codec, path)
+            payload.update(reader.headers)
+            patches = [reader.load_entry(record, payloads)
+                       for record in reader.records]
+        elif not payloads:
+            patches = cls._load_tar_headers(patchfile, payload)
+        else:
+            handle, payload_file = mkstemp(prefix='pdar-payload.')
+            os.close(handle)
             try:
-                payload.update(tfile.pax_headers)
-                if ARCHIVE_HEADER_CREATED in payload:
-                    cdt = payload[ARCHIVE_HEADER_CREATED]
-                    if isinstance(cdt, basestring):
-                        iso, iso_ms = cdt.split('.', 1)
-                        cdt = datetime.strptime(
-                            iso.replace("-", ""), "%Y%m%dT%H:%M:%S")
-                        if iso_ms:
-                            cdt = cdt.replace(microsecond=int(iso_ms))
-                    payload[ARCHIVE_HEADER_CREATED] = cdt
-
-                data = tfile.next()
-                while data:
-                    patch = PDAREntry.pax_load(tfile, data)
-                    patches.append(patch)
-                    data = tfile.next()
-            finally:
-                tfile.close()
-            payload['patches'] = patches[:]
-
-            # if 0 > cmp(parse_version(PDAR_VERSION),
-            #            parse_version(patch.pdar_version)):
-            #     raise RuntimeError(
-            #         "File '%s' created with pdar protocal %s. "
-            #         "This verion of pdar only supports up to %s."
-            #         % (patch.pdar_version, PDAR_VERSION))
-            # return patch
-            return cls(orig_path=None, dest_path=None, patterns=None,
-                       payload=payload)
+                patches = cls._load_tar_entries(
+                    patchfile, payload, payload_file)
+            except:
+                os.unlink(payload_file)
+                raise
+            payload['payload_file'] = payload_file
+        payload = cls._parse_headers(payload)
+        payload['patches'] = patches
+
+        # if 0 > cmp(parse_version(PDAR_VERSION),
+        #            parse_version(patch.pdar_version)):
+        #     raise RuntimeError(
+        #         "File '%s' created with pdar protocal %s. "
+        #         "This verion of pdar only supports up to %s."
+        #         % (patch.pdar_version, PDAR_VERSION))
+        # return patch
+        return cls(orig_path=None, dest_path=None, patterns=None,
+                   payload=payload)
+
+    @classmethod
+    def load_entry(cls, path, target):
+        with open(path, 'rb') as patchfile:
+            if cls._read_file_id(patchfile) in INDEXED_IDS:
+                reader = IndexedArchiveReader(patchfile, cls.get_codec)
+                record = reader.find_record(target)
+                if record is not None:
+                    return reader.load_entry(record)
+            else:
+                for tfile, tinfo in cls._iter_tar_members(patchfile, {}):
+                    if tinfo.pax_headers.get(ENTRY_HEADER_TARGET) == target:
+                        return PDAREntry.pax_load(tfile, tinfo)
+        raise InvalidParameterError(
+            "No entry for '%s' in archive: %s" % (target, path))
+
+
+for _codec in (GzipCodec(), BZ2Codec(), LZMACodec(), StoreCodec()):
+    PDArchive.register_codec(_codec)
+del _codec
@@ -0,0 +1,170 @@
+# This file is part of pdar.
+#
+# Copyright 2011 Jason Penney
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Apply bsdiff4 patches without holding the original file, the patch or
+the result in memory.
+
+A BSDIFF40 patch is a header followed by three bzip2 streams: control
+triples, bytes added to the original, and extra bytes inserted as is.
+Each stream is read with its own reader of the patch, and the result is
+written in chunks of at most `chunk_size` bytes.'''
+
+from bsdiff4 import core
+from pdar.payload import read_fully
+import bz2
+
+__all__ = ['patch_stream']
+
+BSDIFF_MAGIC = 'BSDIFF40'
+BSDIFF_HEADER_SIZE = 32
+CONTROL_SIZE = 24
+STREAM_CHUNK_SIZE = 1024 * 1024
+# bounds on compressed bytes passed to the decompressor at a time, runs of
+# repeated bytes can expand by several orders of magnitude
+MIN_FEED_SIZE = 64
+MAX_FEED_SIZE = 64 * 1024
+
+
+def _skip(reader, size):
+    while size > 0:
+        chunk = reader.read(min(size, STREAM_CHUNK_SIZE))
+        if not chunk:
+            raise ValueError("bsdiff patch is truncated")
+        size -= len(chunk)
+    return reader
+
+
+class _BZ2Reader(object):
+    # decompresses at most `size` bytes of `reader`, or all of it
+
+    def __init__(self, reader, size=None, chunk_size=STREAM_CHUNK_SIZE):
+        self._reader = reader
+        self._remaining = size
+        self._chunk_size = chunk_size
+        self._feed_size = MAX_FEED_SIZE
+        self._decompressor = bz2.BZ2Decompressor()
+        self._buffer = ''
+        self._offset = 0
+        self._eof = False
+
+    def _fill(self):
+        size = self._feed_size
+        if self._remaining is not None:
+            size = min(size, self._remaining)
+        data = size and self._reader.read(size)
+        if not data:
+            self._eof = True
+            return
+        if self._remaining is not None:
+            self._remaining -= len(data)
+        try:
+            output = self._decompressor.decompress(data)
+        except EOFError:
+            # trailing data after the end of the stream
+            self._eof = True
+            return
+        if len(output) > self._chunk_size:
+            self._feed_size = max(MIN_FEED_SIZE, self._feed_size / 2)
+        elif len(output) < self._chunk_size / 4:
+            self._feed_size = min(MAX_FEED_SIZE, self._feed_size * 2)
+        self._buffer = self._buffer[self._offset:] + output
+        self._offset = 0
+
+    def read(self, size):
+        while len(self._buffer) - self._offset < size and not self._eof:
+            self._fill()
+        data = self._buffer[self._offset:self._offset + size]
+        self._offset += len(data)
+        return data
+
+
+def _read_orig(orig, offset, size):
+    # bytes outside of the original are left as they are in the diff
+    if offset >= 0:
+        orig.seek(offset)
+        return orig.read(size)
+    lead = min(size, -offset)
+    orig.seek(0)
+    return '\0' * lead + orig.read(size - lead)
+
+
+def patch_stream(orig, open_patch, writer, chunk_size=STREAM_CHUNK_SIZE):
+    '''Apply a BSDIFF40 patch to the seekable file `orig`, writing the
+    result to `writer` and returning its size.
+
+    `open_patch` is called three times, and must return a new reader of
+    the patch from its start each time.'''
+    reader = open_patch()
+    streams = []
+    try:
+        header = read_fully(reader, BSDIFF_HEADER_SIZE)
+        if len(header) < BSDIFF_HEADER_SIZE or \
+                header[:len(BSDIFF_MAGIC)] != BSDIFF_MAGIC:
+            raise ValueError("incorrect magic bsdiff4 header")
+        len_control, len_diff, len_dst = [
+            core.decode_int64(header[offset:offset + 8])
+            for offset in (8, 16, 24)]
+
+        streams.append(reader)
+        control = _BZ2Reader(reader, len_control, chunk_size)
+        streams.append(_skip(open_patch(),
+                             BSDIFF_HEADER_SIZE + len_control))
+        diff = _BZ2Reader(streams[-1], len_diff, chunk_size)
+        streams.append(_skip(open_patch(),
+                             BSDIFF_HEADER_SIZE + len_control + len_diff))
+        extra = _BZ2Reader(streams[-1], None, chunk_size)
+
+        orig_offset = 0
+        written = 0
+        while written < len_dst:
+            triple = control.read(CONTROL_SIZE)
+            if len(triple) < CONTROL_SIZE:
+                raise ValueError("bsdiff patch is truncated")
+            add_size, extra_size, seek = [
+                core.decode_int64(triple[offset:offset + 8])
+                for offset in (0, 8, 16)]
+            if written + add_size + extra_size > len_dst:
+                raise ValueError("bsdiff patch is corrupt")
+
+            while add_size > 0:
+                size = min(add_size, chunk_size)
+                data = diff.read(size)
+                if len(data) < size:
+                    raise ValueError("bsdiff patch is truncated")
+                # core.patch adds the original to the diff bytes in C
+                writer.write(core.patch(
+                        _read_orig(orig, orig_offset, size), size,
+                        [(size, 0, 0)], data, ''))
+                orig_offset += size
+                add_size -= size
+                written += size
+
+            while extra_size > 0:
+                size = min(extra_size, chunk_size)
+                data = extra.read(size)
+                if len(data) < size:
+                    raise ValueError("bsdiff patch is truncated")
+                writer.write(data)
+                extra_size -= size
+                written += size
+
+            orig_offset += seek
+        return written
+    finally:
+        if reader not in streams:
+            reader.close()
+        for stream in streams:
+            stream.close()
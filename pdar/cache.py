@@ -0,0 +1,397 @@
+# This file is part of pdar.
+#
+# Copyright 2011 Jason Penney
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from collections import OrderedDict
+from tempfile import mkstemp
+import hashlib
+import json
+import logging
+import mmap
+import os
+import shutil
+
+__all__ = ['FileCache', 'DigestCache', 'DeltaCache']
+
+DEFAULT_RETAIN_LIMIT = 64 * 1024 * 1024
+DEFAULT_DIGEST_CACHE_SIZE = 1000000
+DEFAULT_DELTA_CACHE_SIZE = 1024 * 1024 * 1024
+
+DIGEST_CHUNK_SIZE = 1024 * 1024
+
+DIGEST_CACHE_VERSION = 1
+
+
+def file_digest(path, hash_type, chunk_size=DIGEST_CHUNK_SIZE,
+                use_mmap=False):
+    '''Generate the digest of the file at `path`, reading `chunk_size`
+    bytes at a time so memory use does not depend on the file size.'''
+    digest = hashlib.new(hash_type)
+    with open(path, 'rb') as reader:
+        size = os.fstat(reader.fileno()).st_size
+        if use_mmap:
+            # map one window at a time, a single mapping of the whole file
+            # would leave every page of it resident
+            window = max(chunk_size - chunk_size % mmap.ALLOCATIONGRANULARITY,
+                         mmap.ALLOCATIONGRANULARITY)
+            for offset in xrange(0, size, window):
+                mapped = mmap.mmap(reader.fileno(), min(window, size - offset),
+                                   access=mmap.ACCESS_READ, offset=offset)
+                try:
+                    digest.update(mapped)
+                finally:
+                    mapped.close()
+        else:
+            chunk = reader.read(chunk_size)
+            while chunk:
+                digest.update(chunk)
+                chunk = reader.read(chunk_size)
+    return digest.hexdigest()
+
+
+def mtime_ns(stat_result):
+    '''Modification time of `stat_result` in integer nanoseconds.'''
+    result = getattr(stat_result, 'st_mtime_ns', None)
+    if result is None:
+        result = int(stat_result.st_mtime * 1000000000)
+    return result
+
+
+def _stat_key(path, hash_type, stat_result=None):
+    if stat_result is None:
+        stat_result = os.stat(path)
+    return (os.path.abspath(path), stat_result.st_size,
+            mtime_ns(stat_result), stat_result.st_ino, hash_type)
+
+
+class DigestCache(object):
+    '''Digests stored on disk between runs, keyed by path, size, mtime,
+    inode and hash type so files that have not changed are not hashed
+    again.  The least recently used digests are dropped once the cache
+    holds more than `max_entries`.'''
+
+    def __init__(self, path, max_entries=DEFAULT_DIGEST_CACHE_SIZE):
+        self._path = path
+        self._max_entries = max_entries
+        self._entries = OrderedDict()
+        self._updates = []
+        self._hits = 0
+        self._misses = 0
+        if os.path.exists(path):
+            self.load()
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def max_entries(self):
+        return self._max_entries
+
+    @property
+    def hits(self):
+        return self._hits
+
+    @property
+    def misses(self):
+        return self._misses
+
+    def __len__(self):
+        return len(self._entries)
+
+    def load(self):
+        try:
+            with open(self.path, 'rb') as reader:
+                data = json.load(reader)
+        except ValueError, err:
+            logging.warn("ignoring invalid digest cache '%s': %s",
+                         self.path, str(err))
+            return
+        if data.get('version') != DIGEST_CACHE_VERSION:
+            logging.warn("ignoring digest cache '%s' with unsupported "
+                         "version", self.path)
+            return
+        for path, size, mtime_ns, inode, hash_type, digest in data.get(
+            'entries', []):
+            self._set((path.encode('utf-8'), size, mtime_ns, inode,
+                       str(hash_type)), str(digest))
+
+    def save(self):
+        parent = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.exists(parent):
+            os.makedirs(parent)
+        handle, tmp_path = mkstemp(prefix='.digest_cache.', dir=parent)
+        try:
+            with os.fdopen(handle, 'wb') as writer:
+                json.dump({
+                        'version': DIGEST_CACHE_VERSION,
+                        'entries': [list(key) + [digest] for key, digest
+                                    in self._entries.iteritems()]},
+                          writer)
+            if os.name == 'nt' and os.path.exists(self.path):
+                os.unlink(self.path)
+            os.rename(tmp_path, self.path)
+        except:
+            os.unlink(tmp_path)
+            raise
+
+    def _set(self, key, digest):
+        self._entries.pop(key, None)
+        self._entries[key] = digest
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def get(self, path, hash_type, stat_result=None):
+        key = _stat_key(path, hash_type, stat_result)
+        digest = self._entries.pop(key, None)
+        if digest is None:
+            self._misses += 1
+            return None
+        self._hits += 1
+        self._entries[key] = digest
+        return digest
+
+    def put(self, path, hash_type, digest, stat_result=None):
+        key = _stat_key(path, hash_type, stat_result)
+        self._set(key, digest)
+        self._updates.append((key, digest))
+
+    def pop_updates(self):
+        updates, self._updates = self._updates, []
+        return updates
+
+    def update(self, updates):
+        for key, digest in updates:
+            self._set(key, digest)
+
+
+class DeltaCache(object):
+    '''Deltas stored in a directory, addressed by the digests of the files
+    they were generated from and the parameters used to generate them.
+    `prune` removes the least recently used deltas once the directory
+    holds more than `max_size` bytes.'''
+
+    _tmp_prefix = '.tmp.'
+
+    def __init__(self, path, max_size=DEFAULT_DELTA_CACHE_SIZE):
+        self._path = path
+        self._max_size = max_size
+        self._hits = 0
+        self._misses = 0
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def max_size(self):
+        return self._max_size
+
+    @property
+    def hits(self):
+        return self._hits
+
+    @property
+    def misses(self):
+        return self._misses
+
+    def _delta_path(self, orig_digest, dest_digest, hash_type, params=()):
+        key = hashlib.sha1('|'.join(
+                [hash_type, orig_digest, dest_digest] +
+                [str(param) for param in params])).hexdigest()
+        return os.path.join(self.path, key[:2], key)
+
+    def get(self, orig_digest, dest_digest, hash_type, params=()):
+        path = self._delta_path(orig_digest, dest_digest, hash_type, params)
+        try:
+            with open(path, 'rb') as reader:
+                delta = reader.read()
+        except IOError:
+            self._misses += 1
+            return None
+        self._used(path)
+        return delta
+
+    def get_path(self, orig_digest, dest_digest, hash_type, params=()):
+        '''Path of a cached delta, for deltas too large to read into
+        memory, or None.  The file may be removed by the next `prune`.'''
+        path = self._delta_path(orig_digest, dest_digest, hash_type, params)
+        if not os.path.isfile(path):
+            self._misses += 1
+            return None
+        self._used(path)
+        return path
+
+    def _used(self, path):
+        self._hits += 1
+        try:
+            # mtime tracks use for `prune`
+            os.utime(path, None)
+        except OSError:
+            pass
+
+    def put(self, orig_digest, dest_digest, hash_type, delta, params=()):
+        self._put(orig_digest, dest_digest, hash_type, params,
+                  lambda writer: writer.write(delta))
+
+    def put_file(self, orig_digest, dest_digest, hash_type, delta_path,
+                 params=()):
+        '''Store the delta in the file at `delta_path`.'''
+
+        def copy(writer):
+            with open(delta_path, 'rb') as reader:
+                shutil.copyfileobj(reader, writer, DIGEST_CHUNK_SIZE)
+
+        self._put(orig_digest, dest_digest, hash_type, params, copy)
+
+    def _put(self, orig_digest, dest_digest, hash_type, params, write):
+        path = self._delta_path(orig_digest, dest_digest, hash_type, params)
+        parent = os.path.dirname(path)
+        if not os.path.exists(parent):
+            try:
+                os.makedirs(parent)
+            except OSError:
+                # created by another process
+                if not os.path.isdir(parent):
+                    raise
+        handle, tmp_path = mkstemp(prefix=self._tmp_prefix, dir=parent)
+        try:
+            with os.fdopen(handle, 'wb') as writer:
+                write(writer)
+            if os.name == 'nt' and os.path.exists(path):
+                os.unlink(path)
+            os.rename(tmp_path, path)
+        except:
+            os.unlink(tmp_path)
+            raise
+
+    def prune(self):
+        deltas = []
+        total_size = 0
+        for root, dummy, files in os.walk(self.path):
+            for fname in files:
+                if fname.startswith(self._tmp_prefix):
+                    continue
+                path = os.path.join(root, fname)
+                try:
+                    stat_result = os.stat(path)
+                except OSError:
+                    continue
+                deltas.append(
+                    (stat_result.st_mtime, stat_result.st_size, path))
+                total_size += stat_result.st_size
+
+        deltas.sort()
+        for dummy, size, path in deltas:
+            if total_size <= self.max_size:
+                break
+            logging.debug("removing cached delta: %s", path)
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            total_size -= size
+        return total_size
+
+
+class FileCache(object):
+    '''File contents and digests shared by the entries created for a
+    single archive, so input files are only read once.
+
+    Digests are kept for the life of the cache.  File contents are only
+    kept when requested with `retain`, up to `retain_limit` bytes, and are
+    released by the next `read` of the same file.'''
+
+    def __init__(self, retain_limit=DEFAULT_RETAIN_LIMIT, digest_cache=None):
+        self._retain_limit = retain_limit
+        self._digest_cache = digest_cache
+        self._retained_size = 0
+        self._data = {}
+        self._digests = {}
+        self._bytes_read = 0
+
+    def __getstate__(self):
+        # retained data is only useful to the process that read it
+        state = self.__dict__.copy()
+        state.update({'_data': {}, '_retained_size': 0})
+        return state
+
+    @property
+    def bytes_read(self):
+        return self._bytes_read
+
+    @property
+    def digest_cache(self):
+        return self._digest_cache
+
+    @classmethod
+    def _key(cls, path):
+        return os.path.abspath(path)
+
+    def _retain(self, key, data):
+        if self._retained_size + len(data) <= self._retain_limit:
+            self._data[key] = data
+            self._retained_size += len(data)
+
+    def release(self, path):
+        data = self._data.pop(self._key(path), None)
+        if data is not None:
+            self._retained_size -= len(data)
+
+    def read(self, path, hash_type=None, retain=False):
+        key = self._key(path)
+        data = self._data.get(key)
+        stat_result = None
+        if data is None:
+            with open(path, 'rb') as reader:
+                stat_result = os.fstat(reader.fileno())
+                data = reader.read()
+            self._bytes_read += len(data)
+        else:
+            self.release(path)
+
+        if hash_type is not None and (key, hash_type) not in self._digests:
+            digest = hashlib.new(hash_type, data).hexdigest()
+            self._digests[(key, hash_type)] = digest
+            if self.digest_cache is not None and stat_result is not None:
+                self.digest_cache.put(path, hash_type, digest, stat_result)
+        if retain:
+            self._retain(key, data)
+        return data
+
+    def cached_digest(self, path, hash_type):
+        key = (self._key(path), hash_type)
+        digest = self._digests.get(key)
+        if digest is None and self.digest_cache is not None:
+            digest = self.digest_cache.get(path, hash_type)
+            if digest is not None:
+                self._digests[key] = digest
+        return digest
+
+    def digest(self, path, hash_type, retain=False):
+        digest = self.cached_digest(path, hash_type)
+        if digest is None:
+            key = self._key(path)
+            if retain or key in self._data:
+                self.read(path, hash_type, retain)
+                return self.cached_digest(path, hash_type)
+
+            stat_result = os.stat(path)
+            digest = file_digest(path, hash_type)
+            self._bytes_read += stat_result.st_size
+            self._digests[(key, hash_type)] = digest
+            if self.digest_cache is not None:
+                self.digest_cache.put(path, hash_type, digest, stat_result)
+        return digest
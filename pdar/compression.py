@@ -0,0 +1,224 @@
+# This file is part of pdar.
+#
+# Copyright 2011 Jason Penney
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from StringIO import StringIO
+from pdar.errors import InvalidParameterError
+import bz2
+import zlib
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+__all__ = ['BaseCodec', 'GzipCodec', 'BZ2Codec', 'LZMACodec', 'StoreCodec']
+
+READ_CHUNK_SIZE = 64 * 1024
+
+
+class _CompressorWriter(object):
+
+    def __init__(self, fileobj, compressor):
+        self._fileobj = fileobj
+        self._compressor = compressor
+
+    def write(self, data):
+        data = self._compressor.compress(data)
+        if data:
+            self._fileobj.write(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self._compressor is not None:
+            self._fileobj.write(self._compressor.flush())
+            self._compressor = None
+
+
+class _NullCompressor(object):
+
+    def compress(self, data):
+        return data
+
+    decompress = compress
+
+    def flush(self):
+        return ''
+
+
+class _DecompressorReader(object):
+
+    def __init__(self, fileobj, decompressor):
+        self._fileobj = fileobj
+        self._decompressor = decompressor
+        self._buf = ''
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self, size):
+        chunks = [self._buf[self._pos:]]
+        available = len(chunks[0])
+        while not self._eof and (size < 0 or available < size):
+            data = self._fileobj.read(READ_CHUNK_SIZE)
+            if not data:
+                self._eof = True
+                break
+            try:
+                data = self._decompressor.decompress(data)
+            except EOFError:
+                # trailing data after the end of the compressed stream
+                self._eof = True
+                break
+            chunks.append(data)
+            available += len(data)
+        self._buf = ''.join(chunks)
+        self._pos = 0
+
+    def read(self, size=-1):
+        if size < 0 or len(self._buf) - self._pos < size:
+            self._fill(size)
+        if size < 0:
+            size = len(self._buf) - self._pos
+        data = self._buf[self._pos:self._pos + size]
+        self._pos += len(data)
+        return data
+
+    def close(self):
+        self._buf = ''
+        self._pos = 0
+        self._eof = True
+
+
+class BaseCodec(object):
+
+    name = None
+    magic = None
+    default_level = None
+    # levels accepted by the codec, None when the level is ignored
+    levels = ()
+    available = True
+
+    def compress(self, data, level=None):
+        raise NotImplementedError()
+
+    def open_writer(self, fileobj, level=None):
+        raise NotImplementedError()
+
+    def open_reader(self, fileobj):
+        raise NotImplementedError()
+
+    def decompress(self, data):
+        return self.open_reader(StringIO(data)).read()
+
+    def matches(self, header):
+        return self.magic is not None and header.startswith(self.magic)
+
+    def check_level(self, level):
+        if level is not None and self.levels is not None and \
+                level not in self.levels:
+            raise InvalidParameterError(
+                "unsupported compression level for %s: %s"
+                % (self.name, level))
+
+    def _level(self, level):
+        if level is None:
+            return self.default_level
+        return level
+
+
+class GzipCodec(BaseCodec):
+
+    name = 'gz'
+    magic = '\x1f\x8b'
+    default_level = 9
+    levels = range(10)
+
+    @classmethod
+    def _compressobj(cls, level):
+        # wbits of 16 + MAX_WBITS selects the gzip container
+        return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data, level=None):
+        compressor = self._compressobj(self._level(level))
+        return compressor.compress(data) + compressor.flush()
+
+    def open_writer(self, fileobj, level=None):
+        return _CompressorWriter(
+            fileobj, self._compressobj(self._level(level)))
+
+    def open_reader(self, fileobj):
+        return _DecompressorReader(
+            fileobj, zlib.decompressobj(16 + zlib.MAX_WBITS))
+
+
+class BZ2Codec(BaseCodec):
+
+    name = 'bz2'
+    magic = 'BZh'
+    default_level = 9
+    levels = range(1, 10)
+
+    def compress(self, data, level=None):
+        return bz2.compress(data, self._level(level))
+
+    def open_writer(self, fileobj, level=None):
+        return _CompressorWriter(
+            fileobj, bz2.BZ2Compressor(self._level(level)))
+
+    def open_reader(self, fileobj):
+        return _DecompressorReader(fileobj, bz2.BZ2Decompressor())
+
+
+class LZMACodec(BaseCodec):
+
+    name = 'xz'
+    magic = '\xfd7zXZ\x00'
+    default_level = 6
+    levels = range(10)
+    available = lzma is not None
+
+    def compress(self, data, level=None):
+        return lzma.compress(data, preset=self._level(level))
+
+    def open_writer(self, fileobj, level=None):
+        return _CompressorWriter(
+            fileobj, lzma.LZMACompressor(preset=self._level(level)))
+
+    def open_reader(self, fileobj):
+        return _DecompressorReader(fileobj, lzma.LZMADecompressor())
+
+
+class StoreCodec(BaseCodec):
+
+    name = 'store'
+    levels = None
+
+    def compress(self, data, level=None):
+        return data
+
+    def open_writer(self, fileobj, level=None):
+        return _CompressorWriter(fileobj, _NullCompressor())
+
+    def open_reader(self, fileobj):
+        return _DecompressorReader(fileobj, _NullCompressor())
+
+    def matches(self, header):
+        # uncompressed archives are plain tar files
+        return header[257:262] == 'ustar'
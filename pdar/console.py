@@ -17,18 +17,33 @@
 # limitations under the License.
 
 import argparse
+import json
 import locale
 import logging
 import os
 import pdar
+import pdar.cache
+import pdar.entry
 import pdar.errors
+import pdar.patcher
+import pdar.screen
 import shutil
+import sys
 
 
 def pdar_create(args):
-    archive = pdar.PDArchive(orig_path=args.path1,
-                             dest_path=args.path2,
-                             patterns=args.patterns)
+    digest_cache = None
+    if args.digest_cache:
+        digest_cache = pdar.DigestCache(args.digest_cache,
+                                        args.digest_cache_size)
+    delta_cache = None
+    if args.delta_cache:
+        delta_cache = pdar.DeltaCache(args.delta_cache, args.delta_cache_size)
+    screen = None
+    if not args.no_screen:
+        screen = pdar.DiffScreen(
+            allow=args.screen_allow,
+            deny=pdar.screen.DEFAULT_DENY_EXTENSIONS + tuple(args.screen_deny))
     if args.backup:
         if os.path.exists(args.archive_name):
             backup_name = '.'.join([args.archive_name, 'bak'])
@@ -37,23 +52,77 @@ def pdar_create(args):
             args.force = True
             shutil.copy(args.archive_name,
                         '.'.join([args.archive_name, 'bak']))
+    if args.stream:
+        logging.debug("streaming archive: %s" % args.archive_name)
+        pdar.PDArchive.create(args.archive_name, args.path1, args.path2,
+                              force=args.force, patterns=args.patterns,
+                              workers=args.jobs, digest_cache=digest_cache,
+                              delta_cache=delta_cache, codec=args.codec,
+                              level=args.level, layout=args.layout,
+                              observer=args.observer,
+                              block_threshold=args.block_threshold,
+                              block_size=args.block_size,
+                              replace_ratio=args.replace_ratio,
+                              screen=screen)
+        logging.debug("Success!")
+        return 0
+    archive = pdar.PDArchive(orig_path=args.path1,
+                             dest_path=args.path2,
+                             patterns=args.patterns,
+                             workers=args.jobs,
+                             digest_cache=digest_cache,
+                             delta_cache=delta_cache,
+                             observer=args.observer,
+                             block_threshold=args.block_threshold,
+                             block_size=args.block_size,
+                             replace_ratio=args.replace_ratio,
+                             screen=screen)
     logging.debug("saving archive: %s" % args.archive_name)
-    archive.save(args.archive_name, args.force)
+    archive.save(args.archive_name, args.force, args.codec, args.level,
+                 args.layout)
     logging.debug("Success!")
     return 0
 
 
 def pdar_apply(args):
-    archive = pdar.PDArchive.load(args.archive_name)
-    if args.output_path:
-        logging.debug("copying files '%s'->'%s'", args.path,
-                      args.output_path)
-        shutil.copytree(args.path, args.output_path)
-        path = args.output_path
-    else:
-        path = args.path
-
-    archive.patch(path)
+    with pdar.PDArchive.load(args.archive_name,
+                             observer=args.observer) as archive:
+        if args.rollback:
+            pdar.PDArchivePatcher(archive, args.path).rollback_journal()
+            return 0
+        if args.output_path:
+            logging.debug("copying files '%s'->'%s'", args.path,
+                          args.output_path)
+            shutil.copytree(args.path, args.output_path)
+            path = args.output_path
+        else:
+            path = args.path
+
+        archive.patch(path, workers=args.jobs, atomic=args.atomic,
+                      journal=args.journal, verify=args.verify,
+                      preflight=args.preflight,
+                      stream_threshold=args.stream_threshold,
+                      patch_processes=args.processes)
+    return 0
+
+
+def pdar_verify(args):
+    failed = 0
+    with pdar.PDArchive.load(args.archive_name, payloads=False,
+                             observer=args.observer) as archive:
+        patcher = pdar.PDArchivePatcher(archive, args.path, workers=args.jobs)
+        for entry, passed in patcher.audit():
+            if not passed:
+                failed += 1
+            print json.dumps({
+                    'target': entry.target,
+                    'type': entry.type_code,
+                    'dest_digest': entry.dest_digest,
+                    'status': passed and 'pass' or 'fail'})
+    if failed:
+        logging.warn("%d of %d entries failed verification", failed,
+                     len(archive.patches))
+        return 1
     return 0
 
 
@@ -65,11 +134,11 @@ PDAR version: %(pdar_version)s
         size: %(archive_size)s bytes
 '''
     archive_size = os.path.getsize(args.archive_name)
-    archive = pdar.PDArchive.load(args.archive_name)
-
-    entry_info = [
-        (locale.format("%d", len(entry.payload), grouping=True),
-         entry.target, entry.type_code) for entry in archive.patches]
+    with pdar.PDArchive.load(args.archive_name, payloads=False,
+                             observer=args.observer) as archive:
+        entry_info = [
+            (locale.format("%d", entry.payload_size, grouping=True),
+             entry.target, entry.type_code) for entry in archive.patches]
 
     max_size_str_width = max(len(info[0]) for info in entry_info)
     max_target_str_width = max(len(info[1]) for info in entry_info)
@@ -106,6 +175,17 @@ PDAR version: %(pdar_version)s
     return 0
 
 
+def run_command(args):
+    args.observer = None
+    if args.stats:
+        args.observer = pdar.StatsCollector()
+    try:
+        return args.func(args)
+    finally:
+        if args.observer is not None:
+            print >> sys.stderr, args.observer.summary()
+
+
 def pdar_cmd():
 
     if locale.getlocale() == (None, None):
@@ -124,6 +204,9 @@ def pdar_cmd():
     logging_args.add_argument('-q', '--quiet', dest='log_level',
                               action='store_const', const=logging.WARN,
                               default=logging.INFO)
+    parser.add_argument('--stats', action='store_true', default=False,
+                        help='print time spent in each phase, and other '
+                        'statistics, when done')
     subparsers = parser.add_subparsers(
         title='commands',
         )
@@ -141,6 +224,84 @@ def pdar_cmd():
             'backup existing archive before overwriting '
             '(implies force, existing backups may be lost).'),
         dest='backup', action='store_true')
+    parser_create.add_argument(
+        '--stream', help=(
+            'write each entry as soon as it is created, so memory use is '
+            'bounded by the largest changed file rather than the whole '
+            'archive (the codec is not estimated, gz is used unless '
+            '--codec is given)'),
+        dest='stream', action='store_true')
+    parser_create.add_argument(
+        '-j', '--jobs', help=(
+            'number of worker processes used to generate deltas '
+            '(0 uses one per CPU)'),
+        dest='jobs', default=1, type=int)
+    parser_create.add_argument(
+        '--codec', help=(
+            'compression used for the archive (default: estimated from '
+            'a sample of the archive contents)'),
+        dest='codec', default=None, choices=pdar.PDArchive.codec_names())
+    parser_create.add_argument(
+        '--level', help=(
+            'compression level, the meaning and default depend on the codec '
+            '(bz2 only accepts 1 to 9)'),
+        dest='level', default=None, type=int, choices=range(10))
+    parser_create.add_argument(
+        '--layout', help=(
+            "archive layout, 'indexed' archives can be listed and read one "
+            "entry at a time (default: tar)"),
+        dest='layout', default=None, choices=pdar.PDArchive.layout_names())
+    parser_create.add_argument(
+        '--digest-cache', help=(
+            'file used to cache digests of unchanged files between runs'),
+        dest='digest_cache', default=None, type=str)
+    parser_create.add_argument(
+        '--digest-cache-size', help=(
+            'maximum number of digests kept in the digest cache'),
+        dest='digest_cache_size', default=pdar.cache.DEFAULT_DIGEST_CACHE_SIZE,
+        type=int)
+    parser_create.add_argument(
+        '--delta-cache', help=(
+            'directory used to cache deltas between runs'),
+        dest='delta_cache', default=None, type=str)
+    parser_create.add_argument(
+        '--delta-cache-size', help=(
+            'maximum size in bytes of the delta cache'),
+        dest='delta_cache_size', default=pdar.cache.DEFAULT_DELTA_CACHE_SIZE,
+        type=int)
+    parser_create.add_argument(
+        '--block-threshold', help=(
+            'changed files larger than this many bytes are diffed one block '
+            'at a time, 0 diffs every file whole (default: %(default)s)'),
+        dest='block_threshold', default=pdar.entry.DEFAULT_BLOCK_THRESHOLD,
+        type=int)
+    parser_create.add_argument(
+        '--block-size', help=(
+            'size in bytes of the blocks large files are diffed in '
+            '(default: %(default)s)'),
+        dest='block_size', default=pdar.entry.DEFAULT_BLOCK_SIZE, type=int)
+    parser_create.add_argument(
+        '--replace-ratio', help=(
+            'changed files are stored whole when their delta is at least '
+            'this ratio of their size, 0 always stores deltas '
+            '(default: %(default)s)'),
+        dest='replace_ratio', default=pdar.entry.DEFAULT_REPLACE_RATIO,
+        type=float)
+    parser_create.add_argument(
+        '--no-screen', help=(
+            'diff every changed file, rather than storing files that look '
+            'compressed whole'),
+        dest='no_screen', action='store_true')
+    parser_create.add_argument(
+        '--screen-allow', help=(
+            'extension, such as .jar, of files that are always diffed '
+            '(may be repeated)'),
+        dest='screen_allow', action='append', default=[], metavar='EXT')
+    parser_create.add_argument(
+        '--screen-deny', help=(
+            'extension of files that are stored whole rather than diffed, '
+            'in addition to common compressed formats (may be repeated)'),
+        dest='screen_deny', action='append', default=[], metavar='EXT')
 
     parser_create.add_argument(
         'archive_name',
@@ -167,6 +328,49 @@ def pdar_cmd():
         help=('apply patch in alternate location, rather than overwriting '
               'original files'),
         dest='output_path', default=None, type=str)
+    parser_apply.add_argument(
+        '-j', '--jobs', help=(
+            'number of threads used to apply entries (0 uses one per CPU, '
+            'the default is 1, or one per CPU for --preflight)'),
+        dest='jobs', default=None, type=int)
+    parser_apply.add_argument(
+        '--processes', help=(
+            'apply deltas in this many worker processes rather than in '
+            'the threads applying entries (0 uses one per CPU, by default '
+            'no processes are used)'),
+        dest='processes', default=None, type=int)
+    parser_apply.add_argument(
+        '--atomic', help=(
+            'write each patched file next to the original and rename it '
+            'into place, keeping the original as a hard link backup'),
+        dest='atomic', action='store_true')
+    parser_apply.add_argument(
+        '--journal', help=(
+            'record progress in a journal in the target path, so an '
+            'interrupted apply is resumed by the next run'),
+        dest='journal', action='store_true')
+    parser_apply.add_argument(
+        '--rollback', help=(
+            'roll back the interrupted apply recorded in the journal of '
+            'the target path, rather than resuming it'),
+        dest='rollback', action='store_true')
+    parser_apply.add_argument(
+        '--verify', help=(
+            'when resuming, verify the digests of files the journal records '
+            'as patched rather than only their size and modification time'),
+        dest='verify', action='store_true')
+    parser_apply.add_argument(
+        '--preflight', help=(
+            'verify every original file before changing anything, '
+            'reporting all mismatches at once'),
+        dest='preflight', action='store_true')
+    parser_apply.add_argument(
+        '--stream-threshold', help=(
+            'files larger than this many bytes are patched a chunk at a '
+            'time rather than in memory, 0 patches every file in memory '
+            '(default: %(default)s)'),
+        dest='stream_threshold', type=int,
+        default=pdar.patcher.DEFAULT_STREAM_THRESHOLD)
     parser_apply.add_argument(
         'archive_name',
         help='path to output pdar archive')
@@ -174,6 +378,24 @@ def pdar_cmd():
         'path',
         help='path to which pdar will be applied')
 
+    parser_verify = subparsers.add_parser(
+        'verify',
+        description=('check that a path matches the patched state of a pdar '
+                     'archive, printing one JSON result per entry'),
+        help='check path against patched state of pdar archive')
+    parser_verify.set_defaults(func=pdar_verify)
+    parser_verify.add_argument(
+        '-j', '--jobs', help=(
+            'number of threads used to verify entries '
+            '(0 uses one per CPU, the default)'),
+        dest='jobs', default=0, type=int)
+    parser_verify.add_argument(
+        'archive_name',
+        help='path to pdar archive')
+    parser_verify.add_argument(
+        'path',
+        help='path to verify')
+
     parser_info = subparsers.add_parser(
         'info',
         description='show info about pdar archive',
@@ -191,10 +413,10 @@ def pdar_cmd():
                         level=args.log_level)
 
     if args.log_level == logging.DEBUG:
-        parser.exit(args.func(args))
+        parser.exit(run_command(args))
 
     try:
-        parser.exit(args.func(args))
+        parser.exit(run_command(args))
     except pdar.errors.InternalError, err:
         logging.error("internal error")
         logging.debug(" -- %s", str(err))
@@ -18,15 +18,20 @@ import os
 import bsdiff4
 import stat
 import tarfile
-import filecmp
 
 from pdar import DEFAULT_HASH_TYPE
-from pdar.errors import InvalidParameterError
+from pdar.cache import FileCache, file_digest
+from pdar.errors import InvalidParameterError, PDArchiveFormatError
+from pdar.errors import UnsupportedArchiveError
+from pdar.payload import FilePayload, TemporaryPayload, UnloadedPayload
+from pdar.payload import discard_payload, open_payload, payload_size
+from pdar.payload import read_fully, read_payload
 import hashlib
-from StringIO import StringIO
+import struct
 
 __all__ = ['PDAREntry', 'PDARCopyEntry', 'PDARNewEntry',
-           'PDARMoveEntry', 'PDARDeleteEntry', 'PDARDiffEntry']
+           'PDARMoveEntry', 'PDARDeleteEntry', 'PDARDiffEntry',
+           'PDARBlockDiffEntry', 'PDARReplaceEntry']
 
 ENTRY_HEADER_TYPE = 'pdar_entry_type'
 ENTRY_HEADER_DEST_DIGEST = 'pdar_entry_dest_digest'
@@ -34,6 +39,16 @@ ENTRY_HEADER_ORIG_DIGEST = 'pdar_entry_orig_digest'
 ENTRY_HEADER_TARGET = 'pdar_entry_target'
 ENTRY_HEADER_TARGET_SOURCE = 'pdar_entry_target_source'
 
+# files larger than the threshold are diffed one block at a time, against
+# a window of the original around the same offset
+DEFAULT_BLOCK_THRESHOLD = 64 * 1024 * 1024
+DEFAULT_BLOCK_SIZE = 4 * 1024 * 1024
+# orig offset, orig size, patch size
+BLOCK_HEADER = struct.Struct('>QQQ')
+# changed files are stored whole when their delta is at least this ratio
+# of their size
+DEFAULT_REPLACE_RATIO = 1.0
+
 DEFAULT_MODE = os.umask(0)
 os.umask(DEFAULT_MODE)
 DEFAULT_MODE = 0700 & ~DEFAULT_MODE
@@ -79,6 +94,14 @@ class PDAREntry(object):
 
     __metaclass__ = _PDAREntryMeta
 
+    # streamed entries are always applied from the target file to a new
+    # file, other entries are streamed when the patcher chooses to
+    streamed = False
+
+    # extended entries can not be applied by releases before they were
+    # added, so are only written to archives of the extended format
+    extended = False
+
     # pylint: disable=W0613
     def __init__(self, target, payload='', mode=DEFAULT_MODE,
                  orig_digest=None, dest_digest=None,
@@ -110,12 +133,40 @@ class PDAREntry(object):
 
     @property
     def payload(self):
-        return self._payload
+        # payloads loaded from an archive are only read when requested,
+        # and are not kept in memory afterwards
+        return read_payload(self._payload)
+
+    @property
+    def payload_size(self):
+        return payload_size(self._payload)
+
+    def open_payload(self, offset=0):
+        return open_payload(self._payload, offset)
+
+    def unload_payload(self):
+        '''Release the payload once it has been written, keeping only its
+        size.'''
+        size = self.payload_size
+        if size:
+            discard_payload(self._payload)
+            self._payload = UnloadedPayload(size)
+
+    def discard_payload(self):
+        '''Remove the temporary file holding a generated payload.'''
+        discard_payload(self._payload)
 
     @property
     def target(self):
         return self._target
 
+    def target_path(self, root=None):
+        '''Path of the target, relative to `root` rather than the current
+        directory when it is given.'''
+        if root:
+            return os.path.join(root, self.target)
+        return self.target
+
     @property
     def orig_digest(self):
         return self._orig_digest
@@ -132,27 +183,33 @@ class PDAREntry(object):
     def _generate_digest(cls, data, hash_type):
         return hashlib.new(hash_type, data).hexdigest()
 
+    @classmethod
+    def _generate_file_digest(cls, path, hash_type, use_mmap=False):
+        return file_digest(path, hash_type, use_mmap=use_mmap)
+
     def generate_digest(self, data):
         return self._generate_digest(data, self.hash_type)
 
-    def _verify_digest(self, digest, data=None, path=None):
+    def generate_file_digest(self, path, use_mmap=False):
+        return self._generate_file_digest(path, self.hash_type, use_mmap)
+
+    def _verify_digest(self, digest, data=None, path=None, root=None):
         if data is None:
             if path is None:
-                path = self.target
-            with open(path, 'rb') as verify_reader:
-                data = verify_reader.read()
+                path = self.target_path(root)
+            return digest == self.generate_file_digest(path)
         return digest == self.generate_digest(data)
 
-    def verify_orig_digest(self, data=None, path=None):
-        return self._verify_digest(self.orig_digest, data, path)
+    def verify_orig_digest(self, data=None, path=None, root=None):
+        return self._verify_digest(self.orig_digest, data, path, root)
 
-    def verify_dest_digest(self, data=None, path=None):
-        return self._verify_digest(self.dest_digest, data, path)
+    def verify_dest_digest(self, data=None, path=None, root=None):
+        return self._verify_digest(self.dest_digest, data, path, root)
 
-    def patch(self, path=None, data=None, patcher=None):
+    def patch(self, path=None, data=None, patcher=None, root=None):
         if path is None:
-            path = self.target
-        if data is None:
+            path = self.target_path(root)
+        if data is None and not patcher.streams(self, path):
             if not os.path.exists(path):
                 data = ''
             elif os.path.exists(path):
@@ -160,28 +217,37 @@ class PDAREntry(object):
                     data = data_reader.read()
         patcher.apply_entry(self, path, data)
 
+    def pax_headers(self):
+        return {
+            ENTRY_HEADER_TYPE: unicode(self.type_code),
+            ENTRY_HEADER_TARGET: unicode(self.target),
+            ENTRY_HEADER_ORIG_DIGEST: unicode(self.orig_digest),
+            ENTRY_HEADER_DEST_DIGEST: unicode(self.dest_digest)}
+
     def pax_dump_info(self, tfile, buf):
         info = tarfile.TarInfo(
             name=os.path.join(
                 self.target, self.orig_digest))
-        info.pax_headers.update({
-                ENTRY_HEADER_TYPE: unicode(self.type_code),
-                ENTRY_HEADER_TARGET: unicode(self.target),
-                ENTRY_HEADER_ORIG_DIGEST: unicode(self.orig_digest),
-                ENTRY_HEADER_DEST_DIGEST: unicode(self.dest_digest)})
-        info.size = len(buf.buf)
+        info.pax_headers.update(self.pax_headers())
+        info.size = self.payload_size
         info.mode = self.mode
         return info
 
     def pax_dump(self, tfile):
-        buf = StringIO(self.payload)
-        buf.seek(0)
-        info = self.pax_dump_info(tfile, buf)
-        tfile.addfile(tarinfo=info, fileobj=buf)
+        buf = self.open_payload()
+        try:
+            info = self.pax_dump_info(tfile, buf)
+            tfile.addfile(tarinfo=info, fileobj=buf)
+        finally:
+            buf.close()
 
     @classmethod
     def pax_load(cls, tfile, tinfo):
-        headers = tinfo.pax_headers
+        return cls.from_headers(tinfo.pax_headers,
+                                payload=tfile.extractfile(tinfo).read())
+
+    @classmethod
+    def from_headers(cls, headers, payload='', **kwargs):
         header_args = dict((
                 key.replace('pdar_entry_', ''),
                 value) for key, value in  headers.iteritems())
@@ -189,12 +255,16 @@ class PDAREntry(object):
                 key.replace('pdar_', ''),
                 value) for key, value in header_args.iteritems())
         # pylint: disable=E1101
-        type_cls = cls.entry_class_map[headers[ENTRY_HEADER_TYPE]]
+        try:
+            type_cls = cls.entry_class_map[headers[ENTRY_HEADER_TYPE]]
+        except KeyError:
+            raise UnsupportedArchiveError(
+                "Unsupported entry type: '%s'"
+                % headers.get(ENTRY_HEADER_TYPE))
         # pylint: enable=E1101
+        header_args.update(kwargs)
         # pylint: disable=W0142
-        return type_cls(
-            payload=tfile.extractfile(tinfo).read(),
-            **header_args)
+        return type_cls(payload=payload, **header_args)
         # pylint: enable=W0142
 
     @classmethod
@@ -204,7 +274,7 @@ class PDAREntry(object):
     # pylint: disable=W0613
     @classmethod
     def create(cls, target, orig_target, dest_target, orig_path, dest_path,
-               hash_type=DEFAULT_HASH_TYPE):
+               hash_type=DEFAULT_HASH_TYPE, file_cache=None, **kwargs):
         return False
     # pylint: enable=W0613
 
@@ -227,21 +297,30 @@ class PDAREmptyEntry(PDAREntry):
     def payload(self):
         return ''
 
+    @property
+    def payload_size(self):
+        return 0
+
 
 class PDARDeleteEntry(PDAREmptyEntry):
 
     _type_code = 'delete'
 
-    def verify_dest_digest(self, data=None, path=None):
-        if data:
-            return False
-        return True
+    def verify_dest_digest(self, data=None, path=None, root=None):
+        if data is None:
+            # emptied files are removed once every entry is applied
+            if path is None:
+                path = self.target_path(root)
+            return not os.path.exists(path) or os.path.getsize(path) == 0
+        return not data
 
     @classmethod
     def create(cls, target, orig_target, dest_target, orig_path, dest_path,
-               hash_type=DEFAULT_HASH_TYPE):
-        with open(os.path.join(orig_path, orig_target), 'rb') as orig_reader:
-            orig_digest = cls._generate_digest(orig_reader.read(), hash_type)
+               hash_type=DEFAULT_HASH_TYPE, file_cache=None, **kwargs):
+        if file_cache is None:
+            file_cache = FileCache()
+        orig_digest = file_cache.digest(
+            os.path.join(orig_path, orig_target), hash_type)
         return cls(target, orig_digest=orig_digest, hash_type=hash_type)
 
 
@@ -259,27 +338,34 @@ class PDARSourceEntry(PDAREmptyEntry):
     def target_source(self):
         return self._target_source
 
-    def pax_dump_info(self, tfile, buf):
-        info = super(PDARSourceEntry, self).pax_dump_info(tfile, buf)
-        info.pax_headers.update({
-                ENTRY_HEADER_TARGET_SOURCE: self.target_source})
-        return info
+    def source_path(self, root=None):
+        if root:
+            return os.path.join(root, self.target_source)
+        return self.target_source
+
+    def pax_headers(self):
+        headers = super(PDARSourceEntry, self).pax_headers()
+        headers[ENTRY_HEADER_TARGET_SOURCE] = unicode(self.target_source)
+        return headers
 
-    def verify_orig_digest(self, data=None, path=None):
+    def verify_orig_digest(self, data=None, path=None, root=None):
         if data:
             return False
 
         if path is None:
-            path = self.target
+            path = self.target_path(root)
 
         return not os.path.exists(path) and \
-            self._verify_digest(self.dest_digest, path=self.target_source)
+            self._verify_digest(self.dest_digest,
+                                path=self.source_path(root))
 
     @classmethod
     def create(cls, target, orig_target, dest_target, orig_path, dest_path,
-               hash_type=DEFAULT_HASH_TYPE):
-        with open(os.path.join(orig_path, orig_target), 'rb') as orig_reader:
-            orig_digest = cls._generate_digest(orig_reader.read(), hash_type)
+               hash_type=DEFAULT_HASH_TYPE, file_cache=None, **kwargs):
+        if file_cache is None:
+            file_cache = FileCache()
+        orig_digest = file_cache.digest(
+            os.path.join(orig_path, orig_target), hash_type)
 
         return cls(target,
                    dest_digest=orig_digest,
@@ -301,22 +387,28 @@ class PDARNewEntry(PDAREntry):
 
     _type_code = 'new'
 
-    def verify_orig_digest(self, data=None, path=None):
+    def verify_orig_digest(self, data=None, path=None, root=None):
         if data:
             return False
 
         if path is None:
-            path = self.target
+            path = self.target_path(root)
 
         return not os.path.exists(path)
 
     @classmethod
     def create(cls, target, orig_target, dest_target, orig_path, dest_path,
-               hash_type=DEFAULT_HASH_TYPE):
+               hash_type=DEFAULT_HASH_TYPE, file_cache=None, **kwargs):
+        if file_cache is None:
+            file_cache = FileCache()
         dest_target_path = os.path.join(dest_path, dest_target)
-        with open(dest_target_path, 'rb') as dest_reader:
-            dest_data = dest_reader.read()
-            dest_digest = cls._generate_digest(dest_data, hash_type)
+        if kwargs.get('stream_payloads'):
+            # copied from `dest_path` when the entry is written
+            file_cache.release(dest_target_path)
+            dest_data = FilePayload(dest_target_path)
+        else:
+            dest_data = file_cache.read(dest_target_path, hash_type)
+        dest_digest = file_cache.digest(dest_target_path, hash_type)
         return cls(target,
                    dest_digest=dest_digest,
                    payload=dest_data,
@@ -330,12 +422,21 @@ class PDARDiffEntry(PDAREntry):
     def __init__(self, target, payload='', mode=DEFAULT_MODE,
                  orig_digest='', dest_digest='', orig_data=None,
                  dest_data=None, hash_type=DEFAULT_HASH_TYPE,
-                 **kwargs):
+                 delta_cache=None, cache_checked=False, **kwargs):
 
         if orig_data is not None or dest_data is not None:
-            orig_digest = self._generate_digest(orig_data, hash_type)
-            dest_digest = self._generate_digest(dest_data, hash_type)
-            payload = bsdiff4.diff(orig_data, dest_data)
+            if not orig_digest:
+                orig_digest = self._generate_digest(orig_data, hash_type)
+            if not dest_digest:
+                dest_digest = self._generate_digest(dest_data, hash_type)
+            payload = None
+            if delta_cache is not None and not cache_checked:
+                payload = delta_cache.get(orig_digest, dest_digest, hash_type)
+            if payload is None:
+                payload = bsdiff4.diff(orig_data, dest_data)
+                if delta_cache is not None:
+                    delta_cache.put(orig_digest, dest_digest, hash_type,
+                                    payload)
 
         super(PDARDiffEntry, self).__init__(
             target=target, payload=payload, mode=mode,
@@ -345,15 +446,195 @@ class PDARDiffEntry(PDAREntry):
 
     @classmethod
     def create(cls, target, orig_target, dest_target, orig_path, dest_path,
-               hash_type=DEFAULT_HASH_TYPE):
+               hash_type=DEFAULT_HASH_TYPE, file_cache=None, delta_cache=None,
+               replace_ratio=DEFAULT_REPLACE_RATIO, screen=None, **kwargs):
+        if file_cache is None:
+            file_cache = FileCache()
         orig = os.path.join(orig_path, orig_target)
         dest = os.path.join(dest_path, dest_target)
-        if not filecmp.cmp(orig, dest, False):
-            with open(orig, 'rb') as orig_reader:
-                with open(dest, 'rb') as dest_reader:
-                    return cls(
-                        target, orig_data=orig_reader.read(),
-                        dest_data=dest_reader.read(),
-                        mode=cls.read_mode(dest),
-                        hash_type=hash_type)
+        orig_digest = file_cache.cached_digest(orig, hash_type)
+        dest_digest = file_cache.cached_digest(dest, hash_type)
+        if orig_digest is not None and orig_digest == dest_digest:
+            file_cache.release(orig)
+            return None
+        # when both digests are known the delta is only looked up here
+        cache_checked = None not in (delta_cache, orig_digest, dest_digest)
+        if cache_checked:
+            payload = delta_cache.get(orig_digest, dest_digest, hash_type)
+            if payload is not None:
+                file_cache.release(orig)
+                return PDARReplaceEntry.unless_smaller(cls(
+                        target, payload=payload, orig_digest=orig_digest,
+                        dest_digest=dest_digest, mode=cls.read_mode(dest),
+                        hash_type=hash_type), dest, replace_ratio)
+
+        orig_data = file_cache.read(orig, hash_type)
+        dest_data = file_cache.read(dest, hash_type)
+        if orig_data != dest_data:
+            orig_digest = file_cache.digest(orig, hash_type)
+            dest_digest = file_cache.digest(dest, hash_type)
+            if screen is not None and screen.check(orig, dest, orig_data,
+                                                   dest_data):
+                return PDARReplaceEntry.from_file(
+                    target, dest, orig_digest, dest_digest, hash_type,
+                    dest_data)
+            return PDARReplaceEntry.unless_smaller(cls(
+                    target, orig_data=orig_data, dest_data=dest_data,
+                    orig_digest=orig_digest, dest_digest=dest_digest,
+                    mode=cls.read_mode(dest), hash_type=hash_type,
+                    delta_cache=delta_cache, cache_checked=cache_checked),
+                dest, replace_ratio, dest_data)
         return None
+
+
+class PDARBlockDiffEntry(PDAREntry):
+    '''Delta of a large file, as a bsdiff patch for each block of the
+    destination.  Blocks are created and applied one at a time, so memory
+    use depends on the block size rather than the size of the file.'''
+
+    _type_code = 'blockdiff'
+    streamed = True
+    extended = True
+
+    def iter_blocks(self):
+        '''Yield `(orig_offset, orig_size, patch)` for each block of the
+        destination, in order.'''
+        reader = self.open_payload()
+        try:
+            while True:
+                header = read_fully(reader, BLOCK_HEADER.size)
+                if not header:
+                    break
+                if len(header) < BLOCK_HEADER.size:
+                    raise PDArchiveFormatError(
+                        "truncated block header: %s" % self.target)
+                orig_offset, orig_size, patch_size = \
+                    BLOCK_HEADER.unpack(header)
+                patch = read_fully(reader, patch_size)
+                if len(patch) < patch_size:
+                    raise PDArchiveFormatError(
+                        "truncated block: %s" % self.target)
+                yield orig_offset, orig_size, patch
+        finally:
+            reader.close()
+
+    @classmethod
+    def diff_blocks(cls, orig, dest, block_size=DEFAULT_BLOCK_SIZE,
+                    limit=None):
+        '''Write the block records of `dest` to a temporary file, returning
+        it as a TemporaryPayload, or None as soon as they reach `limit`
+        bytes.'''
+        # each block is diffed against the original from half a block
+        # before to half a block after it, so nearby insertions and
+        # removals still match
+        margin = block_size / 2
+        orig_size = os.path.getsize(orig)
+        size = 0
+        handle, path = TemporaryPayload.mkstemp()
+        try:
+            with os.fdopen(handle, 'wb') as writer:
+                with open(orig, 'rb') as orig_reader:
+                    with open(dest, 'rb') as dest_reader:
+                        offset = 0
+                        data = dest_reader.read(block_size)
+                        while data:
+                            orig_offset = min(max(0, offset - margin),
+                                              orig_size)
+                            orig_reader.seek(orig_offset)
+                            region = orig_reader.read(block_size + 2 * margin)
+                            patch = bsdiff4.diff(region, data)
+                            writer.write(BLOCK_HEADER.pack(
+                                    orig_offset, len(region), len(patch)))
+                            writer.write(patch)
+                            size += BLOCK_HEADER.size + len(patch)
+                            if limit is not None and size >= limit:
+                                break
+                            offset += len(data)
+                            data = dest_reader.read(block_size)
+        except:
+            os.unlink(path)
+            raise
+        if limit is not None and size >= limit:
+            os.unlink(path)
+            return None
+        return TemporaryPayload(path, size=size)
+
+    @classmethod
+    def create(cls, target, orig_target, dest_target, orig_path, dest_path,
+               hash_type=DEFAULT_HASH_TYPE, file_cache=None, delta_cache=None,
+               block_size=DEFAULT_BLOCK_SIZE,
+               replace_ratio=DEFAULT_REPLACE_RATIO, screen=None, **kwargs):
+        if file_cache is None:
+            file_cache = FileCache()
+        orig = os.path.join(orig_path, orig_target)
+        dest = os.path.join(dest_path, dest_target)
+        orig_digest = file_cache.digest(orig, hash_type)
+        dest_digest = file_cache.digest(dest, hash_type)
+        if orig_digest == dest_digest:
+            return None
+        params = (cls.type_code, block_size)
+        dest_size = os.path.getsize(dest)
+        payload = None
+        if delta_cache is not None:
+            cached = delta_cache.get_path(orig_digest, dest_digest,
+                                          hash_type, params)
+            if cached is not None:
+                # copied, since the cache may be pruned before it is saved
+                payload = TemporaryPayload.copy(cached)
+        if payload is None:
+            if screen is not None and screen.check(orig, dest):
+                return PDARReplaceEntry.from_file(
+                    target, dest, orig_digest, dest_digest, hash_type)
+            # diffing stops once the delta is too large to be kept
+            limit = None
+            if replace_ratio:
+                limit = dest_size * replace_ratio
+            payload = cls.diff_blocks(orig, dest, block_size, limit)
+            if payload is None:
+                return PDARReplaceEntry.from_file(
+                    target, dest, orig_digest, dest_digest, hash_type)
+            if delta_cache is not None:
+                delta_cache.put_file(orig_digest, dest_digest, hash_type,
+                                     payload.path, params)
+        return PDARReplaceEntry.unless_smaller(cls(
+                target, payload=payload, orig_digest=orig_digest,
+                dest_digest=dest_digest, mode=cls.read_mode(dest),
+                hash_type=hash_type), dest, replace_ratio)
+
+
+class PDARReplaceEntry(PDAREntry):
+    '''Whole contents of a changed file, used when a delta would not be
+    smaller.  The original is still verified before it is replaced.'''
+
+    _type_code = 'replace'
+    extended = True
+
+    @classmethod
+    def replaces(cls, delta_size, dest_size, ratio=DEFAULT_REPLACE_RATIO):
+        '''Whether a file of `dest_size` bytes is stored whole rather than
+        as a delta of `delta_size` bytes.  A `ratio` of 0 always keeps the
+        delta.'''
+        return bool(ratio) and delta_size >= dest_size * ratio
+
+    @classmethod
+    def from_file(cls, target, dest, orig_digest, dest_digest,
+                  hash_type=DEFAULT_HASH_TYPE, payload=None):
+        # unless already read as `payload`, copied from `dest` when the
+        # entry is written
+        if payload is None:
+            payload = FilePayload(dest)
+        return cls(target, payload=payload,
+                   orig_digest=orig_digest, dest_digest=dest_digest,
+                   mode=cls.read_mode(dest), hash_type=hash_type)
+
+    @classmethod
+    def unless_smaller(cls, entry, dest, ratio=DEFAULT_REPLACE_RATIO,
+                       payload=None):
+        '''`entry`, or an entry replacing `dest` when the delta of `entry`
+        is not smaller than `ratio` of the file.'''
+        if not cls.replaces(entry.payload_size, os.path.getsize(dest),
+                            ratio):
+            return entry
+        entry.discard_payload()
+        return cls.from_file(entry.target, dest, entry.orig_digest,
+                             entry.dest_digest, entry.hash_type, payload)
@@ -0,0 +1,187 @@
+# This file is part of pdar.
+#
+# Copyright 2011 Jason Penney
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Write-ahead journal of an archive being applied.
+
+The journal is a directory in the root of the tree being patched.  It
+holds a log with one JSON record per line, and the backups of files that
+were modified or removed.  Each record is flushed to disk before the
+change it describes is made, and backups are flushed before their
+record, so an interrupted apply can be resumed or rolled back by the
+next run::
+
+    begin    archive id and planned targets
+    backup   target is about to change, and where its original is kept
+    restored target was put back from its backup
+    done     every entry for target has been applied
+    removed  file is about to be removed, and where it is kept
+    commit   the archive was applied, backups are no longer needed
+'''
+
+from collections import namedtuple, OrderedDict
+from tempfile import mkstemp
+import json
+import logging
+import os
+import shutil
+import threading
+
+__all__ = ['Journal', 'JOURNAL_NAME']
+
+JOURNAL_NAME = '.pdar-journal'
+JOURNAL_LOG = 'log'
+
+JournalState = namedtuple(
+    'JournalState', 'archive_id targets backups done removed committed')
+
+
+def _fsync_path(path):
+    if os.name == 'nt' and os.path.isdir(path):
+        # directories can not be opened, or synced, on Windows
+        return
+    handle = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(handle)
+    finally:
+        os.close(handle)
+
+
+class Journal(object):
+
+    def __init__(self, root, name=JOURNAL_NAME):
+        self._root = root
+        self._path = os.path.join(root, name)
+        self._log = None
+        self._lock = threading.Lock()
+
+    @property
+    def root(self):
+        return self._root
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def log_path(self):
+        return os.path.join(self.path, JOURNAL_LOG)
+
+    def exists(self):
+        return os.path.exists(self.log_path)
+
+    def _relpath(self, path):
+        if path:
+            return os.path.relpath(path, self.root)
+        return None
+
+    def _abspath(self, path):
+        if path:
+            return os.path.join(self.root, path)
+        return None
+
+    def _makedirs(self):
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+    def _write(self, **record):
+        line = json.dumps(record) + '\n'
+        with self._lock:
+            if self._log is None:
+                self._makedirs()
+                self._log = open(self.log_path, 'ab')
+                _fsync_path(self.path)
+                _fsync_path(self.root)
+            self._log.write(line)
+            self._log.flush()
+            os.fsync(self._log.fileno())
+
+    def new_backup(self):
+        '''Return an unused path in the journal directory.'''
+        self._makedirs()
+        handle, path = mkstemp(prefix='backup.', dir=self.path)
+        os.close(handle)
+        os.unlink(path)
+        return path
+
+    def sync(self, backup):
+        '''Flush `backup`, and the directory holding it, to disk.  Called
+        before the record of the backup is written.'''
+        _fsync_path(backup)
+        _fsync_path(os.path.dirname(backup))
+
+    def begin(self, archive_id, targets):
+        self._write(op='begin', archive=archive_id, targets=list(targets))
+
+    def backup(self, target, backup):
+        self._write(op='backup', target=target,
+                    backup=self._relpath(backup))
+
+    def restored(self, target):
+        self._write(op='restored', target=target)
+
+    def done(self, target, **info):
+        self._write(op='done', target=target, **info)
+
+    def removed(self, path, backup):
+        self._write(op='removed', path=self._relpath(path),
+                    backup=self._relpath(backup))
+
+    def commit(self):
+        self._write(op='commit')
+
+    def load(self):
+        archive_id = None
+        targets = []
+        backups = OrderedDict()
+        done = {}
+        removed = []
+        committed = False
+        with open(self.log_path, 'rb') as reader:
+            for line in reader:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # the last record may have been cut short
+                    logging.debug("ignoring incomplete journal record")
+                    continue
+                op = record.get('op')
+                if op == 'begin':
+                    archive_id = record['archive']
+                    targets = record.get('targets', [])
+                elif op == 'backup':
+                    if record['target'] not in backups:
+                        backups[record['target']] = self._abspath(
+                            record['backup'])
+                elif op == 'restored':
+                    backups.pop(record['target'], None)
+                    done.pop(record['target'], None)
+                elif op == 'done':
+                    done[record['target']] = record
+                elif op == 'removed':
+                    removed.append((self._abspath(record['path']),
+                                    self._abspath(record['backup'])))
+                elif op == 'commit':
+                    committed = True
+        return JournalState(archive_id, targets, backups, done, removed,
+                            committed)
+
+    def close(self):
+        '''Remove the journal, along with any backups kept in it.'''
+        with self._lock:
+            if self._log is not None:
+                self._log.close()
+                self._log = None
+        shutil.rmtree(self.path, True)
@@ -0,0 +1,292 @@
+# This file is part of pdar.
+#
+# Copyright 2011 Jason Penney
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''On-disk layouts of pdar archives.
+
+``tar`` archives are a single compressed pax stream, and have to be read
+from start to finish.  ``indexed`` archives compress each payload
+separately and end with an index of every entry, so they can be listed
+and read one entry at a time::
+
+    PDAR_INDEXED_ID (or PDAR_EXTENDED_INDEXED_ID)
+    payload 0 .. payload N  (each compressed independently)
+    index                   (gzip compressed JSON)
+    trailer                 (index offset, index size, INDEX_MAGIC)
+
+Archives holding entry types that earlier releases can not apply, such
+as ``blockdiff`` and ``replace``, are identified by the next format
+number, so those releases reject them as an unsupported version.
+'''
+
+from pdar import PDAR_VERSION
+from pdar.compression import GzipCodec, StoreCodec
+from pdar.entry import PDAREntry, ENTRY_HEADER_TARGET
+from pdar.errors import PDARError, PDArchiveFormatError
+from pdar.payload import CompressedPayload, LimitedReader, UnloadedPayload
+from pkg_resources import parse_version
+import json
+import struct
+import tarfile
+
+__all__ = ['PDAR_MAGIC', 'PDAR_ID', 'PDAR_INDEXED_ID', 'PDAR_EXTENDED_ID',
+           'PDAR_EXTENDED_INDEXED_ID', 'TarArchiveWriter',
+           'IndexedArchiveWriter', 'IndexedArchiveReader']
+
+PDAR_MAGIC = 'PDAR'
+PDAR_FORMAT = int(parse_version(PDAR_VERSION)[0])
+PDAR_EXTENDED_FORMAT = PDAR_FORMAT + 1
+
+
+def format_id(extended=False, indexed=False):
+    return '%s%03d%c' % (
+        PDAR_MAGIC, extended and PDAR_EXTENDED_FORMAT or PDAR_FORMAT,
+        indexed and 1 or 0)
+
+
+PDAR_ID = format_id()
+PDAR_INDEXED_ID = format_id(indexed=True)
+PDAR_EXTENDED_ID = format_id(extended=True)
+PDAR_EXTENDED_INDEXED_ID = format_id(extended=True, indexed=True)
+
+INDEX_MAGIC = 'PDARIDX\0'
+INDEX_TRAILER = struct.Struct('>QQ8s')
+INDEX_VERSION = 1
+
+# payloads that do not compress below this ratio of their original size,
+# judged by their first `ENTRY_SAMPLE_SIZE` bytes, are stored uncompressed
+ENTRY_SAMPLE_SIZE = 64 * 1024
+ENTRY_MIN_RATIO = 0.95
+
+COPY_CHUNK_SIZE = ENTRY_SAMPLE_SIZE
+
+
+class BaseArchiveWriter(object):
+    '''Only `extended` archives can hold entries of types earlier releases
+    can not apply.  When none are added, the file ID is rewritten on close
+    if `fileobj` is seekable.'''
+
+    indexed = False
+
+    def __init__(self, fileobj, headers, codec, level=None, extended=False):
+        codec.check_level(level)
+        self._fileobj = fileobj
+        self._headers = headers
+        self._codec = codec
+        self._level = level
+        self._extended = extended
+        self._added_extended = False
+        try:
+            self._id_offset = fileobj.tell()
+        except (AttributeError, IOError):
+            self._id_offset = None
+        fileobj.write(self.file_id)
+
+    @property
+    def file_id(self):
+        return format_id(self.extended, self.indexed)
+
+    @property
+    def extended(self):
+        return self._extended
+
+    @property
+    def fileobj(self):
+        return self._fileobj
+
+    @property
+    def headers(self):
+        return self._headers
+
+    @property
+    def codec(self):
+        return self._codec
+
+    @property
+    def level(self):
+        return self._level
+
+    def add_entry(self, entry):
+        raise NotImplementedError()
+
+    def _check_entry(self, entry):
+        if entry.extended:
+            if not self.extended:
+                raise PDARError(
+                    "'%s' entries can not be written to format %d archives"
+                    % (entry.type_code, PDAR_FORMAT))
+            self._added_extended = True
+
+    def close(self):
+        if self.extended and not self._added_extended and \
+                self._id_offset is not None:
+            # readable by earlier releases after all
+            end = self.fileobj.tell()
+            self.fileobj.seek(self._id_offset)
+            self.fileobj.write(format_id(False, self.indexed))
+            self.fileobj.seek(end)
+        self.fileobj.flush()
+
+
+class TarArchiveWriter(BaseArchiveWriter):
+
+    def __init__(self, fileobj, headers, codec, level=None, extended=False):
+        super(TarArchiveWriter, self).__init__(fileobj, headers, codec, level,
+                                               extended)
+        # compressed directly into `fileobj` as the tar stream is written
+        self._writer = codec.open_writer(fileobj, level)
+        self._tfile = tarfile.open(
+            mode='w|', fileobj=self._writer, format=tarfile.PAX_FORMAT,
+            pax_headers=headers)
+
+    def add_entry(self, entry):
+        self._check_entry(entry)
+        entry.pax_dump(self._tfile)
+
+    def close(self):
+        self._tfile.close()
+        self._writer.close()
+        super(TarArchiveWriter, self).close()
+
+
+class IndexedArchiveWriter(BaseArchiveWriter):
+
+    indexed = True
+
+    def __init__(self, fileobj, headers, codec, level=None, extended=False):
+        super(IndexedArchiveWriter, self).__init__(
+            fileobj, headers, codec, level, extended)
+        # offsets in the index are from the start of `fileobj`, which may
+        # hold other data before the archive
+        self._writer = _OffsetWriter(
+            fileobj, (self._id_offset or 0) + len(self.file_id))
+        self._records = []
+
+    def _entry_codec(self, sample):
+        if not sample:
+            return StoreCodec()
+        if len(self.codec.compress(sample, self.level)) >= \
+                len(sample) * ENTRY_MIN_RATIO:
+            return StoreCodec()
+        return self.codec
+
+    def add_entry(self, entry):
+        self._check_entry(entry)
+        reader = entry.open_payload()
+        try:
+            chunk = reader.read(COPY_CHUNK_SIZE)
+            codec = self._entry_codec(chunk)
+            start = self._writer.offset
+            writer = codec.open_writer(self._writer, self.level)
+            size = 0
+            while chunk:
+                writer.write(chunk)
+                size += len(chunk)
+                chunk = reader.read(COPY_CHUNK_SIZE)
+            writer.close()
+        finally:
+            reader.close()
+        self._records.append({
+                'headers': entry.pax_headers(),
+                'mode': entry.mode,
+                'codec': codec.name,
+                'offset': start,
+                'size': size,
+                'stored_size': self._writer.offset - start})
+
+    def close(self):
+        index = GzipCodec().compress(json.dumps({
+                    'version': INDEX_VERSION,
+                    'headers': self.headers,
+                    'entries': self._records}))
+        index_offset = self._writer.offset
+        self._writer.write(index)
+        self._writer.write(INDEX_TRAILER.pack(
+                index_offset, len(index), INDEX_MAGIC))
+        super(IndexedArchiveWriter, self).close()
+
+
+class IndexedArchiveReader(object):
+
+    def __init__(self, fileobj, codecs, path=None):
+        self._fileobj = fileobj
+        self._codecs = codecs
+        self._path = path
+        fileobj.seek(-INDEX_TRAILER.size, 2)
+        index_offset, index_size, magic = INDEX_TRAILER.unpack(
+            fileobj.read(INDEX_TRAILER.size))
+        if magic != INDEX_MAGIC:
+            raise PDArchiveFormatError("Missing pdar index")
+        fileobj.seek(index_offset)
+        index = json.loads(GzipCodec().decompress(fileobj.read(index_size)))
+        if index.get('version') != INDEX_VERSION:
+            raise PDArchiveFormatError(
+                "Unsupported pdar index version '%s'" % index.get('version'))
+        self._headers = index['headers']
+        self._records = index['entries']
+
+    @property
+    def headers(self):
+        return self._headers
+
+    @property
+    def records(self):
+        return self._records
+
+    def open_payload(self, record):
+        self._fileobj.seek(record['offset'])
+        return self._codecs(record['codec']).open_reader(
+            LimitedReader(self._fileobj, record['stored_size']))
+
+    def read_payload(self, record):
+        if not record['size']:
+            return ''
+        return self.open_payload(record).read()
+
+    def find_record(self, target):
+        for record in self.records:
+            if record['headers'][ENTRY_HEADER_TARGET] == target:
+                return record
+        return None
+
+    def load_entry(self, record, payloads=True):
+        # payloads are read from `path` when needed if it is available
+        payload = ''
+        if record['size']:
+            if not payloads:
+                payload = UnloadedPayload(record['size'])
+            elif self._path is None:
+                payload = self.read_payload(record)
+            else:
+                payload = CompressedPayload(
+                    self._path, record['offset'], record['stored_size'],
+                    record['size'], self._codecs(record['codec']))
+        return PDAREntry.from_headers(
+            record['headers'], payload=payload, mode=record['mode'])
+
+
+class _OffsetWriter(object):
+
+    def __init__(self, fileobj, offset=0):
+        self._fileobj = fileobj
+        self._offset = offset
+
+    @property
+    def offset(self):
+        return self._offset
+
+    def write(self, data):
+        self._fileobj.write(data)
+        self._offset += len(data)
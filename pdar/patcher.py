@@ -14,18 +14,38 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from multiprocessing.pool import ThreadPool
+from pdar.bspatch import patch_stream
+from pdar.cache import mtime_ns
 from pdar.errors import *
+from pdar.journal import Journal
+from pdar.stats import timed, timed_phase
 from tempfile import mkstemp
 import bsdiff4
 import errno
+import hashlib
 import logging
+import multiprocessing
 import os
 import shutil
 import stat
+import threading
+import time
 
 __all__ = [
     'PDArchivePatcher', 'DEFAULT_PATCHER_TYPE']
 
+# files created next to targets when patching with `atomic`
+TEMP_PREFIX = '.pdar-tmp.'
+BACKUP_PREFIX = '.pdar-backup.'
+# entries of files larger than this are applied without reading them
+# into memory
+DEFAULT_STREAM_THRESHOLD = 64 * 1024 * 1024
+STREAM_CHUNK_SIZE = 1024 * 1024
+# deltas are only sent to worker processes below this size, larger
+# arguments can not be pickled
+MAX_PROCESS_PATCH_SIZE = 1024 * 1024 * 1024
+
 
 class BaseErrorHandler(object):
 
@@ -38,12 +58,35 @@ class BaseErrorHandler(object):
         raise err
 
 
+class _HashingWriter(object):
+
+    def __init__(self, writer, hash_type):
+        self._writer = writer
+        self._hash = hashlib.new(hash_type)
+        self._size = 0
+
+    @property
+    def size(self):
+        return self._size
+
+    def write(self, data):
+        self._writer.write(data)
+        self._hash.update(data)
+        self._size += len(data)
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+
 class BasePatcher(object):  # pylint: disable=R0922
 
-    def __init__(self, archive, path, error_handler=None):
+    def __init__(self, archive, path, error_handler=None, observer=None):
         self._archive = archive
         self._path = path
         self._error_handler = error_handler
+        if observer is None:
+            observer = getattr(archive, 'observer', None)
+        self._observer = observer
 
     @property
     def archive(self):
@@ -53,6 +96,23 @@ class BasePatcher(object):  # pylint: disable=R0922
     def path(self):
         return self._path
 
+    @property
+    def observer(self):
+        return self._observer
+
+    @property
+    def root(self):
+        '''Absolute path that entry targets are relative to.'''
+        return os.path.abspath(self.path or os.curdir)
+
+    def resolve(self, target):
+        return os.path.join(self.root, target)
+
+    def streams(self, entry, path):
+        '''Whether `entry` is applied from the file at `path`, rather than
+        from its contents read into memory.'''
+        return entry.streamed
+
     @property
     def error_handler(self):
         if self._error_handler is None:
@@ -99,15 +159,7 @@ class PDArchiveHandler(BaseErrorHandler):
             "Applying archive failed: %s", str(err))
         logging.warn(
             "Attempting to back out changes")
-        for target, backup in patcher.backups.iteritems():
-            target = os.path.join(patcher.path, target)
-            if backup:
-                logging.debug("restoring '%s'" % target)
-                shutil.copy(backup, target)
-            else:
-                # newly created file
-                logging.debug("removing newly created file: '%s'" % target)
-                os.unlink(target)
+        patcher.rollback()
         logging.info("Changes successfully backed out")
         raise err
 
@@ -125,12 +177,15 @@ class PDArchiveHandler(BaseErrorHandler):
 
 class PDArchivePatcher(BasePatcher):
 
-    def __init__(self, archive, path, error_handler=None):
+    def __init__(self, archive, path, error_handler=None, workers=None,
+                 atomic=False, journal=False, verify=False, preflight=False,
+                 observer=None, stream_threshold=DEFAULT_STREAM_THRESHOLD,
+                 patch_processes=None):
         if error_handler is None:
             error_handler = PDArchiveHandler()
 
         super(PDArchivePatcher, self).__init__(
-            archive, path, error_handler)
+            archive, path, error_handler, observer)
 
         targets = {}
         for entry in self.archive.patches:
@@ -139,11 +194,78 @@ class PDArchivePatcher(BasePatcher):
         self._targets = dict(targets)
         self._backups = {}
         self._to_unlink = []
+        self._removed = []
+        self._done = {}
+        if workers == 0:
+            workers = multiprocessing.cpu_count()
+        self._workers = workers
+        if patch_processes == 0:
+            patch_processes = multiprocessing.cpu_count()
+        self._patch_processes = patch_processes
+        self._atomic = atomic
+        self._journal = Journal(self.root)
+        self._use_journal = journal
+        self._journal_started = False
+        self._verify = verify
+        self._use_preflight = preflight
+        self._stream_threshold = stream_threshold
+        self._lock = threading.Lock()
+        self._aborted = threading.Event()
+        self._patch_pool = None
 
     @property
     def targets(self):
         return self._targets
 
+    @property
+    def workers(self):
+        return self._workers
+
+    @property
+    def patch_processes(self):
+        '''Number of worker processes deltas are applied in, rather than
+        in the threads applying entries.  The processes are forked, which
+        can deadlock when other threads of the calling process hold locks,
+        so they are only used when requested.'''
+        return self._patch_processes
+
+    @property
+    def atomic(self):
+        return self._atomic
+
+    @property
+    def journal(self):
+        return self._journal
+
+    @property
+    def use_journal(self):
+        return self._use_journal
+
+    @property
+    def stream_threshold(self):
+        return self._stream_threshold
+
+    @property
+    def use_preflight(self):
+        return self._use_preflight
+
+    @property
+    def verify(self):
+        '''Verify the digests of targets a resumed apply found complete,
+        rather than only checking their size and modification time.'''
+        return self._verify
+
+    @property
+    def archive_id(self):
+        '''Digest identifying the entries of the archive.'''
+        digest = hashlib.sha1()
+        for entry in sorted(self.archive.patches,
+                            key=lambda entry: entry.target):
+            digest.update('\0'.join([
+                        entry.type_code, entry.target, entry.orig_digest,
+                        entry.dest_digest]).encode('utf-8') + '\n')
+        return digest.hexdigest()
+
     @property
     def backups(self):
         return self._backups
@@ -152,119 +274,632 @@ class PDArchivePatcher(BasePatcher):
     def to_unlink(self):
         return self._to_unlink
 
-    def _do_apply_archive(self):
-        orig_path = os.getcwd()
+    def plan(self):
+        '''Split targets into stages that can each be applied in parallel.
+
+        A target is only overwritten in a stage after every copy or move
+        that reads it as a source.  Deleted files are unlinked once all
+        stages are complete.'''
+        readers = {}
+        for target, entries in self.targets.iteritems():
+            for entry in entries:
+                source = getattr(entry, 'target_source', None)
+                if source and source != target:
+                    readers.setdefault(source, set()).add(target)
+
+        stages = []
+        remaining = set(self.targets)
+        while remaining:
+            stage = sorted(
+                target for target in remaining
+                if not readers.get(target, set()) & remaining)
+            if not stage:
+                raise PDArchiveFormatError(
+                    "circular dependency between entries: %s"
+                    % ', '.join(sorted(remaining)))
+            stages.append(stage)
+            remaining.difference_update(stage)
+        return stages
+
+    def _make_dest_dirs(self):
+        parents = set()
+        for target, entries in self.targets.iteritems():
+            if any(entry.type_code != 'delete' for entry in entries):
+                parents.add(os.path.dirname(self.resolve(target)))
+        for parent in sorted(parents):
+            if not os.path.exists(parent):
+                logging.debug("creating directory: %s", parent)
+                os.makedirs(parent)
+
+    def _checkpoint(self, target):
+        # enough to tell whether the target has changed since it was
+        # patched without reading it
+        info = {'dest_digest': self.targets[target][-1].dest_digest,
+                'size': None, 'mtime_ns': None}
         try:
-            if self.path:
-                os.chdir(self.path)
-            for target, entries in self.targets.iteritems():
-                for entry in entries:
-                    entry.patch(patcher=self)
-
-            for target in self.to_unlink:
-                os.unlink(target)
-        finally:
-            os.chdir(orig_path)
-
+            stat_result = os.stat(self.resolve(target))
+        except OSError:
+            return info
+        info.update(size=stat_result.st_size,
+                    mtime_ns=mtime_ns(stat_result))
+        return info
+
+    def _is_complete(self, target):
+        record = self._done.get(target)
+        if record is None or self.verify:
+            return False
+        checkpoint = self._checkpoint(target)
+        return all(record.get(key) == checkpoint[key]
+                   for key in ('dest_digest', 'size', 'mtime_ns'))
+
+    def _apply_target(self, target):
+        if self._is_complete(target):
+            logging.info("already applied: %s", target)
+            for entry in self.targets[target]:
+                self._add_removals(entry)
+            return
+        root = self.root
+        observer = self.observer
+        for entry in self.targets[target]:
+            if self._aborted.is_set():
+                return
+            start = time.time()
+            try:
+                entry.patch(patcher=self, root=root)
+            except:
+                self._aborted.set()
+                raise
+            if observer is not None:
+                observer.entry_end('apply', entry, time.time() - start)
+        checkpoint = self._checkpoint(target)
+        self._done[target] = checkpoint
+        if self.use_journal:
+            self.journal.done(target, **checkpoint)
+
+    def _add_removals(self, entry):
+        # files removed by applied entries may still be in place
+        with self._lock:
+            if entry.type_code == 'delete':
+                self.to_unlink.append(entry.target_path(self.root))
+            elif entry.type_code == 'move':
+                self.to_unlink.append(entry.source_path(self.root))
+
+    def _add_backup(self, target, backup):
+        if backup and self.use_journal:
+            with timed(self.observer, 'sync'):
+                self.journal.sync(backup)
+        with self._lock:
+            if target in self.backups:
+                return False
+            if self.use_journal:
+                self.journal.backup(target, backup)
+            self.backups[target] = backup
+        return True
+
+    def restore_backup(self, path, backup):
+        if hasattr(os.path, 'samefile') and os.path.exists(path) and \
+                os.path.samefile(backup, path):
+            # hard link to a target that was never replaced, renaming it
+            # over the target would leave both names in place
+            os.unlink(backup)
+            return
+        if os.name == 'nt' and os.path.exists(path):
+            os.unlink(path)
+        try:
+            os.rename(backup, path)
+        except OSError:
+            # backup is on another file system
+            shutil.copy(backup, path)
+            os.unlink(backup)
+
+    def _restore_target(self, target, backup):
+        path = self.resolve(target)
+        if backup:
+            if os.path.exists(backup):
+                logging.debug("restoring '%s'" % path)
+                self.restore_backup(path, backup)
+        elif os.path.exists(path):
+            # newly created file
+            logging.debug("removing newly created file: '%s'" % path)
+            os.unlink(path)
+
+    def _restore_removed(self, removed):
+        for path, backup in reversed(removed):
+            if backup and os.path.exists(backup):
+                logging.debug("restoring removed file '%s'" % path)
+                self.restore_backup(path, backup)
+
+    def _discard_backups(self, backups):
         logging.debug('cleaning up unused backup files')
-        for dummy, path in self.backups.iteritems():
+        for dummy, path in backups.iteritems():
             if path:
                 try:
                     os.unlink(path)
-                except IOError:
+                except OSError:
                     pass
 
-    def _do_apply_entry(self, entry, path, data):
-        if not entry.verify_orig_digest(data):
-            if entry.verify_dest_digest(data):
-                logging.info(
-                    "patch already applied: %s", entry.target)
-                return
+    def _sweep_stray_files(self, targets, keep=()):
+        # temporary files and backups of an interrupted atomic apply are
+        # created next to their targets, some before they are journaled
+        keep = set(keep)
+        for parent in sorted(set(os.path.dirname(self.resolve(target))
+                                 for target in targets)):
+            try:
+                names = os.listdir(parent)
+            except OSError:
+                continue
+            for name in names:
+                path = os.path.join(parent, name)
+                if name.startswith((TEMP_PREFIX, BACKUP_PREFIX)) and \
+                        path not in keep:
+                    logging.debug("removing stray file: '%s'" % path)
+                    os.unlink(path)
+
+    def rollback(self):
+        '''Back out every change made by this patcher.'''
+        self._restore_removed(self._removed)
+        for target, backup in self.backups.iteritems():
+            self._restore_target(target, backup)
+        self._removed = []
+        self._backups = {}
+        self._done = {}
+        if self._journal_started:
+            self.journal.close()
+            self._journal_started = False
+
+    def rollback_journal(self):
+        '''Back out the interrupted apply recorded in the journal.'''
+        if not self.journal.exists():
+            logging.info("no journal found in '%s'", self.root)
+            return
+        state = self.journal.load()
+        if state.committed:
+            self._discard_backups(state.backups)
+        else:
+            logging.warn("rolling back interrupted apply recorded in '%s'",
+                         self.journal.path)
+            self._restore_removed(state.removed)
+            for target, backup in state.backups.iteritems():
+                self._restore_target(target, backup)
+        self._sweep_stray_files(state.targets)
+        self.journal.close()
+
+    def _resume(self):
+        state = self.journal.load()
+        if state.committed:
+            # interrupted while cleaning up
+            self._discard_backups(state.backups)
+            self._sweep_stray_files(state.targets)
+            self.journal.close()
+            return
+        if state.archive_id != self.archive_id:
+            raise PDARError(
+                "'%s' records an interrupted apply of a different archive, "
+                "it must be rolled back first" % self.journal.path)
+
+        logging.warn("resuming interrupted apply recorded in '%s'",
+                     self.journal.path)
+        self._use_journal = True
+        self._journal_started = True
+        for target, backup in state.backups.iteritems():
+            if target in state.done:
+                self.backups[target] = backup
+            else:
+                # interrupted part way through this target
+                self._restore_target(target, backup)
+                self.journal.restored(target)
+        self._sweep_stray_files(state.targets, self.backups.values())
+        self._done = dict(state.done)
+        self._removed = list(state.removed)
+
+    def _remove_files(self):
+        for path in self.to_unlink:
+            if not os.path.exists(path):
+                # removed before an apply was interrupted
+                continue
+            if self.use_journal:
+                backup = self.journal.new_backup()
+                self.journal.removed(path, backup)
+                self._removed.append((path, backup))
+                os.rename(path, backup)
+                self.journal.sync(backup)
             else:
+                os.unlink(path)
+
+    def _map_stages(self, func, stages, workers=None):
+        workers = min(workers or self.workers or 1,
+                      max(len(stage) for stage in stages))
+        if workers < 2:
+            return [func(target) for stage in stages for target in stage]
+
+        logging.debug("using %d threads" % workers)
+        results = []
+        pool = ThreadPool(workers)
+        try:
+            for stage in stages:
+                results.extend(pool.map(func, stage, 1))
+        finally:
+            # let running entries finish before anything is backed out
+            pool.close()
+            pool.join()
+        return results
+
+    def _start_patch_pool(self):
+        # bsdiff4 holds the GIL while it patches, so deltas can be applied
+        # in worker processes while threads keep the backups and journal.
+        # Started before the patcher starts any thread, since the pool forks
+        if not self.patch_processes:
+            return
+        diffs = len([entry for entry in self.archive.patches
+                     if entry.type_code in ('diff', 'blockdiff')])
+        processes = min(self.patch_processes, diffs)
+        if processes:
+            logging.debug("using %d patch processes" % processes)
+            self._patch_pool = multiprocessing.Pool(processes)
+
+    def _stop_patch_pool(self, terminate=False):
+        pool, self._patch_pool = self._patch_pool, None
+        if pool is None:
+            return
+        if terminate:
+            pool.terminate()
+        else:
+            pool.close()
+        pool.join()
+
+    def _patch(self, data, payload):
+        pool = self._patch_pool
+        with timed(self.observer, 'patch'):
+            if pool is None or \
+                    len(data) + len(payload) > MAX_PROCESS_PATCH_SIZE:
+                return bsdiff4.patch(data, payload)
+            return pool.apply(bsdiff4.patch, (data, payload))
+
+    def _check_target(self, target):
+        if self._is_complete(target):
+            return None
+        # later entries for the same target depend on the earlier ones
+        entry = self.targets[target][0]
+        root = self.root
+        path = entry.target_path(root)
+        if os.path.exists(path):
+            args = {'path': path, 'root': root}
+        else:
+            args = {'data': '', 'path': path, 'root': root}
+        if entry.verify_orig_digest(**args) or \
+                entry.verify_dest_digest(**args):
+            return None
+        return target
+
+    def _audit_entry(self, entry):
+        root = self.root
+        path = entry.target_path(root)
+        if entry.type_code == 'delete':
+            return not os.path.exists(path)
+        if not os.path.exists(path):
+            return False
+        if entry.type_code == 'move' and \
+                os.path.exists(entry.source_path(root)):
+            return False
+        return entry.verify_dest_digest(path=path, root=root)
+
+    def audit(self):
+        '''Check every entry against the tree without changing anything,
+        returning `(entry, passed)` pairs.  Targets pass when they match
+        their patched digest, or no longer exist for deleted files.  Moves
+        also fail while their source is still in place.  Uses one thread
+        per CPU unless `workers` was given.'''
+        entries = sorted(self.archive.patches, key=lambda entry: entry.target)
+        if not entries:
+            return []
+        with timed_phase(self.observer, 'audit'):
+            return zip(entries, self._map_stages(
+                    self._audit_entry, [entries],
+                    self.workers or multiprocessing.cpu_count()))
+
+    def preflight(self):
+        '''Check every target against the digests in the archive without
+        changing anything, returning the targets that do not contain the
+        expected original (or already patched) data.  Uses one thread per
+        CPU unless `workers` was given.'''
+        if not self.targets:
+            return []
+        logging.debug("verifying original files")
+        with timed_phase(self.observer, 'preflight'):
+            return [target for target in self._map_stages(
+                    self._check_target, [sorted(self.targets)],
+                    self.workers or multiprocessing.cpu_count())
+                    if target is not None]
+
+    def _do_apply_archive(self):
+        # all paths are resolved against `root`, the current directory is
+        # never changed so patchers can run in parallel threads
+        observer = self.observer
+        if self.journal.exists():
+            with timed_phase(observer, 'resume'):
+                self._resume()
+        with timed_phase(observer, 'plan'):
+            stages = self.plan()
+        if self.use_preflight:
+            mismatches = self.preflight()
+            if mismatches:
                 raise SourceFileError(
-                    "original file does not contain expected data: %s"
-                    % entry.target)
+                    "original files do not contain expected data: %s"
+                    % ', '.join(mismatches))
+        if self.use_journal:
+            self.journal.begin(self.archive_id, sorted(self.targets))
+            self._journal_started = True
+        with timed_phase(observer, 'apply'):
+            self._make_dest_dirs()
+            if stages:
+                self._start_patch_pool()
+                try:
+                    self._map_stages(self._apply_target, stages)
+                except:
+                    self._stop_patch_pool(terminate=True)
+                    raise
+                self._stop_patch_pool()
+
+        with timed_phase(observer, 'remove'):
+            self._remove_files()
+
+        with timed_phase(observer, 'cleanup'):
+            if self.use_journal:
+                self.journal.commit()
+            self._discard_backups(self.backups)
+            if self.use_journal:
+                self.journal.close()
+                self._journal_started = False
+
+    def _do_apply_entry(self, entry, path, data):
+        observer = self.observer
+        with timed(observer, 'verify'):
+            if not entry.verify_orig_digest(data, path, self.root):
+                if entry.verify_dest_digest(data, path, self.root):
+                    logging.info(
+                        "patch already applied: %s", entry.target)
+                    self._add_removals(entry)
+                    return
+                else:
+                    raise SourceFileError(
+                        "original file does not contain expected data: %s"
+                        % entry.target)
         logging.debug("patching %s", entry.target)
 
+        if data is None:
+            if entry.type_code == 'delete':
+                # nothing is written, the target is removed along with
+                # the others once every entry is applied
+                self.stream_entry_delete(entry, path, None)
+            else:
+                self._apply_streamed(entry, path)
+            return
+
         new_data = super(PDArchivePatcher, self)._do_apply_entry(
             entry, path, data)
 
-        if not entry.verify_dest_digest(new_data):
-            raise PatchedFileError(
-                "patched file does not contain expected data: %s"
-                % entry.target)
+        with timed(observer, 'verify'):
+            if not entry.verify_dest_digest(new_data, path, self.root):
+                raise PatchedFileError(
+                    "patched file does not contain expected data: %s"
+                    % entry.target)
+        if observer is not None:
+            observer.count('bytes_in', len(data))
+            observer.count('bytes_out', len(new_data))
 
         exists = os.path.exists(path)
+        if self.atomic:
+            self._replace_file(entry.target, path, new_data, entry.mode,
+                               exists)
+        else:
+            self._overwrite_file(entry.target, path, new_data, entry.mode,
+                                 exists)
+
+    def streams(self, entry, path):
+        if entry.streamed:
+            return True
+        if not self.stream_threshold or \
+                not hasattr(self, 'stream_entry_%s' % entry.type_code):
+            return False
+        size = entry.payload_size
+        source = getattr(entry, 'target_source', None)
+        if source:
+            path = entry.source_path(self.root)
+        if os.path.exists(path):
+            size = max(size, os.path.getsize(path))
+        return size > self.stream_threshold
+
+    def _apply_streamed(self, entry, path):
+        # the patched file is written next to the target, hashed as it is
+        # written, and replaced atomically
+        func = getattr(self, 'stream_entry_%s' % entry.type_code, None)
+        if func is None:
+            raise NotImplementedError(
+                "Patcher '%s' can not stream entries of type '%s'"
+                % (self.__class__.__name__, entry.type_code))
+        self._verify_dest_dir(path)
+        handle, tmp_path = mkstemp(prefix=TEMP_PREFIX,
+                                   dir=os.path.dirname(path))
+        try:
+            with os.fdopen(handle, 'wb') as raw:
+                writer = _HashingWriter(raw, entry.hash_type)
+                func(entry, path, writer)
+            if writer.hexdigest() != entry.dest_digest:
+                raise PatchedFileError(
+                    "patched file does not contain expected data: %s"
+                    % entry.target)
+        except:
+            os.unlink(tmp_path)
+            raise
+        exists = os.path.exists(path)
+        if self.observer is not None:
+            if exists:
+                self.observer.count('bytes_in', os.path.getsize(path))
+            self.observer.count('bytes_out', writer.size)
+        self._install_file(entry.target, path, tmp_path, entry.mode, exists)
 
-        tmp_path = None
+    def _overwrite_file(self, target, path, data, mode, exists):
+        backup = None
         if exists:
             orig_mode = stat.S_IMODE(os.stat(path).st_mode)
-            dummy, tmp_path = mkstemp(prefix=__name__)
-            os.close(dummy)
-
-        backup_created = False
+            if self.use_journal:
+                backup = self.journal.new_backup()
+            else:
+                dummy, backup = mkstemp(prefix=__name__)
+                os.close(dummy)
+            with timed(self.observer, 'backup'):
+                shutil.copy(path, backup)
+
+            if not os.access(path, os.W_OK):
+                os.chmod(path, stat.S_IREAD | stat.S_IWRITE | orig_mode)
+        registered = self._add_backup(target, backup)
         try:
-            if exists:
-                shutil.copy(path, tmp_path)
-
-                if not os.access(path, os.W_OK):
-                    os.chmod(path, stat.S_IREAD | stat.S_IWRITE | orig_mode)
-            backup_created = True
-            try:
+            with timed(self.observer, 'write'):
                 with open(path, 'wb') as writer:
                     logging.info("writing data to %s", path)
-                    writer.write(new_data)
-                os.chmod(path, entry.mode)
-            except Exception, err:
-                if not exists:
-                    logging.error("%s\nremoving new file: %s",
-                                  str(err), path)
-                    os.unlink(path)
-                else:
-                    logging.error("ERROR: %s\nrestoring unpatched file: %s",
-                                  str(err), path)
-                    shutil.copy(tmp_path, path)
-                raise err
-
+                    writer.write(data)
+                os.chmod(path, mode)
+        except Exception, err:
+            if not exists:
+                logging.error("%s\nremoving new file: %s",
+                              str(err), path)
+                os.unlink(path)
+            else:
+                logging.error("ERROR: %s\nrestoring unpatched file: %s",
+                              str(err), path)
+                shutil.copy(backup, path)
+            raise err
         finally:
-            source = getattr(entry, 'target_source', None)
-            if source:
-                if not source in self.backups:
-                    self.backups[source] = tmp_path
-                tmp_path = None
-            if not entry.target in self.backups:
-                self.backups[entry.target] = tmp_path
+            if backup and not registered:
+                os.unlink(backup)
+
+    def _link_backup(self, path):
+        handle, backup = mkstemp(prefix=BACKUP_PREFIX,
+                                 dir=os.path.dirname(path))
+        os.close(handle)
+        os.unlink(backup)
+        try:
+            os.link(path, backup)
+        except (AttributeError, OSError):
+            # no hard links on this platform or file system
+            os.rename(path, backup)
+        return backup
+
+    def _replace_file(self, target, path, data, mode, exists):
+        # the new contents are written next to the target and renamed over
+        # it, so readers only ever see the old or the new file
+        handle, tmp_path = mkstemp(prefix=TEMP_PREFIX,
+                                   dir=os.path.dirname(path))
+        try:
+            with timed(self.observer, 'write'):
+                with os.fdopen(handle, 'wb') as writer:
+                    writer.write(data)
+        except Exception, err:
+            logging.error("%s\nleaving unpatched file: %s", str(err), path)
+            os.unlink(tmp_path)
+            raise err
+        self._install_file(target, path, tmp_path, mode, exists)
+
+    def _install_file(self, target, path, tmp_path, mode, exists):
+        # renames `tmp_path`, in the same directory as `path`, over it
+        backup = None
+        registered = False
+        try:
+            os.chmod(tmp_path, mode)
+            if exists:
+                with timed(self.observer, 'backup'):
+                    backup = self._link_backup(path)
+            registered = self._add_backup(target, backup)
+            logging.info("replacing %s", path)
+            if os.name == 'nt' and os.path.exists(path):
+                os.unlink(path)
+            os.rename(tmp_path, path)
+        except Exception, err:
+            logging.error("%s\nleaving unpatched file: %s", str(err), path)
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            if backup is not None and not os.path.exists(path):
+                os.rename(backup, path)
+            raise err
+        finally:
+            if backup and not registered and os.path.exists(backup):
+                os.unlink(backup)
 
     def _verify_dest_dir(self, path):
         parent = os.path.dirname(path)
         if not os.path.exists(parent):
-            os.makedirs(parent)
+            try:
+                os.makedirs(parent)
+            except OSError, err:
+                # created by another thread
+                if err.errno != errno.EEXIST:
+                    raise
 
     # pylint: disable=W0613,R0201
     def apply_entry_copy(self, entry, path, data):
         self._verify_dest_dir(path)
-        shutil.copy(entry.target_source, path)
-        with open(path, 'rb') as reader:
+        with open(entry.source_path(self.root), 'rb') as reader:
             data = reader.read()
         return data
 
     def apply_entry_move(self, entry, path, data):
         new_data = self.apply_entry_copy(entry, path, data)
-        self.to_unlink.append(os.path.abspath(entry.target_source))
+        with self._lock:
+            self.to_unlink.append(entry.source_path(self.root))
         return new_data
 
     def apply_entry_delete(self, entry, path, data):
         if path is None:
-            path = entry.target
-        self.to_unlink.append(path)
+            path = entry.target_path(self.root)
+        with self._lock:
+            self.to_unlink.append(path)
         return ''
 
     def apply_entry_new(self, entry, path, data):
         self._verify_dest_dir(path)
         return entry.payload
 
+    def apply_entry_replace(self, entry, path, data):
+        return entry.payload
+
     def apply_entry_diff(self, entry, path, data):
-        return bsdiff4.patch(data, entry.payload)
+        with timed(self.observer, 'payload'):
+            payload = entry.payload
+        return self._patch(data, payload)
+
+    def stream_entry_copy(self, entry, path, writer):
+        with open(entry.source_path(self.root), 'rb') as reader:
+            shutil.copyfileobj(reader, writer, STREAM_CHUNK_SIZE)
+
+    def stream_entry_move(self, entry, path, writer):
+        self.stream_entry_copy(entry, path, writer)
+        with self._lock:
+            self.to_unlink.append(entry.source_path(self.root))
+
+    def stream_entry_delete(self, entry, path, writer):
+        # the target was verified a chunk at a time
+        self.apply_entry_delete(entry, path, None)
+
+    def stream_entry_new(self, entry, path, writer):
+        reader = entry.open_payload()
+        try:
+            shutil.copyfileobj(reader, writer, STREAM_CHUNK_SIZE)
+        finally:
+            reader.close()
+
+    def stream_entry_replace(self, entry, path, writer):
+        self.stream_entry_new(entry, path, writer)
+
+    def stream_entry_diff(self, entry, path, writer):
+        with open(path, 'rb') as reader:
+            with timed(self.observer, 'patch'):
+                patch_stream(reader, entry.open_payload, writer)
+
+    def stream_entry_blockdiff(self, entry, path, writer):
+        with open(path, 'rb') as reader:
+            for orig_offset, orig_size, patch in entry.iter_blocks():
+                reader.seek(orig_offset)
+                writer.write(self._patch(reader.read(orig_size), patch))
 
     # pylint: disable=W0613,R0201
 DEFAULT_PATCHER_TYPE = PDArchivePatcher
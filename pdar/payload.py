@@ -0,0 +1,214 @@
+# This file is part of pdar.
+#
+# Copyright 2011 Jason Penney
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from StringIO import StringIO
+from pdar.errors import PDARError
+from tempfile import mkstemp
+import os
+import shutil
+
+__all__ = ['FilePayload', 'CompressedPayload', 'TemporaryPayload',
+           'UnloadedPayload', 'LimitedReader']
+
+READ_CHUNK_SIZE = 1024 * 1024
+TEMP_PAYLOAD_PREFIX = 'pdar-payload.'
+
+
+def _skip(reader, size):
+    while size > 0:
+        chunk = reader.read(min(size, READ_CHUNK_SIZE))
+        if not chunk:
+            break
+        size -= len(chunk)
+    return reader
+
+
+def read_fully(reader, size):
+    '''Read `size` bytes from `reader`, or as many as it holds.'''
+    chunks = []
+    while size > 0:
+        chunk = reader.read(min(size, READ_CHUNK_SIZE))
+        if not chunk:
+            break
+        chunks.append(chunk)
+        size -= len(chunk)
+    return ''.join(chunks)
+
+
+class LimitedReader(object):
+    '''Reads at most `size` bytes of `fileobj`, closing `owner` when it is
+    closed.'''
+
+    def __init__(self, fileobj, size, owner=None):
+        self._fileobj = fileobj
+        self._remaining = size
+        self._owner = owner
+
+    def read(self, size=-1):
+        if size < 0 or size > self._remaining:
+            size = self._remaining
+        data = self._fileobj.read(size)
+        self._remaining -= len(data)
+        return data
+
+    def close(self):
+        if self._owner is not None:
+            self._owner.close()
+            self._owner = None
+
+
+class _ClosingReader(object):
+
+    def __init__(self, reader, raw):
+        self._reader = reader
+        self._raw = raw
+
+    def read(self, size=-1):
+        return self._reader.read(size)
+
+    def close(self):
+        self._reader.close()
+        self._raw.close()
+
+
+class FilePayload(object):
+    '''Payload stored in a range of a file, only read when it is opened.'''
+
+    def __init__(self, path, offset=0, size=None):
+        if size is None:
+            size = os.path.getsize(path) - offset
+        self._path = path
+        self._offset = offset
+        self._size = size
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def offset(self):
+        return self._offset
+
+    @property
+    def size(self):
+        return self._size
+
+    def _open_raw(self, size, offset=0):
+        reader = open(self.path, 'rb')
+        reader.seek(self.offset + offset)
+        return LimitedReader(reader, size, owner=reader)
+
+    def open(self, offset=0):
+        '''Open the payload for reading from `offset`.'''
+        return self._open_raw(max(0, self.size - offset), offset)
+
+    def read(self):
+        reader = self.open()
+        try:
+            return reader.read()
+        finally:
+            reader.close()
+
+
+class CompressedPayload(FilePayload):
+    '''Payload stored compressed in a range of a file, decompressed as it
+    is read.'''
+
+    def __init__(self, path, offset, stored_size, size, codec):
+        super(CompressedPayload, self).__init__(path, offset, size)
+        self._stored_size = stored_size
+        self._codec = codec
+
+    @property
+    def stored_size(self):
+        return self._stored_size
+
+    @property
+    def codec(self):
+        return self._codec
+
+    def open(self, offset=0):
+        # the bytes before `offset` have to be decompressed to skip them
+        raw = self._open_raw(self.stored_size)
+        return _skip(_ClosingReader(self.codec.open_reader(raw), raw),
+                     offset)
+
+
+class TemporaryPayload(FilePayload):
+    '''Payload generated into a temporary file, which is removed by
+    `discard` once the payload is no longer needed.'''
+
+    @classmethod
+    def mkstemp(cls):
+        '''Return an open handle and the path of a new temporary file.'''
+        return mkstemp(prefix=TEMP_PAYLOAD_PREFIX)
+
+    @classmethod
+    def copy(cls, path):
+        handle, tmp_path = cls.mkstemp()
+        try:
+            with os.fdopen(handle, 'wb') as writer:
+                with open(path, 'rb') as reader:
+                    shutil.copyfileobj(reader, writer, READ_CHUNK_SIZE)
+        except:
+            os.unlink(tmp_path)
+            raise
+        return cls(tmp_path)
+
+    def discard(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+class UnloadedPayload(object):
+    '''Size of a payload that was skipped when its archive was loaded.'''
+
+    def __init__(self, size):
+        self._size = size
+
+    @property
+    def size(self):
+        return self._size
+
+    def open(self, offset=0):
+        raise PDARError("payload was not loaded from the archive")
+
+    read = open
+
+
+def open_payload(payload, offset=0):
+    if isinstance(payload, basestring):
+        reader = StringIO(payload)
+        reader.seek(offset)
+        return reader
+    return payload.open(offset)
+
+
+def payload_size(payload):
+    if isinstance(payload, basestring):
+        return len(payload)
+    return payload.size
+
+
+def read_payload(payload):
+    if isinstance(payload, basestring):
+        return payload
+    return payload.read()
+
+
+def discard_payload(payload):
+    if isinstance(payload, TemporaryPayload):
+        payload.discard()
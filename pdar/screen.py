@@ -0,0 +1,156 @@
+# This file is part of pdar.
+#
+# Copyright 2011 Jason Penney
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Decide, before diffing, whether a changed file is stored whole.
+
+Files are screened by extension first, then by sampling a few blocks of
+the new file.  Samples that have close to 8 bits of entropy per byte and
+do not compress are taken as compressed or encrypted data.  Such files
+are only diffed when a probe from one of the samples is found near the
+same offset in the original file, since a change to compressed data
+usually changes every byte after it.'''
+
+from collections import OrderedDict
+import math
+import os
+import zlib
+
+__all__ = ['DiffScreen']
+
+DEFAULT_DENY_EXTENSIONS = (
+    '.7z', '.bz2', '.gz', '.lz', '.lzma', '.rar', '.tbz2', '.tgz', '.txz',
+    '.xz', '.zip', '.zst',
+    '.gif', '.jpeg', '.jpg', '.png', '.webp',
+    '.aac', '.avi', '.flac', '.m4a', '.mkv', '.mov', '.mp3', '.mp4', '.ogg',
+    '.webm')
+SAMPLE_COUNT = 4
+SAMPLE_SIZE = 16 * 1024
+# bits per byte, and compressed size as a ratio of the sample size
+DEFAULT_MAX_ENTROPY = 7.9
+DEFAULT_MIN_RATIO = 0.95
+PROBE_SIZE = 64
+# distance either side of a sample's offset that the original is searched
+PROBE_WINDOW = 4 * 1024 * 1024
+
+SCREEN_EXTENSION = 'extension'
+SCREEN_INCOMPRESSIBLE = 'incompressible'
+SCREEN_DIFF = 'diff'
+
+
+def _entropy(data):
+    if not data:
+        return 0.0
+    size = float(len(data))
+    entropy = 0.0
+    for num in xrange(256):
+        count = data.count(chr(num))
+        if count:
+            entropy -= count / size * math.log(count / size, 2)
+    return entropy
+
+
+def _read_at(path, offset, size):
+    with open(path, 'rb') as reader:
+        reader.seek(offset)
+        return reader.read(size)
+
+
+class DiffScreen(object):
+    '''Screens changed files before they are diffed.  `allow` and `deny`
+    are file extensions, including the dot, that are always or never
+    diffed.  The number of files given each outcome is kept in `counts`.
+    '''
+
+    def __init__(self, allow=(), deny=DEFAULT_DENY_EXTENSIONS,
+                 max_entropy=DEFAULT_MAX_ENTROPY, min_ratio=DEFAULT_MIN_RATIO,
+                 sample_count=SAMPLE_COUNT, sample_size=SAMPLE_SIZE):
+        self._allow = frozenset(ext.lower() for ext in allow)
+        self._deny = frozenset(ext.lower() for ext in deny) - self._allow
+        self._max_entropy = max_entropy
+        self._min_ratio = min_ratio
+        self._sample_count = sample_count
+        self._sample_size = sample_size
+        self._counts = OrderedDict.fromkeys(
+            (SCREEN_EXTENSION, SCREEN_INCOMPRESSIBLE, SCREEN_DIFF), 0)
+
+    @property
+    def allow(self):
+        return self._allow
+
+    @property
+    def deny(self):
+        return self._deny
+
+    @property
+    def counts(self):
+        return self._counts
+
+    def _offsets(self, size):
+        if self._sample_count < 2 or \
+                size <= self._sample_size * self._sample_count:
+            return [0]
+        step = (size - self._sample_size) / (self._sample_count - 1)
+        return [num * step for num in xrange(self._sample_count)]
+
+    def _sample(self, path, data, offset):
+        if data is not None:
+            return data[offset:offset + self._sample_size]
+        return _read_at(path, offset, self._sample_size)
+
+    def _incompressible(self, samples):
+        sample = ''.join(samples)
+        if _entropy(sample) < self._max_entropy:
+            return False
+        return len(zlib.compress(sample, 1)) >= len(sample) * self._min_ratio
+
+    def _similar(self, orig, orig_data, samples):
+        # any probe found near its offset is enough for bsdiff to help
+        for offset, sample in samples:
+            middle = max(0, (len(sample) - PROBE_SIZE) / 2)
+            probe = sample[middle:middle + PROBE_SIZE]
+            if not probe:
+                continue
+            start = max(0, offset - PROBE_WINDOW)
+            if orig_data is not None:
+                if orig_data.find(probe, start,
+                                  offset + len(sample) + PROBE_WINDOW) >= 0:
+                    return True
+            elif probe in _read_at(orig, start,
+                                   offset - start + len(sample) +
+                                   PROBE_WINDOW):
+                return True
+        return False
+
+    def check(self, orig, dest, orig_data=None, dest_data=None):
+        '''Return why the changed file `dest` should be stored whole
+        rather than diffed against `orig`, or None to diff it.  Contents
+        already read can be passed as `orig_data` and `dest_data`.'''
+        ext = os.path.splitext(dest)[1].lower()
+        reason = None
+        if ext in self.deny:
+            reason = SCREEN_EXTENSION
+        elif ext not in self.allow:
+            if dest_data is not None:
+                size = len(dest_data)
+            else:
+                size = os.path.getsize(dest)
+            samples = [(offset, self._sample(dest, dest_data, offset))
+                       for offset in self._offsets(size)]
+            if self._incompressible([sample for dummy, sample in samples]) \
+                    and not self._similar(orig, orig_data, samples):
+                reason = SCREEN_INCOMPRESSIBLE
+        self._counts[reason or SCREEN_DIFF] += 1
+        return reason
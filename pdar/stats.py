@@ -0,0 +1,170 @@
+# This file is part of pdar.
+#
+# Copyright 2011 Jason Penney
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Observers of archive and patcher events.
+
+Archives and patchers report to an optional observer:
+
+* ``phase_start``/``phase_end``: a phase of creating, saving, loading or
+  applying an archive, such as ``create`` or ``apply``
+* ``entry_end``: an entry finished during a phase
+* ``timing``: time spent on a step within an entry, such as ``digest``,
+  ``patch``, ``backup`` or ``write``
+* ``count``: a counter, such as ``bytes_written`` or ``delta_cache_hits``
+
+Events may be sent from several threads at once.  When no observer is
+set, the only cost is a check for ``None``.'''
+
+from collections import OrderedDict
+import threading
+import time
+
+__all__ = ['BaseObserver', 'StatsCollector']
+
+
+class BaseObserver(object):
+
+    # pylint: disable=W0613,R0201
+
+    def phase_start(self, phase):
+        pass
+
+    def phase_end(self, phase, seconds):
+        pass
+
+    def entry_end(self, phase, entry, seconds):
+        pass
+
+    def timing(self, name, seconds):
+        pass
+
+    def count(self, name, value=1):
+        pass
+
+
+class StatsCollector(BaseObserver):
+    '''Totals of every event, for printing a summary.'''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._phases = OrderedDict()
+        self._entries = OrderedDict()
+        self._timings = OrderedDict()
+        self._counters = OrderedDict()
+
+    @property
+    def phases(self):
+        return self._phases
+
+    @property
+    def entries(self):
+        return self._entries
+
+    @property
+    def timings(self):
+        return self._timings
+
+    @property
+    def counters(self):
+        return self._counters
+
+    def phase_end(self, phase, seconds):
+        with self._lock:
+            self._phases[phase] = self._phases.get(phase, 0) + seconds
+
+    def entry_end(self, phase, entry, seconds):
+        key = (phase, entry.type_code)
+        with self._lock:
+            count, total = self._entries.get(key, (0, 0))
+            self._entries[key] = (count + 1, total + seconds)
+
+    def timing(self, name, seconds):
+        with self._lock:
+            self._timings[name] = self._timings.get(name, 0) + seconds
+
+    def count(self, name, value=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def summary(self):
+        lines = []
+        if self.phases:
+            lines.append('phases:')
+            lines.extend('  %-24s %10.3fs' % item
+                         for item in self.phases.iteritems())
+        if self.entries:
+            lines.append('entries:')
+            lines.extend('  %-24s %10.3fs  (%d)' % (
+                    '%s %s' % key, total, count)
+                         for key, (count, total) in self.entries.iteritems())
+        if self.timings:
+            lines.append('steps:')
+            lines.extend('  %-24s %10.3fs' % item
+                         for item in self.timings.iteritems())
+        if self.counters:
+            lines.append('counters:')
+            lines.extend('  %-24s %11d' % item
+                         for item in self.counters.iteritems())
+        return '\n'.join(lines)
+
+
+class _NullTimer(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer(object):
+
+    def __init__(self, observer, name, phase):
+        self._observer = observer
+        self._name = name
+        self._phase = phase
+        self._start = None
+
+    def __enter__(self):
+        if self._phase:
+            self._observer.phase_start(self._name)
+        self._start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        seconds = time.time() - self._start
+        if self._phase:
+            self._observer.phase_end(self._name, seconds)
+        else:
+            self._observer.timing(self._name, seconds)
+        return False
+
+
+def timed(observer, name):
+    '''Context manager reporting the time spent in a step to `observer`.'''
+    if observer is None:
+        return _NULL_TIMER
+    return _Timer(observer, name, False)
+
+
+def timed_phase(observer, name):
+    '''Context manager reporting the start and end of a phase.'''
+    if observer is None:
+        return _NULL_TIMER
+    return _Timer(observer, name, True)
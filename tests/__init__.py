@@ -62,6 +62,24 @@ class TestCase(unittest2.TestCase):
         
 
 
+class WorkdirTestCase(TestCase):
+
+    def setUp(self):
+        super(WorkdirTestCase, self).setUp()
+        self._workdir = mkdtemp(prefix=type(self).__module__ + '.')
+        self.addCleanup(shutil.rmtree, self._workdir, True)
+
+    @property
+    def workdir(self):
+        return self._workdir
+
+    def write_file(self, name, data):
+        path = os.path.join(self.workdir, name)
+        with open(path, 'wb') as writer:
+            writer.write(data)
+        return path
+
+
 DEFAULT_SIZE = 1024 * 1024 / 2
 
 class DataSetTestCase(TestCase):
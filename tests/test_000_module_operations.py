@@ -46,10 +46,42 @@ class ImportTest(TestCase):
         '''verify import of 'pdar.arhive' module'''
         self._test_import_module('pdar.archive')
 
+    def test_import_pdar_bspatch(self):
+        '''verify import of 'pdar.bspatch' module'''
+        self._test_import_module('pdar.bspatch')
+
+    def test_import_pdar_cache(self):
+        '''verify import of 'pdar.cache' module'''
+        self._test_import_module('pdar.cache')
+
+    def test_import_pdar_compression(self):
+        '''verify import of 'pdar.compression' module'''
+        self._test_import_module('pdar.compression')
+
+    def test_import_pdar_journal(self):
+        '''verify import of 'pdar.journal' module'''
+        self._test_import_module('pdar.journal')
+
+    def test_import_pdar_layout(self):
+        '''verify import of 'pdar.layout' module'''
+        self._test_import_module('pdar.layout')
+
+    def test_import_pdar_payload(self):
+        '''verify import of 'pdar.payload' module'''
+        self._test_import_module('pdar.payload')
+
     def test_import_pdar_patcher(self):
         '''verify import of 'pdar.patcher' module'''
         self._test_import_module('pdar.patcher')
 
+    def test_import_pdar_screen(self):
+        '''verify import of 'pdar.screen' module'''
+        self._test_import_module('pdar.screen')
+
+    def test_import_pdar_stats(self):
+        '''verify import of 'pdar.stats' module'''
+        self._test_import_module('pdar.stats')
+
 class VersionTest(TestCase):
 
     def test_parse_version(self):
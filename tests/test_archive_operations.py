@@ -22,6 +22,7 @@ import os
 import random
 import shutil
 
+from StringIO import StringIO
 from pkg_resources import parse_version
 
 
@@ -49,6 +50,16 @@ class ArchiveTest(tests.ArchiveTestCase):
                               "number of modified items sholud match "
                               "number of patches in pdar")
 
+    def test_0002_source_entries(self):
+        '''validate moved and copied files are detected from sources'''
+        types = dict((patch.target, patch.type_code)
+                     for patch in self.pdarchive.patches)
+        for target in self.copied_files + self.moved_files:
+            self.assertIn(types[target], ['copy', 'move'], target)
+        self.assertEqual(
+            len(self.moved_files),
+            len([code for code in types.values() if code == 'move']))
+
     def test_0003_digest_values(self):
         '''validate `orig_digest` does not ever match `dest_digest`'''
         for entry in self.pdarchive.patches:
@@ -82,12 +93,112 @@ class ArchiveTest(tests.ArchiveTestCase):
         self._test_apply_pdarchive(self.pdarchive)
 
 
+class ParallelArchiveTest(tests.ArchiveTestCase):
+
+    def setUp(self):
+        super(ParallelArchiveTest, self).setUp()
+        self._parallel_pdarchive = pdar.PDArchive(
+            self.orig_dir, self.mod_dir, workers=3)
+
+    @property
+    def parallel_pdarchive(self):
+        return self._parallel_pdarchive
+
+    def test_0001_entries(self):
+        '''validate entries match those created serially, in order'''
+        self.assertEqual(
+            [(entry.type_code, entry.target, entry.orig_digest,
+              entry.dest_digest) for entry in self.parallel_pdarchive.patches],
+            [(entry.type_code, entry.target, entry.orig_digest,
+              entry.dest_digest) for entry in self.pdarchive.patches])
+
+    def test_0002_apply_archive(self):
+        '''Apply pdar created with worker processes and validate results'''
+        self._test_apply_pdarchive(self.parallel_pdarchive)
+
+
 class ArchiveFileTest(tests.ArchiveFileTestCase):
 
     def test_0001_basics(self):
         '''ensure pdar file was written to disk'''
         self.assertTrue(os.path.exists(self.pdarchive_path))
 
+class ArchiveCodecTest(tests.ArchiveTestCase):
+
+    def test_0001_codecs(self):
+        '''save and load archives with each codec'''
+        for codec in pdar.PDArchive.codec_names():
+            path = os.path.join(self.workdir, 'codec.pdar')
+            self.pdarchive.save(path, codec=codec, level=1)
+            try:
+                loaded = pdar.PDArchive.load(path)
+            finally:
+                os.unlink(path)
+            self.assertEqual(
+                [entry.payload for entry in loaded.patches],
+                [entry.payload for entry in self.pdarchive.patches],
+                codec)
+
+    def test_0002_estimate(self):
+        '''estimated codec is one of the supported codecs'''
+        self.assertIn(self.pdarchive.estimate_codec(),
+                      pdar.PDArchive.codec_names())
+
+    def test_0003_detect_codec(self):
+        '''saved archives are identified by their compression'''
+        for codec in pdar.PDArchive.codec_names():
+            path = os.path.join(self.workdir, 'codec.pdar')
+            self.pdarchive.save(path, codec=codec)
+            try:
+                with open(path, 'rb') as reader:
+                    reader.seek(len(pdar.PDAR_ID))
+                    header = reader.read(512)
+            finally:
+                os.unlink(path)
+            self.assertEqual(pdar.PDArchive.detect_codec(header).name, codec)
+
+    def test_0004_estimate_sampled(self):
+        '''estimating the codec reads only a sample of each payload'''
+        expected = self.pdarchive.estimate_codec()
+        opened = []
+
+        class SampledPayload(pdar.FilePayload):
+
+            def open(self, offset=0):
+                opened.append(offset)
+                return super(SampledPayload, self).open(offset)
+
+            def read(self):
+                raise AssertionError('payload read in full')
+
+        for num, entry in enumerate(self.pdarchive.patches):
+            if not entry.payload_size:
+                continue
+            path = os.path.join(self.workdir, 'payload.%d' % num)
+            with open(path, 'wb') as writer:
+                writer.write(entry.payload)
+            self.addCleanup(os.unlink, path)
+            entry._payload = SampledPayload(path)
+        self.assertEqual(self.pdarchive.estimate_codec(), expected)
+        self.assertTrue(opened)
+        self.assertGreater(max(opened), 0)
+
+    def test_0005_levels(self):
+        '''levels a codec rejects fail before the archive is written'''
+        path = os.path.join(self.workdir, 'level.pdar')
+        for kwargs in ({'codec': 'bz2', 'level': 0}, {'level': 10}):
+            self.assertRaises(pdar.InvalidParameterError, self.pdarchive.save,
+                              path, **kwargs)
+            self.assertFalse(os.path.exists(path))
+            self.assertRaises(pdar.InvalidParameterError,
+                              pdar.PDArchive.create, path, self.orig_dir,
+                              self.mod_dir, **kwargs)
+            self.assertFalse(os.path.exists(path))
+        self.assertNotEqual(self.pdarchive.estimate_codec(0), 'bz2')
+        self.pdarchive.save(path, level=0, layout='indexed')
+        os.unlink(path)
+
+
 class LoadedArchiveFileTest(tests.ArchiveFileTestCase):
 
     def setUp(self):
@@ -139,5 +250,247 @@ class LoadedArchiveFileTest(tests.ArchiveFileTestCase):
         self._test_apply_pdarchive(self.loaded_pdarchive)
         
         
+class IndexedArchiveFileTest(tests.ArchiveTestCase):
+
+    def setUp(self):
+        super(IndexedArchiveFileTest, self).setUp()
+        self._pdarchive_path = os.path.join(self.workdir, 'indexed.pdar')
+        self.pdarchive.save(self._pdarchive_path, layout='indexed')
+        self.addCleanup(os.unlink, self._pdarchive_path)
+
+    @property
+    def pdarchive_path(self):
+        return self._pdarchive_path
+
+    def test_0001_file_id(self):
+        '''indexed archives are identified by PDAR_INDEXED_ID'''
+        file_id = pdar.PDAR_INDEXED_ID
+        if any(entry.extended for entry in self.pdarchive.patches):
+            file_id = pdar.PDAR_EXTENDED_INDEXED_ID
+        with open(self.pdarchive_path, 'rb') as reader:
+            self.assertEqual(reader.read(len(file_id)), file_id)
+
+    def test_0002_load(self):
+        '''loaded entries match the original entries'''
+        loaded = pdar.PDArchive.load(self.pdarchive_path)
+        self.assertEqual(
+            [(entry.type_code, entry.target, entry.orig_digest,
+              entry.dest_digest, entry.mode, entry.payload)
+             for entry in loaded.patches],
+            [(entry.type_code, entry.target, entry.orig_digest,
+              entry.dest_digest, entry.mode, entry.payload)
+             for entry in self.pdarchive.patches])
+        self.assertEqual(loaded.created_datetime,
+                         self.pdarchive.created_datetime)
+
+    def test_0003_load_entry(self):
+        '''single entries can be read from indexed and tar archives'''
+        tar_path = os.path.join(self.workdir, 'tar.pdar')
+        self.pdarchive.save(tar_path, layout='tar')
+        self.addCleanup(os.unlink, tar_path)
+        for entry in self.pdarchive.patches[::3]:
+            for path in (self.pdarchive_path, tar_path):
+                loaded = pdar.PDArchive.load_entry(path, entry.target)
+                self.assertEqual(loaded.type_code, entry.type_code)
+                self.assertEqual(loaded.payload, entry.payload)
+
+    def test_0004_apply_archive(self):
+        '''Apply loaded indexed pdar file and validate results'''
+        self._test_apply_pdarchive(pdar.PDArchive.load(self.pdarchive_path))
+
+    def test_0005_prefix(self):
+        '''indexed archives can follow other data in a file'''
+        path = os.path.join(self.workdir, 'prefixed.pdar')
+        self.addCleanup(os.unlink, path)
+        prefix = 'prefix data' * 100
+        with open(path, 'wb') as writer:
+            writer.write(prefix)
+            self.pdarchive.save_archive(writer, layout='indexed')
+        with open(path, 'rb') as reader:
+            reader.seek(len(prefix))
+            loaded = pdar.PDArchive.load_archive(reader)
+        self.addCleanup(loaded.close)
+        self.assertEqual(
+            [entry.payload for entry in loaded.patches],
+            [entry.payload for entry in self.pdarchive.patches])
+        self._test_apply_pdarchive(loaded)
+
+
+class LazyPayloadTest(tests.ArchiveTestCase):
+
+    def _save(self, layout):
+        path = os.path.join(self.workdir, '%s.pdar' % layout)
+        self.pdarchive.save(path, layout=layout)
+        self.addCleanup(os.unlink, path)
+        return path
+
+    def _payload_entries(self, archive):
+        return [entry for entry in archive.patches if entry.payload_size]
+
+    def test_0001_tar_payloads(self):
+        '''tar payloads are spooled to a file that is removed on close'''
+        archive = pdar.PDArchive.load(self._save('tar'))
+        entries = self._payload_entries(archive)
+        self.assertTrue(entries)
+        payload_file = entries[0]._payload.path
+        for entry in entries:
+            self.assertIsInstance(entry._payload, pdar.FilePayload)
+            self.assertEqual(entry._payload.path, payload_file)
+        self.assertTrue(os.path.exists(payload_file))
+        archive.close()
+        self.assertFalse(os.path.exists(payload_file))
+
+    def test_0002_indexed_payloads(self):
+        '''indexed payloads are read from the archive when needed'''
+        with pdar.PDArchive.load(self._save('indexed')) as archive:
+            entries = self._payload_entries(archive)
+            self.assertTrue(entries)
+            for entry in entries:
+                self.assertIsInstance(entry._payload, pdar.CompressedPayload)
+            self.assertEqual(
+                [entry.payload for entry in entries],
+                [entry.payload
+                 for entry in self._payload_entries(self.pdarchive)])
+            reader = entries[0].open_payload(100)
+            self.assertEqual(reader.read(), entries[0].payload[100:])
+            reader.close()
+
+    def test_0003_apply_archive(self):
+        '''Apply archive with lazy payloads and validate results'''
+        with pdar.PDArchive.load(self._save('tar')) as archive:
+            self._test_apply_pdarchive(archive)
+
+    def test_0004_headers_only(self):
+        '''archives can be loaded without reading payloads'''
+        expected = [(entry.type_code, entry.target, entry.orig_digest,
+                     entry.dest_digest, entry.payload_size)
+                    for entry in self.pdarchive.patches]
+        for layout in ('tar', 'indexed'):
+            with pdar.PDArchive.load(self._save(layout),
+                                     payloads=False) as archive:
+                self.assertEqual(
+                    [(entry.type_code, entry.target, entry.orig_digest,
+                      entry.dest_digest, entry.payload_size)
+                     for entry in archive.patches], expected)
+                entry = self._payload_entries(archive)[0]
+                self.assertRaises(pdar.PDARError, getattr, entry, 'payload')
+
+
+class StreamingCreateTest(tests.ArchiveTestCase):
+
+    def _entry_info(self, archive):
+        return [(entry.type_code, entry.target, entry.orig_digest,
+                 entry.dest_digest, entry.payload_size)
+                for entry in archive.patches]
+
+    def _create(self, layout, workers=None):
+        path = os.path.join(self.workdir, '%s.pdar' % layout)
+        archive = pdar.PDArchive.create(path, self.orig_dir, self.mod_dir,
+                                        workers=workers, layout=layout)
+        self.addCleanup(os.unlink, path)
+        self.assertEqual(self._entry_info(archive),
+                         self._entry_info(self.pdarchive))
+        entry = [entry for entry in archive.patches
+                 if entry.payload_size][0]
+        self.assertRaises(pdar.PDARError, getattr, entry, 'payload')
+        loaded = pdar.PDArchive.load(path)
+        self.addCleanup(loaded.close)
+        self.assertEqual(
+            [entry.payload for entry in loaded.patches],
+            [entry.payload for entry in self.pdarchive.patches])
+        return loaded
+
+    def test_0001_create(self):
+        '''streamed archives hold the same entries, without payloads'''
+        self._test_apply_pdarchive(self._create('tar'))
+
+    def test_0002_create_indexed(self):
+        '''streamed indexed archives created with worker processes'''
+        self._create('indexed', workers=3)
+
+    def test_0003_force(self):
+        '''existing files are only replaced when forced'''
+        path = os.path.join(self.workdir, 'exists.pdar')
+        open(path, 'wb').close()
+        self.addCleanup(os.unlink, path)
+        self.assertRaises(RuntimeError, pdar.PDArchive.create, path,
+                          self.orig_dir, self.mod_dir)
+        self.assertEqual(os.path.getsize(path), 0)
+        pdar.PDArchive.create(path, self.orig_dir, self.mod_dir, force=True)
+        self.assertTrue(os.path.getsize(path))
+
+    def test_0004_window(self):
+        '''worker processes only queue a window of jobs at a time'''
+        taken = []
+
+        class Jobs(list):
+
+            def __iter__(self):
+                for job in list.__iter__(self):
+                    taken.append(job)
+                    yield job
+
+        jobs = Jobs((pdar.PDARNewEntry, (target, None, target), None,
+                     self.mod_dir, 'sha1') for target in self.new_files * 4)
+        results = pdar.PDArchive._create_entries(
+            jobs, {'file_cache': pdar.FileCache(retain_limit=0)}, 2)
+        self.assertEqual(next(results)[0].target, self.new_files[0])
+        self.assertEqual(len(taken), 1 + 2 * pdar.archive.CREATE_WINDOW)
+        self.assertEqual([entry.target for entry, dummy, dummy in results],
+                         (self.new_files * 4)[1:])
+
+
+class FormatIdTest(tests.ArchiveTestCase):
+
+    def _file_id(self, path):
+        with open(path, 'rb') as reader:
+            return reader.read(len(pdar.PDAR_ID))
+
+    def _create(self, name, **kwargs):
+        path = os.path.join(self.workdir, name)
+        pdar.PDArchive.create(path, self.orig_dir, self.mod_dir, **kwargs)
+        self.addCleanup(os.unlink, path)
+        return path
+
+    def test_0001_extended(self):
+        '''archives with newer entry types use the extended format'''
+        path = self._create('extended.pdar', block_threshold=1)
+        archive = pdar.PDArchive.load(path)
+        self.addCleanup(archive.close)
+        self.assertIn('blockdiff',
+                      [entry.type_code for entry in archive.patches])
+        self.assertEqual(self._file_id(path), pdar.PDAR_EXTENDED_ID)
+
+    def test_0002_compatible(self):
+        '''archives without newer entry types keep the original format'''
+        path = self._create('compatible.pdar', block_threshold=0,
+                            replace_ratio=0, screen=False)
+        self.assertEqual(self._file_id(path), pdar.PDAR_ID)
+        archive = pdar.PDArchive.load(path)
+        self.addCleanup(archive.close)
+        self.assertFalse(any(entry.extended for entry in archive.patches))
+        path = os.path.join(self.workdir, 'saved.pdar')
+        archive.save(path, layout='indexed')
+        self.addCleanup(os.unlink, path)
+        self.assertEqual(self._file_id(path), pdar.PDAR_INDEXED_ID)
+
+    def test_0003_rewritten(self):
+        '''streamed archives fall back to the original format'''
+        path = self._create('rewritten.pdar', layout='indexed',
+                            block_threshold=0, replace_ratio=0)
+        self.assertEqual(self._file_id(path), pdar.PDAR_INDEXED_ID)
+        pdar.PDArchive.load(path).close()
+
+    def test_0004_unsupported(self):
+        '''extended entries are not written to original format archives'''
+        entry = pdar.PDARReplaceEntry(self.new_files[0], payload='data')
+        writer = pdar.TarArchiveWriter(StringIO(), {}, pdar.StoreCodec())
+        self.assertRaises(pdar.PDARError, writer.add_entry, entry)
+        headers = entry.pax_headers()
+        headers[pdar.entry.ENTRY_HEADER_TYPE] = 'unknown'
+        self.assertRaises(pdar.UnsupportedArchiveError,
+                          pdar.PDAREntry.from_headers, headers)
+
+
 if __name__ == "__main__":
     tests.main()
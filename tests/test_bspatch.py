@@ -0,0 +1,62 @@
+# This file is part of pdar.
+#
+# Copyright 2011 Jason Penney
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest2
+import tests
+import pdar.bspatch
+
+import bsdiff4
+import random
+from StringIO import StringIO
+
+
+class PatchStreamTest(tests.TestCase):
+
+    def _patch(self, orig, dest, chunk_size):
+        patch = bsdiff4.diff(orig, dest)
+        writer = StringIO()
+        size = pdar.bspatch.patch_stream(
+            StringIO(orig), lambda: StringIO(patch), writer, chunk_size)
+        self.assertEqual(size, len(dest))
+        return writer.getvalue()
+
+    def test_0001_matches_bsdiff4(self):
+        '''streamed patches match patches applied in memory'''
+        rand = random.Random(0)
+        orig = ''.join(chr(rand.randint(0, 255)) for dummy in xrange(20000))
+        dest = bytearray(orig)
+        for dummy in xrange(10):
+            offset = rand.randint(0, len(dest))
+            dest[offset:offset + rand.randint(0, 300)] = \
+                orig[:rand.randint(0, 300)]
+        dest = str(dest) + '\0' * 50000
+        for chunk_size in (7, 4096, pdar.bspatch.STREAM_CHUNK_SIZE):
+            self.assertEqual(self._patch(orig, dest, chunk_size), dest)
+
+    def test_0002_empty(self):
+        '''empty originals and results are patched'''
+        self.assertEqual(self._patch('', 'data', 2), 'data')
+        self.assertEqual(self._patch('data', '', 2), '')
+
+    def test_0003_invalid(self):
+        '''patches without a bsdiff header are rejected'''
+        self.assertRaises(ValueError, pdar.bspatch.patch_stream,
+                          StringIO(''), lambda: StringIO('invalid'),
+                          StringIO())
+
+
+if __name__ == "__main__":
+    tests.main()
@@ -0,0 +1,225 @@
+# This file is part of pdar.
+#
+# Copyright 2011 Jason Penney
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest2
+import tests
+import pdar
+
+import hashlib
+import os
+import shutil
+
+
+class FileDigestTest(tests.WorkdirTestCase):
+
+    def test_0001_chunked(self):
+        '''chunked digests match digests of the whole file'''
+        data = os.urandom(10000)
+        path = self.write_file('data', data)
+        for use_mmap in (False, True):
+            self.assertEqual(
+                pdar.cache.file_digest(path, 'sha1', chunk_size=999,
+                                       use_mmap=use_mmap),
+                hashlib.sha1(data).hexdigest())
+
+    def test_0002_empty(self):
+        '''digests of empty files match the digest of an empty string'''
+        path = self.write_file('data', '')
+        for use_mmap in (False, True):
+            self.assertEqual(
+                pdar.cache.file_digest(path, 'sha1', use_mmap=use_mmap),
+                hashlib.sha1('').hexdigest())
+
+
+class FileCacheTest(tests.WorkdirTestCase):
+
+    def test_0001_digest(self):
+        '''digests are generated once and match hashlib'''
+        path = self.write_file('data', 'x' * 1000)
+        cache = pdar.FileCache()
+        self.assertEqual(cache.digest(path, 'sha1'),
+                         hashlib.sha1('x' * 1000).hexdigest())
+        self.assertEqual(cache.digest(path, 'sha1'),
+                         hashlib.sha1('x' * 1000).hexdigest())
+        self.assertEqual(cache.bytes_read, 1000)
+
+    def test_0002_retain(self):
+        '''retained data is returned by the next read, then released'''
+        path = self.write_file('data', 'x' * 1000)
+        cache = pdar.FileCache()
+        cache.digest(path, 'sha1', retain=True)
+        self.assertEqual(cache.read(path), 'x' * 1000)
+        self.assertEqual(cache.bytes_read, 1000)
+        cache.read(path)
+        self.assertEqual(cache.bytes_read, 2000)
+
+    def test_0003_retain_limit(self):
+        '''data larger than `retain_limit` is not retained'''
+        path = self.write_file('data', 'x' * 1000)
+        cache = pdar.FileCache(retain_limit=999)
+        cache.digest(path, 'sha1', retain=True)
+        cache.read(path)
+        self.assertEqual(cache.bytes_read, 2000)
+
+
+class DigestCacheTest(tests.WorkdirTestCase):
+
+    def test_0001_persist(self):
+        '''digests are saved and reloaded'''
+        path = self.write_file('data', 'x' * 1000)
+        cache_path = os.path.join(self.workdir, 'digests')
+        cache = pdar.DigestCache(cache_path)
+        self.assertIsNone(cache.get(path, 'sha1'))
+        cache.put(path, 'sha1', 'digest')
+        cache.save()
+        cache = pdar.DigestCache(cache_path)
+        self.assertEqual(cache.get(path, 'sha1'), 'digest')
+        self.assertIsNone(cache.get(path, 'md5'))
+
+    def test_0002_stat_change(self):
+        '''digests are not used once a file changes'''
+        path = self.write_file('data', 'x' * 1000)
+        cache = pdar.DigestCache(os.path.join(self.workdir, 'digests'))
+        cache.put(path, 'sha1', 'digest')
+        self.write_file('data', 'x' * 1001)
+        self.assertIsNone(cache.get(path, 'sha1'))
+
+    def test_0003_lru(self):
+        '''least recently used digests are evicted'''
+        paths = [self.write_file('data%d' % num, 'x')
+                 for num in xrange(3)]
+        cache = pdar.DigestCache(os.path.join(self.workdir, 'digests'),
+                                 max_entries=2)
+        cache.put(paths[0], 'sha1', 'digest0')
+        cache.put(paths[1], 'sha1', 'digest1')
+        cache.get(paths[0], 'sha1')
+        cache.put(paths[2], 'sha1', 'digest2')
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get(paths[1], 'sha1'))
+        self.assertEqual(cache.get(paths[0], 'sha1'), 'digest0')
+
+    def test_0004_file_cache(self):
+        '''FileCache uses digests from the DigestCache without reading'''
+        path = self.write_file('data', 'x' * 1000)
+        cache = pdar.DigestCache(os.path.join(self.workdir, 'digests'))
+        pdar.FileCache(digest_cache=cache).digest(path, 'sha1')
+        file_cache = pdar.FileCache(digest_cache=cache)
+        self.assertEqual(file_cache.digest(path, 'sha1'),
+                         hashlib.sha1('x' * 1000).hexdigest())
+        self.assertEqual(file_cache.bytes_read, 0)
+
+
+class DeltaCacheTest(tests.WorkdirTestCase):
+
+    def test_0001_get_put(self):
+        '''deltas are stored by digests and parameters'''
+        cache = pdar.DeltaCache(os.path.join(self.workdir, 'deltas'))
+        self.assertIsNone(cache.get('a', 'b', 'sha1'))
+        cache.put('a', 'b', 'sha1', 'delta')
+        self.assertEqual(cache.get('a', 'b', 'sha1'), 'delta')
+        self.assertIsNone(cache.get('a', 'b', 'sha1', params=(1,)))
+        self.assertIsNone(cache.get('b', 'a', 'sha1'))
+        self.assertEqual(cache.hits, 1)
+
+    def test_0002_prune(self):
+        '''least recently used deltas are removed by `prune`'''
+        cache = pdar.DeltaCache(os.path.join(self.workdir, 'deltas'),
+                                max_size=20)
+        for num in xrange(3):
+            cache.put('a', str(num), 'sha1', 'x' * 10)
+            path = cache._delta_path('a', str(num), 'sha1')
+            os.utime(path, (num, num))
+        self.assertEqual(cache.prune(), 20)
+        self.assertIsNone(cache.get('a', '0', 'sha1'))
+        self.assertIsNotNone(cache.get('a', '2', 'sha1'))
+
+    def test_0003_files(self):
+        '''deltas are stored from and returned as files'''
+        cache = pdar.DeltaCache(os.path.join(self.workdir, 'deltas'))
+        self.assertIsNone(cache.get_path('a', 'b', 'sha1'))
+        cache.put_file('a', 'b', 'sha1', self.write_file('delta', 'delta'))
+        path = cache.get_path('a', 'b', 'sha1')
+        with open(path, 'rb') as reader:
+            self.assertEqual(reader.read(), 'delta')
+        self.assertEqual(cache.get('a', 'b', 'sha1'), 'delta')
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+
+
+class SinglePassTest(tests.WorkdirTestCase):
+
+    def test_0001_bytes_read(self):
+        '''originals hashed to detect moves are not read again to diff'''
+        orig_dir = os.path.join(self.workdir, 'orig')
+        dest_dir = os.path.join(self.workdir, 'dest')
+        os.makedirs(orig_dir)
+        os.makedirs(dest_dir)
+        data = ''.join(chr(num % 251) for num in xrange(100000))
+        for path, name, contents in ((orig_dir, 'changed.bin', data),
+                                     (dest_dir, 'changed.bin', data[::-1]),
+                                     (dest_dir, 'new.bin', data[1:] + 'x')):
+            with open(os.path.join(path, name), 'wb') as writer:
+                writer.write(contents)
+        stats = pdar.StatsCollector()
+        archive = pdar.PDArchive(orig_dir, dest_dir, observer=stats)
+        self.assertEqual(sorted(entry.type_code
+                                for entry in archive.patches),
+                         ['diff', 'new'])
+        self.assertEqual(stats.counters['bytes_read'], 3 * len(data))
+
+
+class CachedArchiveTest(tests.ArchiveTestCase):
+
+    def test_0001_cached_archive(self):
+        '''archives created with a digest cache match, and reuse digests'''
+        cache_path = os.path.join(self.workdir, 'digests')
+        self.addCleanup(os.unlink, cache_path)
+        for dummy in xrange(2):
+            cache = pdar.DigestCache(cache_path)
+            pdarchive = pdar.PDArchive(self.orig_dir, self.mod_dir,
+                                       digest_cache=cache)
+            self.assertEqual(
+                [(entry.type_code, entry.target, entry.orig_digest,
+                  entry.dest_digest) for entry in pdarchive.patches],
+                [(entry.type_code, entry.target, entry.orig_digest,
+                  entry.dest_digest) for entry in self.pdarchive.patches])
+        self.assertGreater(cache.hits, 0)
+        self._test_apply_pdarchive(pdarchive)
+
+    def test_0002_cached_deltas(self):
+        '''archives created with a delta cache reuse deltas'''
+        cache_path = os.path.join(self.workdir, 'deltas')
+        self.addCleanup(shutil.rmtree, cache_path, True)
+        digest_path = os.path.join(self.workdir, 'digests')
+        self.addCleanup(os.unlink, digest_path)
+        pdar.PDArchive(self.orig_dir, self.mod_dir,
+                       digest_cache=pdar.DigestCache(digest_path))
+        lookups = []
+        for dummy in xrange(2):
+            cache = pdar.DeltaCache(cache_path)
+            pdarchive = pdar.PDArchive(
+                self.orig_dir, self.mod_dir, delta_cache=cache,
+                digest_cache=pdar.DigestCache(digest_path))
+            lookups.append((cache.hits, cache.misses))
+        diffs = len([entry for entry in pdarchive.patches
+                     if entry.type_code == 'diff'])
+        # each delta is looked up once, whether or not the digests of
+        # its files were cached
+        self.assertEqual(lookups, [(0, diffs), (diffs, 0)])
+        self._test_apply_pdarchive(pdarchive)
+
+
+if __name__ == "__main__":
+    tests.main()
@@ -0,0 +1,722 @@
+# This file is part of pdar.
+#
+# Copyright 2011 Jason Penney
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest2
+import tests
+import pdar
+
+import bsdiff4
+import multiprocessing
+import os
+import shutil
+import threading
+
+
+class PatcherTestCase(tests.WorkdirTestCase):
+
+    def setUp(self):
+        super(PatcherTestCase, self).setUp()
+        self._orig_dir = os.path.join(self.workdir, 'orig_dir')
+        self._dest_dir = os.path.join(self.workdir, 'dest_dir')
+
+    @property
+    def orig_dir(self):
+        return self._orig_dir
+
+    @property
+    def dest_dir(self):
+        return self._dest_dir
+
+    def write_files(self, path, files):
+        for name, data in files.iteritems():
+            fname = os.path.join(path, name)
+            if not os.path.exists(os.path.dirname(fname)):
+                os.makedirs(os.path.dirname(fname))
+            with open(fname, 'wb') as writer:
+                writer.write(data)
+
+    def make_trees(self, orig_files, dest_files):
+        self.write_files(self.orig_dir, orig_files)
+        self.write_files(self.dest_dir, dest_files)
+        return pdar.PDArchive(self.orig_dir, self.dest_dir)
+
+    def patch_copy(self, archive, **kwargs):
+        patch_dir = os.path.join(self.workdir, 'patch_dir')
+        shutil.rmtree(patch_dir, True)
+        shutil.copytree(self.orig_dir, patch_dir)
+        archive.patch(patch_dir, **kwargs)
+        return patch_dir
+
+    def read_file(self, path):
+        with open(path, 'rb') as reader:
+            return reader.read()
+
+    def tree_files(self, path):
+        files = {}
+        for root, dummy, fnames in os.walk(path):
+            for fname in fnames:
+                fname = os.path.join(root, fname)
+                files[os.path.relpath(fname, path)] = self.read_file(fname)
+        return files
+
+    def assertTreesEqual(self, first, second):
+        self.assertEqual(self.tree_files(first), self.tree_files(second))
+
+class ApplyTestCase(PatcherTestCase):
+
+    def setUp(self):
+        super(ApplyTestCase, self).setUp()
+        base = ''.join(chr(num % 251) for num in xrange(64 * 1024))
+        self._archive = self.make_trees({
+                'source.bin': base,
+                'moved.bin': base[::-1],
+                'deleted.bin': base[:1024],
+                'sub/same.bin': base[1024:]},
+            {
+                'source.bin': base[:4096] + 'changed' + base[4096:],
+                'copy.bin': base,
+                'new/dir/moved.bin': base[::-1],
+                'sub/same.bin': base[1024:],
+                'new.bin': 'new data'})
+
+    @property
+    def archive(self):
+        return self._archive
+
+    def archive_targets(self):
+        return [entry.target for entry in self.archive.patches]
+
+    def default_workers(self, check):
+        '''threads used by `check` of a patcher without and with workers
+        given'''
+        used = []
+        for workers in (None, 2):
+            patcher = pdar.PDArchivePatcher(self.archive, self.orig_dir,
+                                            workers=workers)
+            map_stages = patcher._map_stages
+
+            def record_workers(func, stages, workers=None):
+                used.append(workers)
+                return map_stages(func, stages, workers)
+
+            patcher._map_stages = record_workers
+            check(patcher)
+        return used
+
+
+class ParallelApplyTest(ApplyTestCase):
+
+    def test_0001_plan(self):
+        '''copy and move sources are overwritten after they are read'''
+        patcher = pdar.PDArchivePatcher(self.archive, self.orig_dir)
+        stages = patcher.plan()
+        stage_of = dict((target, num) for num, stage in enumerate(stages)
+                        for target in stage)
+        self.assertItemsEqual(stage_of.keys(), patcher.targets.keys())
+        self.assertLess(stage_of['copy.bin'], stage_of['source.bin'])
+
+    def test_0002_apply(self):
+        '''parallel apply produces the destination tree'''
+        for workers in (1, 4):
+            patch_dir = self.patch_copy(self.archive, workers=workers)
+            self.assertTreesEqual(self.dest_dir, patch_dir)
+
+
+class ProcessPatchTest(PatcherTestCase):
+
+    def test_0001_apply(self):
+        '''deltas are applied in worker processes when requested'''
+        base = ''.join(chr((num * 7) % 251) for num in xrange(128 * 1024))
+        names = ['diff%d.bin' % num for num in xrange(4)]
+        self.write_files(self.orig_dir, dict(
+                (name, base[num:]) for num, name in enumerate(names)))
+        self.write_files(self.dest_dir, dict(
+                (name, base[num:] + name) for num, name in enumerate(names)))
+        # two files are diffed in blocks
+        archive = pdar.PDArchive(self.orig_dir, self.dest_dir,
+                                 block_threshold=128 * 1024 + 7,
+                                 block_size=16 * 1024)
+        self.assertEqual(sorted(entry.type_code
+                                for entry in archive.patches),
+                         ['blockdiff', 'blockdiff', 'diff', 'diff'])
+        patch_dir = os.path.join(self.workdir, 'patch_dir')
+        shutil.copytree(self.orig_dir, patch_dir)
+        for kwargs, expected in (({'workers': 3}, False),
+                                 ({'patch_processes': 1}, True),
+                                 ({'workers': 3, 'patch_processes': 3},
+                                  True)):
+            patcher = pdar.PDArchivePatcher(archive, patch_dir, **kwargs)
+            pooled = []
+            patch = patcher._patch
+
+            def record_patch(data, payload):
+                pooled.append(patcher._patch_pool is not None)
+                return patch(data, payload)
+
+            patcher._patch = record_patch
+            archive.patch(patcher=patcher)
+            self.assertTreesEqual(self.dest_dir, patch_dir)
+            self.assertTrue(pooled)
+            self.assertEqual(set(pooled), set([expected]))
+            self.assertIsNone(patcher._patch_pool)
+            shutil.rmtree(patch_dir)
+            shutil.copytree(self.orig_dir, patch_dir)
+
+
+class AtomicApplyTest(ApplyTestCase):
+
+    def test_0001_apply(self):
+        '''atomic apply replaces files and leaves no temporary files'''
+        patch_dir = os.path.join(self.workdir, 'patch_dir')
+        shutil.copytree(self.orig_dir, patch_dir)
+        target = os.path.join(patch_dir, 'source.bin')
+        # readers holding the original file keep seeing the old contents
+        with open(target, 'rb') as reader:
+            orig_inode = os.fstat(reader.fileno()).st_ino
+            self.archive.patch(patch_dir, atomic=True)
+            self.assertEqual(reader.read(4096), self.read_file(
+                    os.path.join(self.orig_dir, 'source.bin'))[:4096])
+        self.assertNotEqual(os.stat(target).st_ino, orig_inode)
+        self.assertTreesEqual(self.dest_dir, patch_dir)
+
+    def test_0002_rollback(self):
+        '''failed atomic apply restores the original files'''
+        patch_dir = os.path.join(self.workdir, 'patch_dir')
+        shutil.copytree(self.orig_dir, patch_dir)
+        patcher = pdar.PDArchivePatcher(self.archive, patch_dir, atomic=True)
+
+        def failing_apply(entry, path, data):
+            raise IOError('failed')
+
+        patcher.apply_entry_new = failing_apply
+        self.assertRaises(IOError, self.archive.patch, patcher=patcher)
+        self.assertTreesEqual(self.orig_dir, patch_dir)
+
+    def test_0003_rollback_linked(self):
+        '''failures after a target is backed up leave no backup behind'''
+        patch_dir = os.path.join(self.workdir, 'patch_dir')
+        shutil.copytree(self.orig_dir, patch_dir)
+        rename = os.rename
+
+        def failing_rename(src, dst):
+            # patched files fail to replace targets that were backed up
+            if os.path.basename(src).startswith(pdar.patcher.TEMP_PREFIX) \
+                    and os.path.exists(dst):
+                raise OSError('failed')
+            rename(src, dst)
+
+        os.rename = failing_rename
+        self.addCleanup(setattr, os, 'rename', rename)
+        self.assertRaises(OSError, self.archive.patch, patch_dir,
+                          atomic=True)
+        self.assertTreesEqual(self.orig_dir, patch_dir)
+
+
+class JournalTest(ApplyTestCase):
+
+    def interrupted_patch_dir(self, atomic=False):
+        '''apply the archive until it is interrupted after patching
+        'source.bin', without backing anything out'''
+        patch_dir = os.path.join(self.workdir, 'patch_dir')
+        shutil.copytree(self.orig_dir, patch_dir)
+        patcher = pdar.PDArchivePatcher(
+            self.archive, patch_dir, pdar.patcher.BaseErrorHandler(),
+            atomic=atomic, journal=True)
+        journal_done = patcher.journal.done
+
+        def interrupt(target, **info):
+            if target == 'source.bin':
+                raise KeyboardInterrupt()
+            journal_done(target, **info)
+
+        patcher.journal.done = interrupt
+        self.assertRaises(KeyboardInterrupt, patcher.apply_archive)
+        self.assertTrue(patcher.journal.exists())
+        return patch_dir
+
+    def test_0001_apply(self):
+        '''journal is removed once the archive is applied'''
+        patch_dir = self.patch_copy(self.archive, journal=True)
+        self.assertFalse(os.path.exists(
+                os.path.join(patch_dir, pdar.JOURNAL_NAME)))
+        self.assertTreesEqual(self.dest_dir, patch_dir)
+
+    def test_0002_resume(self):
+        '''interrupted apply is resumed by the next apply'''
+        for atomic in (False, True):
+            patch_dir = self.interrupted_patch_dir(atomic)
+            self.archive.patch(patch_dir, atomic=atomic)
+            self.assertTreesEqual(self.dest_dir, patch_dir)
+            shutil.rmtree(patch_dir)
+
+    def test_0003_rollback(self):
+        '''interrupted apply is rolled back from the journal'''
+        for atomic in (False, True):
+            patch_dir = self.interrupted_patch_dir(atomic)
+            pdar.PDArchivePatcher(self.archive, patch_dir).rollback_journal()
+            self.assertTreesEqual(self.orig_dir, patch_dir)
+            shutil.rmtree(patch_dir)
+
+    def test_0004_other_archive(self):
+        '''journal of a different archive is not resumed'''
+        patch_dir = self.interrupted_patch_dir()
+        other = pdar.PDArchive(self.orig_dir, self.orig_dir)
+        self.assertRaises(pdar.PDARError, other.patch, patch_dir)
+        self.assertTrue(os.path.exists(
+                os.path.join(patch_dir, pdar.JOURNAL_NAME)))
+
+    def resume_targets(self, patch_dir, **kwargs):
+        '''resume the interrupted apply, returning the targets whose
+        entries were read and verified'''
+        patcher = pdar.PDArchivePatcher(self.archive, patch_dir, **kwargs)
+        applied = []
+        apply_entry = patcher.apply_entry
+
+        def record_entry(entry, target, data):
+            applied.append(entry.target)
+            apply_entry(entry, target, data)
+
+        patcher.apply_entry = record_entry
+        self.archive.patch(patcher=patcher)
+        self.assertTreesEqual(self.dest_dir, patch_dir)
+        return applied
+
+    def test_0005_checkpoint(self):
+        '''resumed apply skips completed targets without reading them'''
+        patch_dir = self.interrupted_patch_dir()
+        self.assertEqual(self.resume_targets(patch_dir), ['source.bin'])
+
+    def test_0006_verify(self):
+        '''completed targets are verified when requested'''
+        patch_dir = self.interrupted_patch_dir()
+        self.assertItemsEqual(self.resume_targets(patch_dir, verify=True),
+                              self.archive_targets())
+
+    def test_0007_changed_target(self):
+        '''completed targets that changed since are verified'''
+        patch_dir = self.interrupted_patch_dir()
+        os.utime(os.path.join(patch_dir, 'new.bin'), (0, 0))
+        self.assertItemsEqual(self.resume_targets(patch_dir),
+                              ['new.bin', 'source.bin'])
+
+    def test_0008_sync(self):
+        '''backups are flushed to disk before they are recorded'''
+        for atomic in (False, True):
+            patch_dir = os.path.join(self.workdir, 'patch_dir')
+            shutil.copytree(self.orig_dir, patch_dir)
+            patcher = pdar.PDArchivePatcher(self.archive, patch_dir,
+                                            atomic=atomic, journal=True)
+            events = []
+            sync = patcher.journal.sync
+            backup = patcher.journal.backup
+
+            def record_sync(path):
+                sync(path)
+                events.append(('sync', path))
+
+            def record_backup(target, path):
+                events.append(('backup', path))
+                backup(target, path)
+
+            patcher.journal.sync = record_sync
+            patcher.journal.backup = record_backup
+            self.archive.patch(patcher=patcher)
+            self.assertTreesEqual(self.dest_dir, patch_dir)
+            backups = [path for event, path in events
+                       if event == 'backup' and path]
+            self.assertTrue(backups)
+            for path in backups:
+                self.assertLess(events.index(('sync', path)),
+                                events.index(('backup', path)))
+            shutil.rmtree(patch_dir)
+
+    def killed_patch_dir(self):
+        '''apply the archive atomically in another process, killed after
+        'source.bin' is backed up and before it is replaced'''
+        patch_dir = os.path.join(self.workdir, 'patch_dir')
+        shutil.copytree(self.orig_dir, patch_dir)
+
+        def apply_archive():
+            patcher = pdar.PDArchivePatcher(self.archive, patch_dir,
+                                            atomic=True, journal=True)
+            add_backup = patcher._add_backup
+
+            def kill(target, backup):
+                registered = add_backup(target, backup)
+                if target == 'source.bin':
+                    os._exit(1)
+                return registered
+
+            patcher._add_backup = kill
+            patcher.apply_archive()
+
+        process = multiprocessing.Process(target=apply_archive)
+        process.start()
+        process.join()
+        self.assertEqual(process.exitcode, 1)
+        names = os.listdir(patch_dir)
+        for prefix in (pdar.patcher.TEMP_PREFIX, pdar.patcher.BACKUP_PREFIX):
+            self.assertTrue([name for name in names
+                             if name.startswith(prefix)])
+        return patch_dir
+
+    def test_0009_killed(self):
+        '''killed atomic apply leaves no files behind once resumed, or
+        rolled back'''
+        patch_dir = self.killed_patch_dir()
+        self.archive.patch(patch_dir, atomic=True)
+        self.assertTreesEqual(self.dest_dir, patch_dir)
+        shutil.rmtree(patch_dir)
+        patch_dir = self.killed_patch_dir()
+        pdar.PDArchivePatcher(self.archive, patch_dir).rollback_journal()
+        self.assertTreesEqual(self.orig_dir, patch_dir)
+
+
+class PreflightTest(ApplyTestCase):
+
+    def test_0001_clean(self):
+        '''preflight of an unmodified tree finds no mismatches'''
+        patcher = pdar.PDArchivePatcher(self.archive, self.orig_dir,
+                                        workers=4)
+        self.assertEqual(patcher.preflight(), [])
+
+    def test_0002_mismatches(self):
+        '''all mismatches are reported before anything is written'''
+        patch_dir = os.path.join(self.workdir, 'patch_dir')
+        shutil.copytree(self.orig_dir, patch_dir)
+        for name in ('source.bin', 'deleted.bin'):
+            with open(os.path.join(patch_dir, name), 'ab') as writer:
+                writer.write('unexpected')
+        modified = self.tree_files(patch_dir)
+
+        patcher = pdar.PDArchivePatcher(self.archive, patch_dir, workers=4,
+                                        preflight=True)
+        # 'copy.bin' is copied from the modified 'source.bin'
+        self.assertItemsEqual(patcher.preflight(),
+                              ['source.bin', 'deleted.bin', 'copy.bin'])
+        self.assertRaises(pdar.SourceFileError, self.archive.patch,
+                          patcher=patcher)
+        self.assertEqual(self.tree_files(patch_dir), modified)
+
+
+    def test_0003_default_workers(self):
+        '''preflight uses one thread per CPU unless workers are given'''
+        self.assertEqual(
+            self.default_workers(
+                lambda patcher: self.assertEqual(patcher.preflight(), [])),
+            [multiprocessing.cpu_count(), 2])
+
+
+class AuditTest(ApplyTestCase):
+
+    def audit(self, path):
+        patcher = pdar.PDArchivePatcher(self.archive, path, workers=4)
+        return dict((entry.target, passed)
+                    for entry, passed in patcher.audit())
+
+    def test_0001_patched(self):
+        '''every entry passes on a patched tree'''
+        results = self.audit(self.patch_copy(self.archive))
+        self.assertItemsEqual(results.keys(), self.archive_targets())
+        self.assertTrue(all(results.values()))
+
+    def test_0002_unpatched(self):
+        '''entries that are not applied fail'''
+        results = self.audit(self.orig_dir)
+        self.assertEqual(
+            sorted(target for target, passed in results.iteritems()
+                   if passed), [])
+
+    def test_0003_move_source(self):
+        '''moves fail while their source is still in place'''
+        patch_dir = self.patch_copy(self.archive)
+        shutil.copy(os.path.join(self.orig_dir, 'moved.bin'), patch_dir)
+        results = self.audit(patch_dir)
+        self.assertEqual([target for target, passed in results.iteritems()
+                          if not passed], ['new/dir/moved.bin'])
+
+    def test_0004_default_workers(self):
+        '''audits use one thread per CPU unless workers are given'''
+        self.assertEqual(
+            self.default_workers(lambda patcher: patcher.audit()),
+            [multiprocessing.cpu_count(), 2])
+
+
+class StreamingApplyTest(ApplyTestCase):
+
+    def test_0001_apply(self):
+        '''entries over the threshold are applied without reading them'''
+        patcher = pdar.PDArchivePatcher(self.archive, self.orig_dir,
+                                        stream_threshold=1024)
+        entries = dict((entry.target, entry)
+                       for entry in self.archive.patches)
+        self.assertTrue(patcher.streams(
+                entries['source.bin'], patcher.resolve('source.bin')))
+        self.assertFalse(patcher.streams(
+                entries['new.bin'], patcher.resolve('new.bin')))
+        for kwargs in ({}, {'journal': True}, {'workers': 4}):
+            patch_dir = self.patch_copy(self.archive, stream_threshold=1,
+                                        **kwargs)
+            self.assertTreesEqual(self.dest_dir, patch_dir)
+
+    def test_0002_rollback(self):
+        '''streamed targets are restored when an apply fails'''
+        patch_dir = os.path.join(self.workdir, 'patch_dir')
+        shutil.copytree(self.orig_dir, patch_dir)
+        patcher = pdar.PDArchivePatcher(self.archive, patch_dir,
+                                        stream_threshold=1)
+
+        def failing_remove():
+            raise IOError('failed')
+
+        patcher._remove_files = failing_remove
+        self.assertRaises(IOError, self.archive.patch, patcher=patcher)
+        self.assertTreesEqual(self.orig_dir, patch_dir)
+
+    def test_0003_delete(self):
+        '''deleted files over the threshold are removed without reading
+        them'''
+        patch_dir = os.path.join(self.workdir, 'patch_dir')
+        shutil.copytree(self.orig_dir, patch_dir)
+        patcher = pdar.PDArchivePatcher(self.archive, patch_dir,
+                                        stream_threshold=1)
+        applied = {}
+        apply_entry = patcher.apply_entry
+
+        def record_entry(entry, target, data):
+            applied[entry.target] = data
+            apply_entry(entry, target, data)
+
+        patcher.apply_entry = record_entry
+        self.archive.patch(patcher=patcher)
+        self.assertTreesEqual(self.dest_dir, patch_dir)
+        self.assertIn('deleted.bin', applied)
+        self.assertIsNone(applied['deleted.bin'])
+
+
+class BlockDiffTest(PatcherTestCase):
+
+    def setUp(self):
+        super(BlockDiffTest, self).setUp()
+        base = ''.join(chr((num * 7) % 251) for num in xrange(256 * 1024))
+        self.write_files(self.orig_dir, {'large.bin': base,
+                                         'small.bin': base[:1024]})
+        self.write_files(self.dest_dir, {
+                'large.bin': base[:1000] + 'inserted' + base[1000:150000] +
+                base[160000:] + 'appended',
+                'small.bin': base[:1024] + 'changed'})
+        self._archive = pdar.PDArchive(self.orig_dir, self.dest_dir,
+                                       block_threshold=64 * 1024,
+                                       block_size=16 * 1024)
+
+    @property
+    def archive(self):
+        return self._archive
+
+    def test_0001_entries(self):
+        '''only files over the threshold are diffed in blocks'''
+        self.assertEqual(
+            sorted((entry.target, entry.type_code)
+                   for entry in self.archive.patches),
+            [('large.bin', 'blockdiff'), ('small.bin', 'diff')])
+        entry = self.archive.patches[0]
+        size = os.path.getsize(os.path.join(self.dest_dir, 'large.bin'))
+        self.assertEqual(len(list(entry.iter_blocks())),
+                         (size + 16 * 1024 - 1) / (16 * 1024))
+
+    def test_0002_apply(self):
+        '''block diffs apply in place, atomically and with a journal'''
+        for kwargs in ({}, {'atomic': True}, {'journal': True}):
+            patch_dir = self.patch_copy(self.archive, **kwargs)
+            self.assertTreesEqual(self.dest_dir, patch_dir)
+
+    def test_0003_saved(self):
+        '''block diffs are applied from saved archives'''
+        for layout in ('tar', 'indexed'):
+            path = os.path.join(self.workdir, '%s.pdar' % layout)
+            self.archive.save(path, layout=layout)
+            with pdar.PDArchive.load(path) as archive:
+                patch_dir = self.patch_copy(archive)
+            self.assertTreesEqual(self.dest_dir, patch_dir)
+
+    def test_0004_mismatch(self):
+        '''modified originals are left in place'''
+        patch_dir = os.path.join(self.workdir, 'patch_dir')
+        shutil.copytree(self.orig_dir, patch_dir)
+        self.write_files(patch_dir, {'large.bin': 'unexpected'})
+        self.assertRaises(pdar.SourceFileError, self.archive.patch,
+                          patch_dir)
+        self.assertEqual(self.read_file(os.path.join(patch_dir,
+                                                     'large.bin')),
+                         'unexpected')
+
+    def test_0005_payload_file(self):
+        '''block records are kept in a file until the archive is closed'''
+        entry = self.archive.patches[0]
+        self.assertIsInstance(entry._payload, pdar.TemporaryPayload)
+        path = entry._payload.path
+        self.assertTrue(os.path.exists(path))
+        self.archive.close()
+        self.assertFalse(os.path.exists(path))
+
+    def test_0006_replace(self):
+        '''diffing stops once the delta is too large to be kept'''
+        self.write_files(self.dest_dir,
+                         {'large.bin': os.urandom(256 * 1024)})
+        diffs = []
+        diff = bsdiff4.diff
+        self.addCleanup(setattr, bsdiff4, 'diff', diff)
+
+        def record_diff(orig, dest):
+            diffs.append(len(dest))
+            return diff(orig, dest)
+
+        bsdiff4.diff = record_diff
+        archive = pdar.PDArchive(self.orig_dir, self.dest_dir,
+                                 block_threshold=64 * 1024,
+                                 block_size=16 * 1024, screen=False,
+                                 replace_ratio=0.25)
+        self.assertEqual(archive.patches[0].type_code, 'replace')
+        # a quarter of the blocks, and small.bin
+        self.assertLessEqual(len(diffs), 256 / 16 / 4 + 1)
+        patch_dir = self.patch_copy(archive)
+        self.assertTreesEqual(self.dest_dir, patch_dir)
+
+
+class ReplaceTest(PatcherTestCase):
+
+    def setUp(self):
+        super(ReplaceTest, self).setUp()
+        base = ''.join(chr(num % 251) for num in xrange(64 * 1024))
+        self.write_files(self.orig_dir, {'random.bin': os.urandom(8192),
+                                         'edited.bin': base})
+        self.write_files(self.dest_dir, {'random.bin': os.urandom(8192),
+                                         'edited.bin': base + 'changed'})
+
+    def entry_types(self, archive):
+        return dict((entry.target, entry.type_code)
+                    for entry in archive.patches)
+
+    def test_0001_entries(self):
+        '''files are stored whole when the delta is not smaller'''
+        archive = pdar.PDArchive(self.orig_dir, self.dest_dir)
+        self.assertEqual(self.entry_types(archive),
+                         {'random.bin': 'replace', 'edited.bin': 'diff'})
+        archive = pdar.PDArchive(self.orig_dir, self.dest_dir,
+                                 replace_ratio=0, screen=False)
+        self.assertEqual(self.entry_types(archive),
+                         {'random.bin': 'diff', 'edited.bin': 'diff'})
+        archive = pdar.PDArchive(self.orig_dir, self.dest_dir,
+                                 replace_ratio=0.001)
+        self.assertEqual(self.entry_types(archive),
+                         {'random.bin': 'replace', 'edited.bin': 'replace'})
+
+    def test_0002_apply(self):
+        '''replacements apply in memory and streamed'''
+        archive = pdar.PDArchive(self.orig_dir, self.dest_dir)
+        for stream_threshold in (0, 1):
+            patch_dir = self.patch_copy(archive,
+                                        stream_threshold=stream_threshold)
+            self.assertTreesEqual(self.dest_dir, patch_dir)
+
+    def test_0003_orig_digest(self):
+        '''replaced files must still contain the original data'''
+        archive = pdar.PDArchive(self.orig_dir, self.dest_dir)
+        patch_dir = os.path.join(self.workdir, 'patch_dir')
+        shutil.copytree(self.orig_dir, patch_dir)
+        self.write_files(patch_dir, {'random.bin': 'unexpected'})
+        self.assertRaises(pdar.SourceFileError, archive.patch, patch_dir)
+
+
+class StatsTest(PatcherTestCase):
+
+    def test_0001_phases(self):
+        '''observers receive phases, entries and counters'''
+        base = ''.join(chr(num % 251) for num in xrange(16 * 1024))
+        self.write_files(self.orig_dir, {'diff.bin': base})
+        self.write_files(self.dest_dir, {'diff.bin': base + 'changed',
+                                         'new.bin': 'new data'})
+        stats = pdar.StatsCollector()
+        archive = pdar.PDArchive(self.orig_dir, self.dest_dir,
+                                 observer=stats)
+        archive_path = os.path.join(self.workdir, 'stats.pdar')
+        archive.save(archive_path)
+        with pdar.PDArchive.load(archive_path, observer=stats) as loaded:
+            self.patch_copy(loaded)
+
+        self.assertEqual(
+            stats.phases.keys(),
+            ['scan', 'match', 'create', 'save', 'load', 'plan', 'apply',
+             'remove', 'cleanup'])
+        for phase in ('create', 'save', 'apply'):
+            self.assertEqual(stats.entries[(phase, 'diff')][0], 1)
+            self.assertEqual(stats.entries[(phase, 'new')][0], 1)
+        self.assertIn('patch', stats.timings)
+        self.assertEqual(stats.counters['bytes_written'],
+                         os.path.getsize(archive_path))
+        self.assertEqual(stats.counters['bytes_out'],
+                         len(base + 'changed') + len('new data'))
+        self.assertIn('counters:', stats.summary())
+
+
+class ConcurrentApplyTest(PatcherTestCase):
+
+    count = 4
+
+    def test_0001_concurrent_apply(self):
+        '''archives can be applied to separate trees from parallel threads'''
+        jobs = []
+        for num in xrange(self.count):
+            data = ''.join(chr((num * 7 + i) % 256) for i in xrange(32768))
+            orig_dir = os.path.join(self.workdir, 'orig_%d' % num)
+            dest_dir = os.path.join(self.workdir, 'dest_%d' % num)
+            patch_dir = os.path.join(self.workdir, 'patch_%d' % num)
+            self.write_files(orig_dir, {
+                    'diff.bin': data, 'moved.bin': data[::-1],
+                    'deleted.bin': data[:num + 1]})
+            self.write_files(dest_dir, {
+                    'diff.bin': data[:num * 100] + 'tree %d' % num + data,
+                    'sub/moved.bin': data[::-1],
+                    'new.bin': 'tree %d' % num})
+            shutil.copytree(orig_dir, patch_dir)
+            jobs.append((pdar.PDArchive(orig_dir, dest_dir), dest_dir,
+                         patch_dir))
+
+        errors = []
+
+        def apply_archive(archive, patch_dir):
+            try:
+                archive.patch(patch_dir)
+            except Exception, err:
+                errors.append(err)
+
+        cwd = os.getcwd()
+        threads = [threading.Thread(target=apply_archive,
+                                    args=(archive, patch_dir))
+                   for archive, dummy, patch_dir in jobs]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(os.getcwd(), cwd)
+        for dummy, dest_dir, patch_dir in jobs:
+            self.assertTreesEqual(dest_dir, patch_dir)
+
+
+if __name__ == "__main__":
+    tests.main()
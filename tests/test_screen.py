@@ -0,0 +1,95 @@
+# This file is part of pdar.
+#
+# Copyright 2011 Jason Penney
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest2
+import tests
+import pdar
+
+import os
+import random
+import zlib
+
+
+class ScreenTestCase(tests.WorkdirTestCase):
+
+    def setUp(self):
+        super(ScreenTestCase, self).setUp()
+        rand = random.Random(0)
+        self.text = ''.join(rand.choice('abcdefgh \n')
+                            for dummy in xrange(200000))
+        self.packed = zlib.compress(self.text, 9)
+
+
+class DiffScreenTest(ScreenTestCase):
+
+    def test_0001_extensions(self):
+        '''denied extensions are stored whole unless allowed'''
+        orig = self.write_file('orig.txt', self.text)
+        dest = self.write_file('dest.GZ', self.text + 'changed')
+        self.assertEqual(pdar.DiffScreen().check(orig, dest), 'extension')
+        screen = pdar.DiffScreen(allow=['.gz'])
+        self.assertIsNone(screen.check(orig, dest))
+        self.assertEqual(screen.counts['diff'], 1)
+
+    def test_0002_compressible(self):
+        '''compressible files are diffed'''
+        orig = self.write_file('orig', self.text)
+        dest = self.write_file('dest', self.text[::-1])
+        self.assertIsNone(pdar.DiffScreen().check(orig, dest))
+
+    def test_0003_incompressible(self):
+        '''compressed files are diffed only when they resemble the
+        original'''
+        orig = self.write_file('orig', self.packed)
+        dest = self.write_file('dest', zlib.compress(self.text[1:], 9))
+        screen = pdar.DiffScreen()
+        self.assertEqual(screen.check(orig, dest), 'incompressible')
+        self.assertEqual(screen.check(orig, dest, self.packed),
+                         'incompressible')
+        dest = self.write_file('dest', self.packed[:50000] + 'changed' +
+                               self.packed[50000:])
+        self.assertIsNone(screen.check(orig, dest))
+        self.assertIsNone(screen.check(orig, dest, self.packed))
+        self.assertEqual(screen.counts.items(), [
+                ('extension', 0), ('incompressible', 2), ('diff', 2)])
+
+
+class ScreenedArchiveTest(ScreenTestCase):
+
+    def test_0001_create(self):
+        '''screened files become replace entries and are counted'''
+        orig_dir = os.path.join(self.workdir, 'orig')
+        dest_dir = os.path.join(self.workdir, 'dest')
+        os.makedirs(orig_dir)
+        os.makedirs(dest_dir)
+        for path, data in ((orig_dir, self.packed),
+                           (dest_dir, zlib.compress(self.text[1:], 9))):
+            with open(os.path.join(path, 'packed.bin'), 'wb') as writer:
+                writer.write(data)
+        for workers in (None, 2):
+            stats = pdar.StatsCollector()
+            archive = pdar.PDArchive(orig_dir, dest_dir, workers=workers,
+                                     observer=stats)
+            self.assertEqual([entry.type_code for entry in archive.patches],
+                             ['replace'])
+            self.assertEqual(stats.counters['screen_incompressible'], 1)
+            archive = pdar.PDArchive(orig_dir, dest_dir, screen=False)
+            self.assertEqual([entry.type_code for entry in archive.patches],
+                             ['replace'])
+
+
+if __name__ == "__main__":
+    tests.main()